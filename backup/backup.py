@@ -10,64 +10,125 @@ pip3 install python_telegram_bot==13.7
 
 pip3 install voluptuous==0.12.2
 pip3 install pyyaml==5.4.1
+
+pip3 install cryptography  # only for the encryption
+pip3 install zstandard  # only for the zstd codec
 """
 
+import base64
+import collections
+import concurrent.futures
+import contextlib
 import datetime
-import docker
+import fcntl
 import fnmatch
+import functools
 import glob
+import grp
+import gzip
+import hashlib
+import io
 import logging
 import os
-import paramiko
+import pwd
 import re
-import scp
 import shutil
+import signal
 import socket
+import sqlite3
+import stat
+import struct
+import subprocess
 import sys
 import tarfile
-import telegram
+import tempfile
+import threading
+import time
+import zlib
 import voluptuous as vol
 import yaml
 
 from logging.handlers import RotatingFileHandler
 
+# docker, paramiko, scp, telegram, cryptography and zstandard are imported by the code
+# that needs them. Together they are most of the startup time on a Pi, and e.g.
+# run_host or cleanup do not need any of them
+
 #################################################################
+CONF_AES_GCM = "aes-gcm"
 CONF_APP = "app"
 CONF_CLEANUP = "cleanup"
 CONF_CHAT_ID = "chat_id"
+CONF_CATALOG = "catalog"
+CONF_CHACHA20 = "chacha20"
 CONF_CHOWN = "chown"
+CONF_CIPHER = "cipher"
+CONF_CODEC = "codec"
 CONF_CONFIG = "config"
 CONF_CONTAINER = "container"
 CONF_COUNT = "count"
+CONF_DATA = "data"
 CONF_DAY = "day"
+CONF_DAYS = "days"
 CONF_DB = "db"
+CONF_DEADLINE = "deadline"
 CONF_DBNAME = "dbname"
 CONF_DBUSER = "dbuser"
 CONF_DIR = "dir"
 CONF_DISABLE_NOTIFICATION = "disable_notification"
 CONF_DOCKER = "docker"
 CONF_ENABLED = "enabled"
+CONF_ENCRYPTION = "encryption"
+CONF_ERASURE = "erasure"
 CONF_EXCLUDE = "exclude"
 CONF_EXPIRY = "expiry"
 CONF_EXPIRY_APP = "expiry_app"
 CONF_EXPIRY_DB = "expiry_db"
 CONF_EXPIRY_OTHER = "expire_other"
+CONF_FADVISE = "fadvise"
+CONF_FILE = "file"
+CONF_FROM = "from"
+CONF_FSYNC = "fsync"
+CONF_FULL = "full"
+CONF_GZIP = "gzip"
 CONF_HOST = "host"
+CONF_IDLE = "idle"
+CONF_IONICE = "ionice"
+CONF_BEST_EFFORT = "best-effort"
 CONF_IMAGE = "image"
+CONF_LEVEL = "level"
 CONF_LOCAL = "local"
+CONF_METRICS = "metrics"
 CONF_MSG = "msg"
+CONF_NONE = "none"
 CONF_MONTH = "month"
 CONF_NAME = "name"
+CONF_NICE = "nice"
 CONF_OTHER = "other"
+CONF_PARITY = "parity"
+CONF_PAUSE = "pause"
 CONF_PORT = "port"
+CONF_PREFETCH = "prefetch"
+CONF_PREFLIGHT = "preflight"
+CONF_PRIVATE_KEY = "private_key"
+CONF_PUBLIC_KEY = "public_key"
+CONF_QUIESCE = "quiesce"
+CONF_RATE = "rate"
 CONF_RUN_HOST = "run_host"
+CONF_SCHEDULE = "schedule"
 CONF_REMOTE = "remote"
 CONF_RETRY = "retry"
 CONF_SCP = "scp"
+CONF_SCRUB = "scrub"
+CONF_SHARDS = "shards"
+CONF_SIZE = "size"
+CONF_SNAPSHOT = "snapshot"
 CONF_SOURCEDIR = "sourcedir"
+CONF_STOP = "stop"
 CONF_STOPDOCKER = "stopdocker"
 CONF_TELEGRAM = "telegram"
 CONF_TEMP = "temp"
+CONF_THROTTLE = "throttle"
 CONF_TOKEN = "token"
 CONF_TRANSFER = "transfer"
 CONF_TYPE = "type"
@@ -76,18 +137,215 @@ CONF_TYPE_POSTGRESQL = "postgresql"
 CONF_TYPE_INFLUXDB_BACKUP = "influxdb-backup"
 CONF_TYPE_INFLUXDB_EXPORT = "influxdb-export"
 CONF_USER = "user"
+CONF_VERIFY = "verify"
+CONF_VOLUME = "volume"
+CONF_WORKERS = "workers"
 CONF_YEAR = "year"
+CONF_ZSTD = "zstd"
 CONF_WEEKDAY = "weekday"
 
 # Weekday: Mon=1, Tue=2, Wed=3, Thu=4, Fri=5, Sat=6, Sun=7
 
+# Cron fields: minute, hour, day, month, weekday (Sun=0 or 7)
+CRON_RANGES = [(0, 59), (0, 23), (1, 31), (1, 12), (0, 7)]
+
 #################################################################
 CONFIGNAME = "backup.yaml"
-DB_MYSQL = "docker exec {container} sh -c 'exec mysqldump --defaults-extra-file=/var/lib/mysql/.mysql-root.conf --routines --skip-lock-tables --databases {database}' | gzip >{dir_temp}/{file_name}"
-DB_POSTGRESQL = "docker exec -t {container} pg_dumpall -c -U {sqluser}| gzip >{dir_temp}/{file_name}"
+CONFIGFILE = f"{os.path.realpath(os.path.dirname(os.path.abspath(__file__)))}/{CONFIGNAME}"
+DB_MYSQL = "docker exec {container} sh -c '{priority}exec mysqldump --defaults-extra-file=/var/lib/mysql/.mysql-root.conf --routines --skip-lock-tables --databases {database}'"
+DB_POSTGRESQL = "docker exec {container} sh -c '{priority}exec pg_dumpall -c -U {sqluser}'"
+DB_GZIP = " | gzip"
 DB_INFLUXDB_BACKUP = "docker exec {container} sh -c 'rm -rf /backup/output && influxd backup -portable /backup/output >/dev/null && cd /backup && tar cfz /backup/{file_name} output --remove-files'"
 DB_INFLUXDB_EXPORT = "docker exec {container} influx_inspect export -compress -database {database} -datadir /var/lib/influxdb/data/ -waldir /var/lib/influxdb/wal/ -out /backup/influx-export.gz >/dev/null"
 
+# Restore commands, the dump is streamed into stdin
+RESTORE_CHUNK = 1024 * 1024
+EXEC_POLL = 0.1
+RESTORE_MYSQL = "exec mysql --defaults-extra-file=/var/lib/mysql/.mysql-root.conf"
+RESTORE_POSTGRESQL = "exec psql -q -U {sqluser} -d postgres"
+RESTORE_INFLUXDB_BACKUP_UNPACK = "rm -rf /backup/output && exec tar xf - -C /backup"
+# All databases of the backup, they must not exist (drop them first)
+RESTORE_INFLUXDB_BACKUP = "influxd restore -portable /backup/output >/dev/null && rm -rf /backup/output"
+# One database, also into an existing one: restored as a new database and
+# copied into it (InfluxDB has no rename), then the new one is dropped
+RESTORE_INFLUXDB_BACKUP_DB = (
+    "influx -execute 'DROP DATABASE \"{database}_restore\"' >/dev/null"
+    " && influxd restore -portable -db {database} -newdb {database}_restore /backup/output >/dev/null"
+    " && rm -rf /backup/output"
+    " && influx -execute 'CREATE DATABASE \"{database}\"' >/dev/null"
+    " && influx -execute 'SELECT * INTO \"{database}\"..:MEASUREMENT FROM \"{database}_restore\"../.*/ GROUP BY *' >/dev/null"
+    " && influx -execute 'DROP DATABASE \"{database}_restore\"' >/dev/null"
+)
+RESTORE_INFLUXDB_EXPORT = "exec influx -import -path=/dev/stdin -precision=ns"
+
+# Encryption stage, see EncryptWriter
+ENCRYPT_MAGIC = b"BACKUPPY-ENC1"
+ENCRYPT_CIPHERS = [CONF_AES_GCM, CONF_CHACHA20]
+ENCRYPT_CHUNK = 1024 * 1024
+ENCRYPT_SUFFIX = ".enc"
+
+# ionice class per throttle setting, best-effort gets the lowest level
+IONICE_ARGS = {
+    CONF_NONE: ["-c", "0"],
+    CONF_BEST_EFFORT: ["-c", "2", "-n", "7"],
+    CONF_IDLE: ["-c", "3"],
+}
+
+# The same for a dump in the container, its shell sets it for itself before
+# the exec. Best-effort, not every image has renice and ionice
+DB_NICE = "renice -n {nice} -p $$ >/dev/null 2>&1; "
+DB_IONICE = "ionice {args} -p $$ >/dev/null 2>&1; "
+
+# Files stored without compression in an app archive, the extension says it
+# is compressed already. Other big files are checked with a sample
+STORE_EXTENSIONS = {
+    ".7z", ".avi", ".bz2", ".gif", ".gz", ".heic", ".jpeg", ".jpg", ".mkv",
+    ".mov", ".mp3", ".mp4", ".png", ".tgz", ".webm", ".webp", ".xz", ".zip",
+    ".zst",
+}
+STORE_SAMPLE = 64 * 1024
+STORE_RATIO = 0.95
+
+# Compression level of the app archives, and with a deadline the speed of
+# the levels relative to level 6 (zlib, text) when there is no history yet
+LEVEL_MAX = 9
+LEVEL_SPEED = {1: 4.0, 2: 3.7, 3: 2.7, 4: 2.4, 5: 2.0, 6: 1.0, 7: 0.55, 8: 0.3, 9: 0.28}
+LEVEL_RATE = 8 * 1024 * 1024
+LEVEL_HISTORY = 20
+
+# Read-ahead of the archive: files up to PREFETCH_SIZE are read by the pool,
+# at most PREFETCH_FILES ahead of the tar writer (so PREFETCH_FILES times
+# PREFETCH_SIZE in memory at most)
+PREFETCH_SIZE = 128 * 1024
+PREFETCH_FILES = 128
+
+# Check the pace of an archive every PACE_BYTES, against the deadline
+PACE_BYTES = 16 * 1024 * 1024
+
+# Volumes of a big artifact on the backup hosts: name.v000, name.v001, ...
+VOLUME_PATTERN = r"\.v\d{3}$"
+
+# Lock of a run, with the pid and mode of the holder. A command line run
+# while the daemon has the lock is a request in the queue of the daemon.
+# Other runs wait, at most LOCK_WAIT seconds
+LOCK_FILE = "/run/backup.py.lock"
+LOCK_WAIT = 6 * 3600
+LOCK_POLL = 10
+QUEUE_DIR = "/run/backup.py.queue"
+
+# Erasure coding over the backup hosts, see writeShards(). A stripe is a
+# block per data shard, at most SHARD_BLOCK (less for a small artifact)
+SHARD_MAGIC = b"BACKUPPY-RS1"
+SHARD_HEADER = struct.Struct(">12sBBBQI")
+SHARD_BLOCK = 1024 * 1024
+SHARD_PATTERN = r"\.rs\d{2}$"
+
+# The zstd codec, for small entries that are alike from day to day. A
+# dictionary per entry is trained from the start (ZSTD_SAMPLE bytes) of the
+# last ZSTD_RUNS artifacts, again every run until it has all of them, and
+# then every ZSTD_RETRAIN days. Its id is in the zstd frame header
+ZSTD_SUFFIX = ".zst"
+ZSTD_LEVEL = 19
+# A tree can be big, its zstd level follows the gzip level of the deadline
+# plan (index 0-9, see chooseLevel). Each is faster than that gzip level,
+# so the plan by gzip rates still holds
+ZSTD_TREE_LEVEL = (1, 1, 1, 1, 2, 2, 2, 3, 3, 3)
+ZSTD_HEADER = 18
+ZSTD_SAMPLE = 1024 * 1024
+ZSTD_CHUNK = 4096
+ZSTD_RUNS = 7
+ZSTD_RETRAIN = 7
+ZSTD_DICT_SIZE = 32 * 1024
+
+# A dictionary also goes with the artifacts, "<name>.dict.<id>" (encrypted if
+# enabled), so a restore without the catalog can find it
+DICT_PATTERN = r"\.dict\.\d+(\.enc)?$"
+
+# ioctl of a reflink copy (linux/fs.h), see cloneFile()
+FICLONE = 0x40049409
+
+# Stages of an entry in the run journal
+JOURNAL_BACKUP = "backup"
+JOURNAL_TRANSFER = "transfer"
+
+# Runs of an entry for its expected duration, see expectedDuration()
+DURATION_HISTORY = 5
+
+# Expected growth of a database or tree since the last backup, for the
+# preflight and the deadline plan
+PREFLIGHT_GROWTH = 1.1
+
+# Seconds to wait for a throwaway database container to be ready
+VERIFY_TIMEOUT = 300
+
+#################################################################
+@functools.lru_cache(maxsize=None)
+def cronParse(schedule):
+    """Parse a cron schedule "minute hour day month weekday" into sets.
+       Supports *, ranges, steps and lists, e.g. "30 2 * * 1-5"."""
+
+    fields = schedule.split()
+    if len(fields) != 5:
+        raise ValueError(f"Schedule '{schedule}' should have 5 fields")
+
+    result = []
+    for field, (low, high) in zip(fields, CRON_RANGES):
+        values = set()
+        for part in field.split(","):
+            part, _, step = part.partition("/")
+            if part == "*":
+                start, end = low, high
+            elif "-" in part:
+                start, end = [int(value) for value in part.split("-")]
+            else:
+                start = end = int(part)
+                if step:
+                    end = high
+
+            if start < low or end > high or start > end:
+                raise ValueError(f"Schedule '{schedule}' has invalid field '{field}'")
+
+            values.update(range(start, end + 1, int(step or 1)))
+        result.append(values)
+
+    # Weekday 0 and 7 are both Sunday
+    if 7 in result[4]:
+        result[4].add(0)
+
+    # Like cron, a restricted day and weekday means either of them
+    result.append(fields[2] != "*" and fields[4] != "*")
+    return result
+
+
+#################################################################
+def cronMatch(schedule, when):
+    """Check if the cron schedule matches the date/time (minute)."""
+
+    minutes, hours, days, months, weekdays, either = cronParse(schedule)
+
+    if when.minute not in minutes or when.hour not in hours:
+        return False
+    if when.month not in months:
+        return False
+
+    day = when.day in days
+    weekday = when.isoweekday() % 7 in weekdays
+    return (day or weekday) if either else (day and weekday)
+
+
+#################################################################
+def cronValid(schedule):
+    """Voluptuous validator for a cron schedule."""
+
+    if schedule:
+        try:
+            cronParse(schedule)
+        except ValueError as e:
+            raise vol.Invalid(str(e))
+
+    return schedule
+
+
 #################################################################
 
 TRANSFER_SCHEMA = vol.Schema(
@@ -98,6 +356,35 @@ TRANSFER_SCHEMA = vol.Schema(
         vol.Optional(CONF_USER, default="pi"): str,
         vol.Optional(CONF_RETRY, default=1): int,
         vol.Optional(CONF_RUN_HOST, default=[]): list,
+        vol.Optional(CONF_EXPIRY, default=0): vol.All(int, vol.Range(min=0)),
+    }
+)
+
+ENCRYPTION_SCHEMA = vol.Schema(
+    {
+        vol.Optional(CONF_ENABLED, default=False): bool,
+        vol.Optional(CONF_PUBLIC_KEY, default=""): str,
+        vol.Optional(CONF_PRIVATE_KEY, default=""): str,
+        vol.Optional(CONF_CIPHER, default=CONF_AES_GCM): vol.Any(
+            CONF_AES_GCM, CONF_CHACHA20
+        ),
+    }
+)
+
+VOLUME_SCHEMA = vol.Schema(
+    {
+        vol.Optional(CONF_SIZE, default=0): vol.All(int, vol.Range(min=0)),
+        vol.Optional(CONF_WORKERS, default=4): vol.All(
+            int, vol.Range(min=1, max=16)
+        ),
+    }
+)
+
+ERASURE_SCHEMA = vol.Schema(
+    {
+        vol.Optional(CONF_ENABLED, default=False): bool,
+        vol.Optional(CONF_DATA, default=2): vol.All(int, vol.Range(min=1, max=50)),
+        vol.Optional(CONF_PARITY, default=1): vol.All(int, vol.Range(min=1, max=49)),
     }
 )
 
@@ -129,7 +416,22 @@ CONF_SCHEMA = vol.Schema(
             list, [vol.Any(TRANSFER_SCHEMA)]
         ),
         vol.Optional(CONF_TELEGRAM, default={}): vol.Schema(TELEGRAM_SCHEMA),
+        vol.Optional(CONF_ENCRYPTION, default={}): ENCRYPTION_SCHEMA,
+        vol.Optional(CONF_VOLUME, default={}): VOLUME_SCHEMA,
+        vol.Optional(CONF_ERASURE, default={}): ERASURE_SCHEMA,
         vol.Optional(CONF_CHOWN, default=""): str,
+        vol.Optional(CONF_SCHEDULE, default="0 2 * * *"): vol.All(str, cronValid),
+        vol.Optional(CONF_WORKERS, default=1): vol.All(int, vol.Range(min=1, max=16)),
+        vol.Optional(CONF_PREFLIGHT, default=True): bool,
+        vol.Optional(CONF_DEADLINE, default=0): vol.All(int, vol.Range(min=0)),
+        vol.Optional(CONF_PREFETCH, default=4): vol.All(
+            int, vol.Range(min=0, max=64)
+        ),
+        vol.Optional(CONF_FSYNC, default=CONF_NONE): vol.Any(
+            CONF_NONE, CONF_FILE, CONF_FULL
+        ),
+        vol.Optional(CONF_CATALOG, default=""): str,
+        vol.Optional(CONF_METRICS, default=""): str,
     }
 )
 # vol.Optional(CONF_TELEGRAM, default={}): vol.Schema(TELEGRAM_SCHEMA),
@@ -142,6 +444,19 @@ EXPIRY_SCHEMA = vol.Schema(
     }
 )
 
+THROTTLE_SCHEMA = vol.Schema(
+    {
+        vol.Optional(CONF_NICE, default=0): vol.All(int, vol.Range(min=0, max=19)),
+        vol.Optional(CONF_IONICE, default=CONF_NONE): vol.Any(
+            CONF_NONE, CONF_BEST_EFFORT, CONF_IDLE
+        ),
+        vol.Optional(CONF_RATE, default=0): vol.All(
+            vol.Coerce(float), vol.Range(min=0)
+        ),
+        vol.Optional(CONF_FADVISE, default=False): bool,
+    }
+)
+
 EXPIRY_APP_SCHEMA = vol.Schema(
     {
         vol.Optional(CONF_DAY, default=14): int,
@@ -174,11 +489,18 @@ APP_SCHEMA = vol.Schema(
         vol.Optional(CONF_ENABLED, default=True): bool,
         vol.Required(CONF_NAME): str,
         vol.Optional(CONF_STOPDOCKER, default=False): bool,
+        vol.Optional(CONF_QUIESCE, default=CONF_NONE): vol.Any(
+            CONF_NONE, CONF_STOP, CONF_PAUSE
+        ),
+        vol.Optional(CONF_SNAPSHOT, default=False): bool,
+        vol.Optional(CONF_CODEC, default=CONF_GZIP): vol.Any(CONF_GZIP, CONF_ZSTD),
         vol.Optional(CONF_EXCLUDE, default=[]): list,
         vol.Optional(CONF_CONTAINER, default=""): str,
         vol.Optional(CONF_SOURCEDIR, default=""): str,
         vol.Optional(CONF_WEEKDAY, default=[1, 2, 3, 4, 5, 6, 7]): list,
+        vol.Optional(CONF_SCHEDULE, default=""): vol.All(str, cronValid),
         vol.Optional(CONF_EXPIRY, default={}): EXPIRY_SCHEMA,
+        vol.Optional(CONF_THROTTLE, default={}): THROTTLE_SCHEMA,
         vol.Optional(CONF_RUN_HOST, default=[]): list,
     }
 )
@@ -188,18 +510,23 @@ DB_SCHEMA = vol.Schema(
         vol.Optional(CONF_ENABLED, default=True): bool,
         vol.Required(CONF_NAME): str,
         vol.Optional(CONF_STOPDOCKER, default=False): bool,
+        # No pause, the dump is a docker exec and a paused container has none
+        vol.Optional(CONF_QUIESCE, default=CONF_NONE): vol.Any(CONF_NONE, CONF_STOP),
         vol.Required(CONF_TYPE): vol.Any(
             CONF_TYPE_MYSQL,
             CONF_TYPE_POSTGRESQL,
             CONF_TYPE_INFLUXDB_BACKUP,
             CONF_TYPE_INFLUXDB_EXPORT,
         ),
+        vol.Optional(CONF_CODEC, default=CONF_GZIP): vol.Any(CONF_GZIP, CONF_ZSTD),
         vol.Optional(CONF_DBNAME, default=""): str,
         vol.Optional(CONF_DBUSER, default=""): str,
         vol.Optional(CONF_CONTAINER, default=""): str,
         vol.Optional(CONF_SOURCEDIR, default=""): str,
         vol.Optional(CONF_WEEKDAY, default=[1, 2, 3, 4, 5, 6, 7]): list,
+        vol.Optional(CONF_SCHEDULE, default=""): vol.All(str, cronValid),
         vol.Optional(CONF_EXPIRY, default={}): EXPIRY_SCHEMA,
+        vol.Optional(CONF_THROTTLE, default={}): THROTTLE_SCHEMA,
         vol.Optional(CONF_RUN_HOST, default=[]): list,
     }
 )
@@ -209,10 +536,17 @@ OTHER_SCHEMA = vol.Schema(
         vol.Optional(CONF_ENABLED, default=True): bool,
         vol.Required(CONF_NAME): str,
         vol.Optional(CONF_STOPDOCKER, default=False): bool,
+        vol.Optional(CONF_QUIESCE, default=CONF_NONE): vol.Any(
+            CONF_NONE, CONF_STOP, CONF_PAUSE
+        ),
+        vol.Optional(CONF_SNAPSHOT, default=False): bool,
+        vol.Optional(CONF_CODEC, default=CONF_GZIP): vol.Any(CONF_GZIP, CONF_ZSTD),
         vol.Optional(CONF_EXCLUDE, default=[]): list,
         vol.Optional(CONF_SOURCEDIR, default=""): str,
         vol.Optional(CONF_WEEKDAY, default=[1, 2, 3, 4, 5, 6, 7]): list,
+        vol.Optional(CONF_SCHEDULE, default=""): vol.All(str, cronValid),
         vol.Optional(CONF_EXPIRY, default={}): EXPIRY_SCHEMA,
+        vol.Optional(CONF_THROTTLE, default={}): THROTTLE_SCHEMA,
         vol.Optional(CONF_RUN_HOST, default=[]): list,
     }
 )
@@ -221,6 +555,26 @@ IMAGE_SCHEMA = vol.Schema(
     {
         vol.Optional(CONF_WEEKDAY, default=[7]): list,
         vol.Optional(CONF_CLEANUP, default=False): bool,
+        vol.Optional(CONF_WORKERS, default=2): vol.All(int, vol.Range(min=1)),
+        vol.Optional(CONF_LEVEL, default=6): vol.All(int, vol.Range(min=0, max=9)),
+    }
+)
+
+VERIFY_SCHEMA = vol.Schema(
+    {
+        vol.Optional(CONF_WEEKDAY, default=[]): list,
+        vol.Optional(CONF_CONTAINER, default=False): bool,
+    }
+)
+
+SCRUB_SCHEMA = vol.Schema(
+    {
+        vol.Optional(CONF_WEEKDAY, default=[]): list,
+        vol.Optional(CONF_WORKERS, default=2): vol.All(int, vol.Range(min=1, max=16)),
+        vol.Optional(CONF_RATE, default=0): vol.All(
+            vol.Coerce(float), vol.Range(min=0)
+        ),
+        vol.Optional(CONF_DAYS, default=30): vol.All(int, vol.Range(min=1)),
     }
 )
 
@@ -234,6 +588,8 @@ CONFIG_SCHEMA = vol.Schema(
         vol.Optional(CONF_EXPIRY_DB, default={}): EXPIRY_DB_SCHEMA,
         vol.Optional(CONF_EXPIRY_OTHER, default={}): EXPIRY_OTHER_SCHEMA,
         vol.Optional(CONF_IMAGE, default={}): IMAGE_SCHEMA,
+        vol.Optional(CONF_VERIFY, default={}): VERIFY_SCHEMA,
+        vol.Optional(CONF_SCRUB, default={}): SCRUB_SCHEMA,
     }
 )
 
@@ -249,12 +605,139 @@ LOGGER.setLevel(logging.DEBUG)
 ERRORS = {}
 ERRORS[CONF_COUNT] = 0
 ERRORS[CONF_MSG] = []
+ERRORS_LOCK = threading.Lock()
+
+# Set by main()
+args = {}
+config = None
+hostname = ""
+
+# Pooled SSH clients, keyed by (host, port, user) and a slot number for
+# the extra sessions of parallel uploads
+SSH_POOL = {}
+SSH_LOCK = threading.RLock()
+
+# Catalog connection, see catalog()
+CATALOG = None
+CATALOG_LOCK = threading.Lock()
+CATALOG_SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS restore (
+        date TEXT, type TEXT, name TEXT, file_name TEXT,
+        seconds REAL, size INTEGER, ok INTEGER)""",
+    """CREATE TABLE IF NOT EXISTS artifact (
+        date TEXT, type TEXT, name TEXT, file_name TEXT,
+        size INTEGER, input_size INTEGER, seconds REAL)""",
+    """CREATE TABLE IF NOT EXISTS fingerprint (
+        date TEXT, type TEXT, name TEXT, file_name TEXT,
+        fingerprint TEXT, reference TEXT)""",
+    """CREATE TABLE IF NOT EXISTS volume (
+        date TEXT, type TEXT, name TEXT, file_name TEXT,
+        volume INTEGER, offset INTEGER, size INTEGER, sha256 TEXT)""",
+    """CREATE TABLE IF NOT EXISTS checksum (
+        date TEXT, type TEXT, name TEXT, file_name TEXT, sha256 TEXT)""",
+    """CREATE TABLE IF NOT EXISTS scrub (
+        date TEXT, type TEXT, name TEXT, file_name TEXT, host TEXT, ok INTEGER)""",
+    """CREATE TABLE IF NOT EXISTS shard (
+        date TEXT, type TEXT, name TEXT, file_name TEXT,
+        shard INTEGER, host TEXT, size INTEGER, sha256 TEXT)""",
+    """CREATE TABLE IF NOT EXISTS journal (
+        run TEXT, type TEXT, name TEXT, stage TEXT, host TEXT,
+        file_name TEXT, done INTEGER, date TEXT,
+        PRIMARY KEY (run, type, name, stage, host))""",
+    """CREATE TABLE IF NOT EXISTS dictionary (
+        date TEXT, type TEXT, name TEXT, version INTEGER, dict_id INTEGER,
+        runs INTEGER, data BLOB)""",
+    """CREATE TABLE IF NOT EXISTS sample (
+        date TEXT, type TEXT, name TEXT, data BLOB)""",
+    """CREATE TABLE IF NOT EXISTS usage (
+        date TEXT, type TEXT, name TEXT, file_name TEXT, dict_id INTEGER)""",
+    """CREATE TABLE IF NOT EXISTS duration (
+        date TEXT, type TEXT, name TEXT, stage TEXT, seconds REAL, size INTEGER)""",
+    """CREATE TABLE IF NOT EXISTS compression (
+        date TEXT, type TEXT, name TEXT, level INTEGER,
+        input_size INTEGER, seconds REAL)""",
+]
+
+# Transfers skipped by the preflight: (host, type, name)
+PREFLIGHT_SKIP = set()
+
+# Size of the trees without history this run, see inputSize()
+TREE_SIZE = {}
+
+# With a deadline: the end (monotonic) and the entries still to do, as
+# (type, entry, input size) for an app and (type, entry, seconds) for a db
+DEADLINE = None
+PLAN = []
+
+# Containers stopped or paused for their backup, with the mode and start
+QUIESCED = {}
+
+# Open lock file while we have the run lock, see lockRun()
+LOCK = None
+
+# The run in the journal: the date it started, or the run we resume
+JOURNAL_RUN = None
+
+# Data key of this run and its wrapped form, see runKey()
+RUN_KEY = None
+
+# Verify-restore results: (type, name, ok)
+VERIFIED = []
+
+# Timing per type/name/stage: (type, name, stage, seconds, size)
+REPORT = []
 
 #################################################################
 def ErrorMsg(msg):
     """Store the error message for reporting via e.g. Telegram."""
-    ERRORS[CONF_COUNT] += 1
-    ERRORS[CONF_MSG].append(msg)
+    with ERRORS_LOCK:
+        ERRORS[CONF_COUNT] += 1
+        ERRORS[CONF_MSG].append(msg)
+
+
+#################################################################
+def ReportTime(typeName, name, stage, seconds, size=0):
+    """Store the timing of a stage for the run report, and in the catalog
+       for the history of the entry."""
+    REPORT.append((typeName, name, stage, seconds, size))
+    catalogExecute(
+        "INSERT INTO duration VALUES (?, ?, ?, ?, ?, ?)",
+        (datetime.datetime.now().isoformat(), typeName, name, stage, seconds, size),
+    )
+
+
+#################################################################
+def sizeUnit(size):
+    """Size in bytes as readable kByte/MByte text."""
+
+    size = round(size / 1024, 1)
+    unit = "kByte"
+
+    # Change to MByte if needed
+    if size > 1000:
+        size = round(size / 1024, 1)
+        unit = "MByte"
+
+    return f"{size} {unit}"
+
+
+#################################################################
+def reportRun():
+    """Log the run report, the timing of every stage executed during run."""
+
+    if not REPORT:
+        return
+
+    LOGGER.info("Run report, %d stage(s):", len(REPORT))
+    for typeName, name, stage, seconds, size in REPORT:
+        LOGGER.info(
+            "Report: %s %s: %s (%d seconds, %s)",
+            typeName,
+            name,
+            stage,
+            seconds,
+            sizeUnit(size),
+        )
 
 
 #################################################################
@@ -282,6 +765,8 @@ def reportError():
 
     msgtext = f"Backup: {ERRORS[CONF_COUNT]} error(s), Msg1={ERRORS[CONF_MSG][0]}"
 
+    import telegram
+
     bot = telegram.Bot(config[CONF_CONFIG][CONF_TELEGRAM][CONF_TOKEN])
     bot.send_message(
         chat_id=config[CONF_CONFIG][CONF_TELEGRAM][CONF_CHAT_ID],
@@ -292,18 +777,162 @@ def reportError():
     )
 
 
+#################################################################
+def catalog():
+    """The catalog is a small sqlite database in the local backup directory.
+       It is opened once per run, the tables are created when needed."""
+    global CATALOG
+
+    if CATALOG is None:
+        name = config[CONF_CONFIG][CONF_CATALOG] or (
+            f"{config[CONF_CONFIG][CONF_DIR][CONF_LOCAL]}/catalog.db"
+        )
+        CATALOG = sqlite3.connect(name, check_same_thread=False, isolation_level=None)
+        for sql in CATALOG_SCHEMA:
+            CATALOG.execute(sql)
+
+    return CATALOG
+
+
+#################################################################
+def catalogExecute(sql, parameters=()):
+    """Execute a statement on the catalog, returns all rows (if any)."""
+
+    with CATALOG_LOCK:
+        return catalog().execute(sql, parameters).fetchall()
+
+
+#################################################################
+def journal(typeName, name, stage, host="", file_name="", done=True):
+    """Record a stage of an entry (per backup host for a transfer) in the
+       journal of the run, so a resume knows what is left to do."""
+
+    if JOURNAL_RUN is None:
+        return
+
+    catalogExecute(
+        "INSERT OR REPLACE INTO journal VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+        (
+            JOURNAL_RUN,
+            typeName,
+            name,
+            stage,
+            host,
+            file_name,
+            int(done),
+            datetime.datetime.now().isoformat(),
+        ),
+    )
+
+
+#################################################################
+def catalogVolumes(file_name):
+    """The volumes of the newest artifact with this name, see volumeList()."""
+
+    rows = catalogExecute(
+        "SELECT volume, offset, size, sha256 FROM volume WHERE file_name = ?"
+        " AND date = (SELECT MAX(date) FROM volume WHERE file_name = ?)"
+        " ORDER BY volume",
+        (file_name, file_name),
+    )
+    return [tuple(row) for row in rows]
+
+
+#################################################################
+def catalogClose():
+    """Close the catalog, at the end of the run."""
+    global CATALOG
+
+    if CATALOG is not None:
+        CATALOG.close()
+        CATALOG = None
+
+
+#################################################################
+def writeMetrics():
+    """Write the run report as Prometheus metrics, e.g. for the textfile
+       collector of the node exporter."""
+
+    name = config[CONF_CONFIG][CONF_METRICS]
+    if not name:
+        return
+
+    lines = [
+        "# TYPE backup_errors gauge",
+        f"backup_errors {ERRORS[CONF_COUNT]}",
+        "# TYPE backup_stage_seconds gauge",
+        "# TYPE backup_stage_bytes gauge",
+    ]
+    for typeName, entryName, stage, seconds, size in REPORT:
+        labels = f'type="{typeName}",name="{entryName}",stage="{stage}"'
+        lines.append(f"backup_stage_seconds{{{labels}}} {seconds}")
+        lines.append(f"backup_stage_bytes{{{labels}}} {size}")
+
+    lines.append("# TYPE backup_verify_restore_ok gauge")
+    for typeName, entryName, ok in VERIFIED:
+        labels = f'type="{typeName}",name="{entryName}"'
+        lines.append(f"backup_verify_restore_ok{{{labels}}} {int(ok)}")
+
+    # Write & rename, so a collector never reads a half written file
+    with open(f"{name}.tmp", "w") as fh:
+        fh.write("\n".join(lines) + "\n")
+    os.rename(f"{name}.tmp", name)
+
+    LOGGER.debug("Metrics written to '%s'", name)
+
+
+#################################################################
+def loadConfig(name):
+    """Read and validate the config file, errors are raised."""
+
+    with open(name, "r") as f:
+        config = yaml.safe_load(f)
+        return CONFIG_SCHEMA(config)
+
+
+#################################################################
+def checkConfig(config):
+    """The checks beyond the schema. Returns the error and the exit code of
+       the first one which fails, None if the config is fine."""
+
+    # Our local directories should exist
+    if config[CONF_CONFIG][CONF_APP] or config[CONF_CONFIG][CONF_DB]:
+        if not os.path.exists(config[CONF_CONFIG][CONF_DIR][CONF_DOCKER]):
+            errmsg = f"Directory ({CONF_DOCKER}): '{config[CONF_CONFIG][CONF_DIR][CONF_DOCKER]}' does not exist"
+            return errmsg, 1
+
+        if not os.path.exists(config[CONF_CONFIG][CONF_DIR][CONF_LOCAL]):
+            errmsg = f"Directory ({CONF_LOCAL}): '{config[CONF_CONFIG][CONF_DIR][CONF_LOCAL]}' does not exist"
+            return errmsg, 1
+
+    for transfer in config[CONF_CONFIG][CONF_TRANSFER]:
+        if transfer[CONF_TYPE] != CONF_SCP:
+            errmsg = f"Unknown transfer type '{transfer[CONF_TYPE]}'"
+            return errmsg, 2
+
+    # Encryption needs a X25519 public key, fail now and not in the first backup
+    encryption = config[CONF_CONFIG][CONF_ENCRYPTION]
+    if encryption[CONF_ENABLED]:
+        try:
+            public_key = base64.b64decode(encryption[CONF_PUBLIC_KEY], validate=True)
+        except ValueError:
+            public_key = b""
+        if len(public_key) != 32:
+            errmsg = f"Encryption enabled, but '{CONF_PUBLIC_KEY}' is not a base64 X25519 public key (32 bytes)"
+            return errmsg, 2
+
+    return None
+
+
 #################################################################
 def readConfig():
 
     config = None
 
-    location = os.path.realpath(os.path.join(os.getcwd(), os.path.dirname(__file__)))
-    name = f"{location}/{CONFIGNAME}"
+    name = CONFIGFILE
 
     try:
-        with open(name, "r") as f:
-            config = yaml.safe_load(f)
-            config = CONFIG_SCHEMA(config)
+        config = loadConfig(name)
     except Exception as e:
         errmsg = f"Exception={type(e).__name__} Msg={e}"
         ErrorMsg(errmsg)
@@ -328,26 +957,13 @@ def readConfig():
 
     LOGGER.info("Using config file '%s'", name)
 
-    # Do some backups checks, our local directories should exist
-    if config[CONF_CONFIG][CONF_APP] or config[CONF_CONFIG][CONF_DB]:
-        if not os.path.exists(config[CONF_CONFIG][CONF_DIR][CONF_DOCKER]):
-            errmsg = f"Directory ({CONF_DOCKER}): '{config[CONF_CONFIG][CONF_DIR][CONF_DOCKER]}' does not exist"
-            ErrorMsg(errmsg)
-            LOGGER.error(errmsg)
-            sys.exit(1)
-
-        if not os.path.exists(config[CONF_CONFIG][CONF_DIR][CONF_LOCAL]):
-            errmsg = f"Directory ({CONF_LOCAL}): '{config[CONF_CONFIG][CONF_DIR][CONF_LOCAL]}' does not exist"
-            ErrorMsg(errmsg)
-            LOGGER.error(errmsg)
-            sys.exit(1)
-
-    for transfer in config[CONF_CONFIG][CONF_TRANSFER]:
-        if transfer[CONF_TYPE] != CONF_SCP:
-            errmsg = "Unknown transfer type '{transfer[CONF_TYPE]}'"
-            ErrorMsg(errmsg)
-            LOGGER.error(errmsg)
-            sys.exit(2)
+    # Do some backups checks, the same as on a reload of the daemon
+    error = checkConfig(config)
+    if error:
+        errmsg, rc = error
+        ErrorMsg(errmsg)
+        LOGGER.error(errmsg)
+        sys.exit(rc)
 
     # LOGGER.debug("Config: %s", config)
     return config
@@ -383,6 +999,8 @@ def remoteSSH(client, cmd, remotehost=None, retrylast=True, retrycount=0):
 #################################################################
 def remoteSCP(client, lfile, rdir, remotehost=None, retrylast=True, retrycount=0):
 
+    import scp
+
     scpclient = scp.SCPClient(client.get_transport())
 
     try:
@@ -401,620 +1019,4344 @@ def remoteSCP(client, lfile, rdir, remotehost=None, retrylast=True, retrycount=0
 
 
 #################################################################
-def startDocker(typeName, name):
+def sshClient(transfer, slot=0):
+    """Return a connected SSH client for the transfer host. Clients are
+       pooled, so all transfers of a run share one session per host (per
+       slot, parallel uploads use a slot per worker)."""
 
-    LOGGER.debug("%s %s: Starting container", typeName, name)
-    rc = os.system(f"docker start {name} >/dev/null")
-    if rc != 0:
-        errmsg = f"{typeName} {name}: Failed to start container, RC={int(rc/256)}"
-        ErrorMsg(errmsg)
-        LOGGER.error(errmsg)
+    key = (transfer[CONF_HOST], transfer[CONF_PORT], transfer[CONF_USER], slot)
+
+    # Entries run concurrently (config workers), one connect per host
+    with SSH_LOCK:
+        return _sshClient(transfer, key)
 
 
 #################################################################
-def stopDocker(typeName, name):
+def _sshClient(transfer, key):
+
+    client = SSH_POOL.get(key)
+    if client is not None:
+        transport = client.get_transport()
+        if transport is not None and transport.is_active():
+            return client
+
+        # Session is gone, e.g. remote reboot. Connect again
+        sshDrop(transfer, key[3])
+
+    import paramiko
+
+    client = paramiko.SSHClient()
+    client.load_system_host_keys()
+    # client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+    client.connect(
+        transfer[CONF_HOST],
+        port=transfer[CONF_PORT],
+        username=transfer[CONF_USER],
+        auth_timeout=5,
+        timeout=10,
+    )
 
-    LOGGER.debug("%s %s: Stopping container", typeName, name)
-    rc = os.system(f"docker stop {name} >/dev/null")
-    if rc != 0:
-        errmsg = f"{typeName} {name}: Failed to stop container, RC={int(rc/256)}"
-        ErrorMsg(errmsg)
-        LOGGER.error(errmsg)
+    # The daemon keeps the session open between runs
+    client.get_transport().set_keepalive(60)
+
+    SSH_POOL[key] = client
+    return client
 
 
 #################################################################
-def doBackupWrapper(typeName, entry):
-    """A wrapper around docker stop/start, because a failure during
-       backup should never leave the container stopped."""
+def sshDrop(transfer, slot=None, client=None):
+    """Close and forget the pooled SSH client (of all slots without a
+       slot), used after a failure so a retry starts with a new session.
+       With the client which failed, only that one: the other slots are in
+       use by other entries, or it is replaced by a new session already."""
+
+    key = (transfer[CONF_HOST], transfer[CONF_PORT], transfer[CONF_USER])
+    with SSH_LOCK:
+        for pooled in list(SSH_POOL):
+            if pooled[:3] != key or slot not in [None, pooled[3]]:
+                continue
+            if client is not None and SSH_POOL[pooled] is not client:
+                continue
+            SSH_POOL.pop(pooled).close()
 
-    if entry[CONF_STOPDOCKER]:
-        stopDocker(typeName, entry[CONF_NAME])
 
-    try:
-        _doAppDb(typeName, entry)
-    except Exception as e:
-        errmsg = f"Failure do{typeName} {entry[CONF_NAME]}. Exception={type(e).__name__} Msg={e}"
-        ErrorMsg(errmsg)
-        LOGGER.error(
-            errmsg, exc_info=True,
-        )
+#################################################################
+def sshCloseAll():
+    """Close all pooled SSH clients, at the end of the run."""
 
-    if entry[CONF_STOPDOCKER]:
-        startDocker(typeName, entry[CONF_NAME])
+    for client in SSH_POOL.values():
+        client.close()
+    SSH_POOL.clear()
 
 
 #################################################################
-def _doAppDb(typeName, entry):
-    def excludeFromTar(tarinfo):
-        """If we exclude it, we return None, otherwise tarinfo."""
-        # LOGGER.debug("x: %s", tarinfo.name)
-        for pattern in entry[CONF_EXCLUDE] or []:
-            if fnmatch.fnmatch(tarinfo.name, pattern):
-                return None
-        # LOGGER.debug("y: %s", tarinfo.name)
-
-        return tarinfo
-
-    # If sourcedir is used, use that one
-    if entry[CONF_SOURCEDIR]:
-        # Check if it is an absolute one or not
-        if entry[CONF_SOURCEDIR].startswith("/"):
-            dir_input = entry[CONF_SOURCEDIR]
-        else:
-            dir_input = (
-                f"{config[CONF_CONFIG][CONF_DIR][CONF_DOCKER]}/{entry[CONF_SOURCEDIR]}"
-            )
-    else:
-        dir_input = f"{config[CONF_CONFIG][CONF_DIR][CONF_DOCKER]}/{entry[CONF_NAME]}"
+def findTransfer(host):
+    """Find the transfer configuration of a host, or use the defaults."""
 
-    # We can overrule the temporary directory, useful for NFS mounts
-    if config[CONF_CONFIG][CONF_DIR][CONF_TEMP]:
-        dir_temp = config[CONF_CONFIG][CONF_DIR][CONF_TEMP]
-    else:
-        dir_temp = f"{config[CONF_CONFIG][CONF_DIR][CONF_LOCAL]}/temp"
+    for transfer in config[CONF_CONFIG][CONF_TRANSFER]:
+        if transfer[CONF_HOST] == host:
+            return transfer
 
-    dir_output = (
-        f"{config[CONF_CONFIG][CONF_DIR][CONF_LOCAL]}/{typeName}/{entry[CONF_NAME]}"
-    )
-    dir_output_remote = (
-        f"{config[CONF_CONFIG][CONF_DIR][CONF_REMOTE]}/{typeName}/{entry[CONF_NAME]}"
-    )
+    return TRANSFER_SCHEMA({CONF_HOST: host})
 
-    # Generare output date & day-of-week
-    file_name = f"{entry[CONF_NAME]}.{datetime.datetime.today().strftime('%Y%m%d')}-{datetime.datetime.today().isoweekday()}"
 
-    # Configure name if no container is specified
-    if entry[CONF_CONTAINER] == "":
-        entry[CONF_CONTAINER] = entry[CONF_NAME]
+#################################################################
+class ProgressReader:
+    """Read-only file wrapper, shows the bytes and bytes/sec read so far."""
+
+    def __init__(self, fileobj, size=0):
+        self.fileobj = fileobj
+        self.size = size
+        self.count = 0
+        self.start = datetime.datetime.now()
+        self.last = self.start
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.count += len(data)
+
+        # Update the progress at most once per second, and at the end.
+        # Only on a terminal, not in cron output
+        now = datetime.datetime.now()
+        if not sys.stdout.isatty():
+            pass
+        elif (now - self.last).total_seconds() >= 1 or not data:
+            self.last = now
+            self.show(end="\n" if not data else "")
+
+        return data
+
+    def rate(self):
+        """Bytes per second so far."""
+        seconds = (datetime.datetime.now() - self.start).total_seconds()
+        return self.count / seconds if seconds > 0 else 0
+
+    def show(self, end=""):
+        total = f" of {sizeUnit(self.size)}" if self.size else ""
+        print(
+            f"\rINFO: {sizeUnit(self.count)}{total} ({sizeUnit(self.rate())}/s)   ",
+            end=end,
+            flush=True,
+        )
 
-    if typeName == CONF_APP:
-        file_name = f"{file_name}.tgz"
-    elif entry[CONF_TYPE] in [CONF_TYPE_MYSQL, CONF_TYPE_POSTGRESQL]:
-        # MySQL/PostgreSQL use same naming
-        file_name = f"{file_name}.sql.gz"
-    elif entry[CONF_TYPE] in [CONF_TYPE_INFLUXDB_EXPORT]:
-        # InfluxDB filename, but is the to-be-renamed filename
-        # The initial output filename is fixed in the container command
-        file_name = f"{file_name}.gz"
-    elif entry[CONF_TYPE] in [CONF_TYPE_INFLUXDB_BACKUP]:
-        # InfluxDB filename, but is the to-be-renamed filename
-        # The initial output filename is fixed in the container command
-        file_name = f"{file_name}.tgz"
 
-    # Check if local directory exists
-    if not os.path.exists(dir_input):
-        errmsg = (
-            f"{typeName} {entry[CONF_NAME]}: Directory '{dir_input}' does not exist"
+#################################################################
+def runKey():
+    """The data key of this run, and the file header part with the key
+       wrapped for the configured public key (X25519 + HKDF + AES-GCM)."""
+    global RUN_KEY
+
+    if RUN_KEY is None:
+        from cryptography.hazmat.primitives.asymmetric.x25519 import (
+            X25519PrivateKey,
+            X25519PublicKey,
         )
-        ErrorMsg(errmsg)
-        LOGGER.error(errmsg)
-        return
+        from cryptography.hazmat.primitives.ciphers.aead import AESGCM
 
-    if not os.path.exists(dir_temp):
-        os.makedirs(dir_temp)
-        LOGGER.debug(
-            "%s %s: Directory '%s' created", typeName, entry[CONF_NAME], dir_temp
+        public = X25519PublicKey.from_public_bytes(
+            base64.b64decode(config[CONF_CONFIG][CONF_ENCRYPTION][CONF_PUBLIC_KEY])
         )
+        ephemeral = X25519PrivateKey.generate()
+        ephemeral_public = ephemeral.public_key().public_bytes_raw()
 
-    # Create output directory structure if needed
-    if not os.path.exists(dir_output):
-        os.makedirs(dir_output)
-        LOGGER.debug(
-            "%s %s: Directory '%s' created", typeName, entry[CONF_NAME], dir_output
-        )
+        # The ephemeral key is new per run, so a fixed nonce is fine here
+        kek = hkdf(ephemeral.exchange(public), ENCRYPT_MAGIC + ephemeral_public)
+        key = os.urandom(32)
+        wrapped = AESGCM(kek).encrypt(bytes(12), key, ENCRYPT_MAGIC)
 
-    alreadymoved = False
+        RUN_KEY = (key, ephemeral_public + wrapped)
 
-    # Current time
-    now = datetime.datetime.now()
+    return RUN_KEY
 
-    # Create output file & compress file(s)
-    if typeName == CONF_APP:
-        # Go to the input directory, I make it relative
-        os.chdir(dir_input)
 
-        LOGGER.debug(
-            "%s %s: Creating '%s' from '%s'",
-            typeName,
-            entry[CONF_NAME],
-            file_name,
+#################################################################
+def unwrapKey(header):
+    """Unwrap the data key from the file header with our private key."""
+
+    from cryptography.hazmat.primitives.asymmetric.x25519 import (
+        X25519PrivateKey,
+        X25519PublicKey,
+    )
+    from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+    name = config[CONF_CONFIG][CONF_ENCRYPTION][CONF_PRIVATE_KEY]
+    if not name:
+        raise ValueError(f"Encrypted backup, but no '{CONF_PRIVATE_KEY}' configured")
+
+    with open(name, "r") as fh:
+        private = X25519PrivateKey.from_private_bytes(base64.b64decode(fh.read()))
+
+    ephemeral_public, wrapped = header[:32], header[32:80]
+    kek = hkdf(
+        private.exchange(X25519PublicKey.from_public_bytes(ephemeral_public)),
+        ENCRYPT_MAGIC + ephemeral_public,
+    )
+    return AESGCM(kek).decrypt(bytes(12), wrapped, ENCRYPT_MAGIC)
+
+
+#################################################################
+def hkdf(secret, info, salt=None):
+    """Derive a 256 bit key."""
+
+    from cryptography.hazmat.primitives import hashes
+    from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+
+    return HKDF(
+        algorithm=hashes.SHA256(), length=32, salt=salt, info=info
+    ).derive(secret)
+
+
+#################################################################
+def aead(cipher, key):
+    """The AEAD of the cipher, ChaCha20 is faster on a CPU without AES."""
+
+    from cryptography.hazmat.primitives.ciphers.aead import (
+        AESGCM,
+        ChaCha20Poly1305,
+    )
+
+    return ChaCha20Poly1305(key) if cipher == CONF_CHACHA20 else AESGCM(key)
+
+
+#################################################################
+class EncryptWriter:
+    """Write-only file wrapper, encrypts in chunks (streaming AEAD).
+
+    File: magic, cipher, wrapped run key, salt, then records of a 4 byte
+    length (high bit marks the last record) and the encrypted chunk. Every
+    file has its own key (HKDF of the run key and the salt), the nonce is the
+    record counter. The header and last-record flag are authenticated, so
+    a truncated or modified file is detected."""
+
+    def __init__(self, fileobj):
+        cipher = config[CONF_CONFIG][CONF_ENCRYPTION][CONF_CIPHER]
+        key, wrapped = runKey()
+        salt = os.urandom(16)
+
+        self.fileobj = fileobj
+        self.header = (
+            ENCRYPT_MAGIC + ENCRYPT_CIPHERS.index(cipher).to_bytes(1, "big") + wrapped + salt
+        )
+        self.aead = aead(cipher, hkdf(key, b"file", salt))
+        self.counter = 0
+        self.buffer = bytearray()
+
+        self.fileobj.write(self.header)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def write(self, data):
+        self.buffer += data
+        while len(self.buffer) >= ENCRYPT_CHUNK:
+            self._record(bytes(self.buffer[:ENCRYPT_CHUNK]), False)
+            del self.buffer[:ENCRYPT_CHUNK]
+        return len(data)
+
+    def _record(self, data, last):
+        nonce = self.counter.to_bytes(12, "big")
+        self.counter += 1
+
+        flag = b"\x01" if last else b"\x00"
+        data = self.aead.encrypt(nonce, data, self.header + flag)
+        length = len(data) | (0x80000000 if last else 0)
+        self.fileobj.write(length.to_bytes(4, "big") + data)
+
+    def flush(self):
+        self.fileobj.flush()
+
+    def close(self):
+        if self.fileobj is None:
+            return
+
+        # Always a last record, even empty, this marks the end of the file
+        self._record(bytes(self.buffer), True)
+        self.buffer = bytearray()
+        self.fileobj.close()
+        self.fileobj = None
+
+
+#################################################################
+class DecryptReader:
+    """Read-only file wrapper, decrypts a file of the EncryptWriter."""
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+
+        self.header = self._read(len(ENCRYPT_MAGIC) + 1 + 80 + 16)
+        if not self.header.startswith(ENCRYPT_MAGIC):
+            raise ValueError("File is not encrypted by backup.py")
+
+        offset = len(ENCRYPT_MAGIC)
+        cipher = ENCRYPT_CIPHERS[self.header[offset]]
+        key = unwrapKey(self.header[offset + 1 : offset + 81])
+        salt = self.header[offset + 81 :]
+
+        self.aead = aead(cipher, hkdf(key, b"file", salt))
+        self.counter = 0
+        self.buffer = b""
+        self.offset = 0
+        self.last = False
+
+    def _read(self, size):
+        """Read exactly size bytes, less only at the end of the stream."""
+        data = b""
+        while len(data) < size:
+            chunk = self.fileobj.read(size - len(data))
+            if not chunk:
+                break
+            data += chunk
+        return data
+
+    def _record(self):
+        length = self._read(4)
+        if len(length) != 4:
+            raise ValueError("Encrypted file is truncated")
+
+        length = int.from_bytes(length, "big")
+        self.last = bool(length & 0x80000000)
+        length &= 0x7FFFFFFF
+
+        data = self._read(length)
+        if len(data) != length:
+            raise ValueError("Encrypted file is truncated")
+
+        nonce = self.counter.to_bytes(12, "big")
+        self.counter += 1
+
+        flag = b"\x01" if self.last else b"\x00"
+        return self.aead.decrypt(nonce, data, self.header + flag)
+
+    def read(self, size=-1):
+        # Callers read in small blocks, so keep an offset in the chunk
+        # instead of copying the rest of the chunk on every read
+        while not self.last and (
+            size < 0 or len(self.buffer) - self.offset < size
+        ):
+            self.buffer = self.buffer[self.offset :] + self._record()
+            self.offset = 0
+
+        if size < 0:
+            size = len(self.buffer) - self.offset
+
+        data = self.buffer[self.offset : self.offset + size]
+        self.offset += len(data)
+        return data
+
+    def close(self):
+        self.fileobj.close()
+
+
+#################################################################
+def encrypting():
+    """Check if the encryption stage is enabled."""
+
+    return config[CONF_CONFIG][CONF_ENCRYPTION][CONF_ENABLED]
+
+
+#################################################################
+def openOutput(file_name):
+    """Open the output file, with the encryption stage if enabled."""
+
+    fh = open(file_name, "wb")
+    return EncryptWriter(fh) if encrypting() else fh
+
+
+#################################################################
+def openInput(file_name, reader):
+    """The (plain) stream of a backup file, decrypted if needed."""
+
+    return DecryptReader(reader) if file_name.endswith(ENCRYPT_SUFFIX) else reader
+
+
+#################################################################
+def startDocker(typeName, name):
+
+    LOGGER.debug("%s %s: Starting container", typeName, name)
+    rc = os.system(f"docker start {name} >/dev/null")
+    if rc != 0:
+        errmsg = f"{typeName} {name}: Failed to start container, RC={int(rc/256)}"
+        ErrorMsg(errmsg)
+        LOGGER.error(errmsg)
+
+
+#################################################################
+def stopDocker(typeName, name):
+
+    LOGGER.debug("%s %s: Stopping container", typeName, name)
+    rc = os.system(f"docker stop {name} >/dev/null")
+    if rc != 0:
+        errmsg = f"{typeName} {name}: Failed to stop container, RC={int(rc/256)}"
+        ErrorMsg(errmsg)
+        LOGGER.error(errmsg)
+
+
+#################################################################
+def pauseDocker(typeName, name):
+    """Freeze the processes of the container (cgroup freezer). Much faster
+       than a stop, the app keeps its state. Returns True if paused."""
+
+    import docker
+
+    LOGGER.debug("%s %s: Pausing container", typeName, name)
+    try:
+        client = docker.from_env()
+        client.containers.get(name).pause()
+        client.close()
+    except Exception as e:
+        errmsg = f"{typeName} {name}: Failed to pause container. Exception={type(e).__name__} Msg={e}"
+        ErrorMsg(errmsg)
+        LOGGER.error(errmsg)
+        return False
+
+    return True
+
+
+#################################################################
+def unpauseDocker(typeName, name):
+
+    import docker
+
+    LOGGER.debug("%s %s: Unpausing container", typeName, name)
+    try:
+        client = docker.from_env()
+        client.containers.get(name).unpause()
+        client.close()
+    except Exception as e:
+        errmsg = f"{typeName} {name}: Failed to unpause container. Exception={type(e).__name__} Msg={e}"
+        ErrorMsg(errmsg)
+        LOGGER.error(errmsg)
+
+
+#################################################################
+def quiesceContainer(typeName, entry):
+    """Stop or pause the container for a consistent backup. The stopdocker
+       option is the same as quiesce stop."""
+
+    mode = entry[CONF_QUIESCE]
+    if mode == CONF_NONE and entry[CONF_STOPDOCKER]:
+        mode = CONF_STOP
+
+    if mode == CONF_STOP:
+        stopDocker(typeName, entry[CONF_NAME])
+    elif mode == CONF_PAUSE:
+        if not pauseDocker(typeName, entry[CONF_NAME]):
+            return
+    else:
+        return
+
+    QUIESCED[(typeName, entry[CONF_NAME])] = (mode, time.monotonic())
+
+
+#################################################################
+def resumeContainer(typeName, entry):
+    """Start or unpause the container again (if we did stop or pause it),
+       the downtime goes in the run report."""
+
+    item = QUIESCED.pop((typeName, entry[CONF_NAME]), None)
+    if item is None:
+        return
+
+    mode, now = item
+    if mode == CONF_STOP:
+        startDocker(typeName, entry[CONF_NAME])
+    else:
+        unpauseDocker(typeName, entry[CONF_NAME])
+
+    diff = time.monotonic() - now
+    ReportTime(typeName, entry[CONF_NAME], f"downtime ({mode})", diff)
+    LOGGER.info(
+        "%s %s: Container %s for %.1f seconds",
+        typeName,
+        entry[CONF_NAME],
+        "stopped" if mode == CONF_STOP else "paused",
+        diff,
+    )
+
+
+#################################################################
+def cloneFile(src, dst):
+    """Copy the content of a file, a reflink (the blocks are shared until
+       written) if the filesystem can, e.g. btrfs and XFS."""
+
+    with open(src, "rb") as fin, open(dst, "wb") as fout:
+        try:
+            fcntl.ioctl(fout.fileno(), FICLONE, fin.fileno())
+        except OSError:
+            shutil.copyfileobj(fin, fout, ENCRYPT_CHUNK)
+
+
+#################################################################
+def snapshotTree(typeName, entry):
+    """Copy the tree, with the excludes applied, to a hidden directory next
+       to it (same filesystem, a reflink where possible). Owner, mode,
+       mtime and hardlinks are kept, so the archive and fingerprint of the
+       copy are the same. Returns the directory."""
+
+    dir_input = dirInput(entry)
+    dir_snapshot = os.path.join(
+        os.path.dirname(dir_input), f".{os.path.basename(dir_input)}.snapshot"
+    )
+
+    # Left behind by a failed run
+    shutil.rmtree(dir_snapshot, ignore_errors=True)
+
+    now = time.monotonic()
+    total = 0
+    links = {}
+    directories = [("", os.lstat(dir_input))]
+    todo = [""]
+
+    os.mkdir(dir_snapshot)
+    while todo:
+        relative = todo.pop()
+        directory = f"{dir_input}/{relative}" if relative else dir_input
+        with os.scandir(directory) as it:
+            items = list(it)
+
+        for item in items:
+            name = f"{relative}/{item.name}" if relative else item.name
+            if excluded(name, entry):
+                continue
+
+            src = item.path
+            dst = f"{dir_snapshot}/{name}"
+            statres = item.stat(follow_symlinks=False)
+
+            if stat.S_ISDIR(statres.st_mode):
+                os.mkdir(dst)
+                directories.append((name, statres))
+                todo.append(name)
+                continue
+
+            if stat.S_ISREG(statres.st_mode) and statres.st_nlink > 1:
+                key = (statres.st_dev, statres.st_ino)
+                if key in links:
+                    os.link(links[key], dst)
+                    continue
+                links[key] = dst
+
+            if stat.S_ISREG(statres.st_mode):
+                cloneFile(src, dst)
+                total += statres.st_size
+            elif stat.S_ISLNK(statres.st_mode):
+                os.symlink(os.readlink(src), dst)
+            elif stat.S_ISSOCK(statres.st_mode):
+                continue
+            else:
+                os.mknod(dst, statres.st_mode, statres.st_rdev)
+
+            os.lchown(dst, statres.st_uid, statres.st_gid)
+            if not stat.S_ISLNK(statres.st_mode):
+                os.chmod(dst, stat.S_IMODE(statres.st_mode))
+            os.utime(
+                dst,
+                ns=(statres.st_atime_ns, statres.st_mtime_ns),
+                follow_symlinks=False,
+            )
+
+    # Last, the files in a directory change its mtime
+    for name, statres in reversed(directories):
+        dst = f"{dir_snapshot}/{name}" if name else dir_snapshot
+        os.chown(dst, statres.st_uid, statres.st_gid)
+        os.chmod(dst, stat.S_IMODE(statres.st_mode))
+        os.utime(dst, ns=(statres.st_atime_ns, statres.st_mtime_ns))
+
+    diff = time.monotonic() - now
+    ReportTime(typeName, entry[CONF_NAME], "snapshot", diff, total)
+    LOGGER.debug(
+        "%s %s: Snapshot '%s' (%.1f seconds, %s)",
+        typeName,
+        entry[CONF_NAME],
+        dir_snapshot,
+        diff,
+        sizeUnit(total),
+    )
+
+    return dir_snapshot
+
+
+#################################################################
+def dirInput(entry):
+    """The directory of an entry, the sourcedir (absolute or relative to the
+       docker directory) or the name in the docker directory."""
+
+    # If sourcedir is used, use that one
+    if entry[CONF_SOURCEDIR]:
+        # Check if it is an absolute one or not
+        if entry[CONF_SOURCEDIR].startswith("/"):
+            return entry[CONF_SOURCEDIR]
+
+        return f"{config[CONF_CONFIG][CONF_DIR][CONF_DOCKER]}/{entry[CONF_SOURCEDIR]}"
+
+    return f"{config[CONF_CONFIG][CONF_DIR][CONF_DOCKER]}/{entry[CONF_NAME]}"
+
+
+#################################################################
+def dirTemp():
+    """The temporary directory."""
+
+    # We can overrule the temporary directory, useful for NFS mounts
+    if config[CONF_CONFIG][CONF_DIR][CONF_TEMP]:
+        return config[CONF_CONFIG][CONF_DIR][CONF_TEMP]
+
+    return f"{config[CONF_CONFIG][CONF_DIR][CONF_LOCAL]}/temp"
+
+
+#################################################################
+def tempName(file_name):
+    """Temporary (hidden) name next to the final name, see publishFile()."""
+
+    return f"{os.path.dirname(file_name)}/.{os.path.basename(file_name)}.tmp"
+
+
+#################################################################
+def syncFile(file_name):
+    """Flush the file to disk, if the fsync policy asks for it."""
+
+    if config[CONF_CONFIG][CONF_FSYNC] in [CONF_FILE, CONF_FULL]:
+        fd = os.open(file_name, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+
+#################################################################
+def syncDir(directory):
+    """Flush the directory (the rename) to disk, if the fsync policy asks for it."""
+
+    if config[CONF_CONFIG][CONF_FSYNC] == CONF_FULL:
+        fd = os.open(directory, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+
+#################################################################
+def publishFile(src, dst, encrypt=False):
+    """Give the file its final name with a rename, so the final name is only
+       ever complete. Only if the source is on another filesystem (explicit
+       temp directory, InfluxDB backup directory) or still needs to be
+       encrypted, it is copied first, to a temporary name next to the final
+       name."""
+
+    directory = os.path.dirname(dst)
+
+    if not encrypt and os.stat(src).st_dev == os.stat(directory).st_dev:
+        syncFile(src)
+        os.rename(src, dst)
+    else:
+        tmp = tempName(dst)
+        try:
+            if encrypt:
+                with open(src, "rb") as fin, openOutput(tmp) as fout:
+                    shutil.copyfileobj(fin, fout, ENCRYPT_CHUNK)
+            else:
+                shutil.copyfile(src, tmp)
+            syncFile(tmp)
+            os.rename(tmp, dst)
+        except Exception:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+        os.remove(src)
+
+    syncDir(directory)
+
+
+#################################################################
+class Throttle:
+    """Cap the throughput (MByte/s) of an entry, 0 is no cap. After a slow
+       period (e.g. compressing) there is no burst of more than a second."""
+
+    def __init__(self, rate):
+        self.rate = rate * 1024 * 1024
+        self.start = time.monotonic()
+        self.count = 0
+
+    def consume(self, size):
+        if not self.rate:
+            return
+
+        self.count += size
+        delay = self.count / self.rate - (time.monotonic() - self.start)
+        if delay > 0:
+            time.sleep(delay)
+        elif delay < -1:
+            self.start = time.monotonic()
+            self.count = 0
+
+
+#################################################################
+class InputReader:
+    """Read-only file wrapper for the archive, with the throttle and the
+       pacer. With fadvise the file is dropped from the page cache when
+       closed, so a backup does not push the data of the live services out
+       of it."""
+
+    def __init__(self, fileobj, throttle, fadvise=False, pacer=None):
+        self.fileobj = fileobj
+        self.throttle = throttle
+        self.fadvise = fadvise
+        self.pacer = pacer
+
+        if fadvise:
+            os.posix_fadvise(fileobj.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.throttle.consume(len(data))
+        if self.pacer is not None:
+            self.pacer.check(len(data))
+        return data
+
+    def close(self):
+        if self.fadvise:
+            os.posix_fadvise(self.fileobj.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+        self.fileobj.close()
+
+
+#################################################################
+@contextlib.contextmanager
+def lowPriority(typeName, entry):
+    """Lower the CPU (nice) and I/O (ionice) priority of this thread during
+       the archive/dump. Child processes on this host (the docker client,
+       gzip) inherit it, a docker exec runs under dockerd: containerPriority()."""
+
+    throttle = entry[CONF_THROTTLE]
+    tid = threading.get_native_id()
+    nice = os.getpriority(os.PRIO_PROCESS, tid)
+
+    if throttle[CONF_NICE] > nice:
+        os.setpriority(os.PRIO_PROCESS, tid, throttle[CONF_NICE])
+
+    if throttle[CONF_IONICE] != CONF_NONE:
+        ioniceThread(typeName, entry, tid, throttle[CONF_IONICE])
+
+    try:
+        yield
+    finally:
+        if throttle[CONF_IONICE] != CONF_NONE:
+            ioniceThread(typeName, entry, tid, CONF_NONE)
+
+        # Only root can lower it again, but we run as root
+        if throttle[CONF_NICE] > nice:
+            os.setpriority(os.PRIO_PROCESS, tid, nice)
+
+
+#################################################################
+def containerPriority(entry):
+    """The shell commands which lower the priority of a dump in the
+       container, the throttle of the entry as lowPriority() uses it."""
+
+    throttle = entry[CONF_THROTTLE]
+    priority = ""
+
+    if throttle[CONF_NICE] > 0:
+        priority += DB_NICE.format(nice=throttle[CONF_NICE])
+
+    if throttle[CONF_IONICE] != CONF_NONE:
+        priority += DB_IONICE.format(args=" ".join(IONICE_ARGS[throttle[CONF_IONICE]]))
+
+    return priority
+
+
+#################################################################
+def ioniceThread(typeName, entry, tid, ionice):
+    """Set the I/O scheduling class of a thread (Linux, needs ionice)."""
+
+    try:
+        subprocess.run(
+            ["ionice"] + IONICE_ARGS[ionice] + ["-p", str(tid)],
+            check=True,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+    except Exception as e:
+        LOGGER.warning(
+            "%s %s: Cannot set ionice '%s'. Exception=%s Msg=%s",
+            typeName,
+            entry[CONF_NAME],
+            ionice,
+            type(e).__name__,
+            e,
+        )
+
+
+#################################################################
+class GzipWriter:
+    """Write-only gzip stream, a file can be stored without compression.
+
+    Two raw deflate compressors share one gzip member: the configured level
+    and level 0. At every switch the active one is flushed with Z_FULL_FLUSH,
+    which ends on a byte boundary and resets its history, so the blocks of
+    both form one valid deflate stream. Any gzip reader can read it, also
+    the stream mode of tarfile."""
+
+    def __init__(self, fileobj, level=9):
+        self.fileobj = fileobj
+        self.compress = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+        self.store = zlib.compressobj(0, zlib.DEFLATED, -zlib.MAX_WBITS)
+        self.active = self.compress
+        self.crc = 0
+        self.size = 0
+
+        # Header: magic, deflate, no flags, no mtime, no extra flags, unix
+        self.fileobj.write(b"\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\x03")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def stored(self, store):
+        """Switch between the stored and the compressed mode."""
+        active = self.store if store else self.compress
+        if active is not self.active:
+            self.fileobj.write(self.active.flush(zlib.Z_FULL_FLUSH))
+            self.active = active
+
+    def setLevel(self, level):
+        """Continue with another compression level, same as stored()."""
+        compress = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+        if self.active is self.compress:
+            self.fileobj.write(self.active.flush(zlib.Z_FULL_FLUSH))
+            self.active = compress
+        self.compress = compress
+
+    def write(self, data):
+        self.crc = zlib.crc32(data, self.crc)
+        self.size += len(data)
+        self.fileobj.write(self.active.compress(data))
+        return len(data)
+
+    def close(self):
+        if self.fileobj is None:
+            return
+
+        self.fileobj.write(self.active.flush(zlib.Z_FINISH))
+        self.fileobj.write(self.crc.to_bytes(4, "little"))
+        self.fileobj.write((self.size & 0xFFFFFFFF).to_bytes(4, "little"))
+        self.fileobj = None
+
+
+#################################################################
+class ZstdWriter:
+    """Write-only zstd stream, with the (trained) dictionary of the entry.
+       The id of the dictionary is in the frame header. The start of the
+       data is kept as a sample, to train the next dictionary."""
+
+    def __init__(self, fileobj, dictionary=None, level=ZSTD_LEVEL):
+        import zstandard
+
+        self.writer = zstandard.ZstdCompressor(
+            level=level, dict_data=dictionary, write_checksum=True
+        ).stream_writer(fileobj, closefd=False)
+        self.sample = bytearray()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def write(self, data):
+        if len(self.sample) < ZSTD_SAMPLE:
+            self.sample += data[: ZSTD_SAMPLE - len(self.sample)]
+        self.writer.write(data)
+        return len(data)
+
+    def close(self):
+        if self.writer is None:
+            return
+
+        # Ends the frame, the output file stays open
+        self.writer.close()
+        self.writer = None
+
+
+#################################################################
+def zstdEnabled(typeName, entry):
+    """The zstd codec, only for the dumps we compress ourselves."""
+
+    if entry[CONF_CODEC] != CONF_ZSTD:
+        return False
+
+    return typeName != CONF_DB or entry[CONF_TYPE] in [
+        CONF_TYPE_MYSQL,
+        CONF_TYPE_POSTGRESQL,
+    ]
+
+
+#################################################################
+def zstdDictionary(typeName, entry):
+    """The newest dictionary of the entry, None if it has none (yet)."""
+
+    import zstandard
+
+    rows = catalogExecute(
+        "SELECT data FROM dictionary WHERE type = ? AND name = ?"
+        " ORDER BY version DESC LIMIT 1",
+        (typeName, entry[CONF_NAME]),
+    )
+    return zstandard.ZstdCompressionDict(rows[0][0]) if rows else None
+
+
+#################################################################
+def zstdTrain(typeName, entry, sample):
+    """Keep the sample of this run, and train a new version of the
+       dictionary from the samples of the last runs if it is due."""
+
+    import zstandard
+
+    now = datetime.datetime.now()
+
+    catalogExecute(
+        "INSERT INTO sample VALUES (?, ?, ?, ?)",
+        (now.isoformat(), typeName, entry[CONF_NAME], bytes(sample)),
+    )
+    rows = catalogExecute(
+        "SELECT date, data FROM sample WHERE type = ? AND name = ?"
+        " ORDER BY date DESC",
+        (typeName, entry[CONF_NAME]),
+    )
+    if len(rows) > ZSTD_RUNS:
+        catalogExecute(
+            "DELETE FROM sample WHERE type = ? AND name = ? AND date < ?",
+            (typeName, entry[CONF_NAME], rows[ZSTD_RUNS - 1][0]),
+        )
+        rows = rows[:ZSTD_RUNS]
+
+    last = catalogExecute(
+        "SELECT version, date, runs FROM dictionary WHERE type = ? AND name = ?"
+        " ORDER BY version DESC LIMIT 1",
+        (typeName, entry[CONF_NAME]),
+    )
+    if (
+        last
+        and last[0][2] >= len(rows)
+        and last[0][1] > (now - datetime.timedelta(days=ZSTD_RETRAIN)).isoformat()
+    ):
+        return
+
+    chunks = [
+        data[offset : offset + ZSTD_CHUNK]
+        for date, data in rows
+        for offset in range(0, len(data), ZSTD_CHUNK)
+    ]
+    try:
+        dictionary = zstandard.train_dictionary(ZSTD_DICT_SIZE, chunks)
+    except zstandard.ZstdError as e:
+        # E.g. too little data to train from, next run we have more
+        LOGGER.debug(
+            "%s %s: No dictionary trained, Msg=%s", typeName, entry[CONF_NAME], e
+        )
+        return
+
+    version = last[0][0] + 1 if last else 1
+    catalogExecute(
+        "INSERT INTO dictionary VALUES (?, ?, ?, ?, ?, ?, ?)",
+        (
+            now.isoformat(),
+            typeName,
+            entry[CONF_NAME],
+            version,
+            dictionary.dict_id(),
+            len(rows),
+            dictionary.as_bytes(),
+        ),
+    )
+    LOGGER.info(
+        "%s %s: Trained dictionary version %d (id %d) from %d run(s), used from the next run",
+        typeName,
+        entry[CONF_NAME],
+        version,
+        dictionary.dict_id(),
+        len(rows),
+    )
+
+    # Next to the artifacts, the transfer sends it to the backup hosts
+    file_name = dictionaryName(
+        f"{config[CONF_CONFIG][CONF_DIR][CONF_LOCAL]}/{typeName}/{entry[CONF_NAME]}",
+        entry[CONF_NAME],
+        dictionary.dict_id(),
+    )
+    if encrypting():
+        file_name = f"{file_name}{ENCRYPT_SUFFIX}"
+
+    with openOutput(tempName(file_name)) as output:
+        output.write(dictionary.as_bytes())
+    syncFile(tempName(file_name))
+    os.rename(tempName(file_name), file_name)
+
+
+#################################################################
+def dictionaryName(directory, name, dict_id):
+    """The file of a dictionary, without the encryption suffix."""
+
+    return f"{directory}/{name}.dict.{dict_id}"
+
+
+#################################################################
+def sendDictionaries(typeName, entry, client, dir_remote, remotehost, retrycount):
+    """Send the dictionaries of the entry which the backup host does not
+       have (complete) yet, before the artifacts which need them. Returns
+       False if one failed."""
+
+    dir_output = (
+        f"{config[CONF_CONFIG][CONF_DIR][CONF_LOCAL]}/{typeName}/{entry[CONF_NAME]}"
+    )
+    names = [
+        name
+        for name in sorted(glob.glob(f"{dir_output}/{entry[CONF_NAME]}.dict.*"))
+        if re.search(DICT_PATTERN, name)
+    ]
+    if not names:
+        return True
+
+    rc, stdout = remoteSSH(
+        client,
+        f"stat -c '%s %n' {dir_remote}/{entry[CONF_NAME]}.dict.* 2>/dev/null; true",
+        remotehost=remotehost,
+        retrylast=False,
+        retrycount=retrycount,
+    )
+    if not rc:
+        return False
+
+    sizes = {}
+    for line in stdout:
+        size, name = line.strip().split(" ", 1)
+        sizes[os.path.basename(name)] = int(size)
+
+    for name in names:
+        if sizes.get(os.path.basename(name)) == os.stat(name).st_size:
+            continue
+
+        if not remoteSCP(
+            client,
+            name,
+            dir_remote,
+            remotehost=remotehost,
+            retrylast=False,
+            retrycount=retrycount,
+        ):
+            return False
+
+        LOGGER.debug(
+            "%s %s: Dictionary '%s' to '%s' OK",
+            typeName,
+            entry[CONF_NAME],
+            os.path.basename(name),
+            remotehost,
+        )
+
+    return True
+
+
+#################################################################
+def readDictionary(file_name, dict_id, client=None):
+    """The dictionary as sent with the artifacts, next to the backup file
+       (local, or on the backup host of the client). None if not found."""
+
+    name = re.sub(r"\.\d{8}-\d\..*$", "", os.path.basename(file_name))
+    base = dictionaryName(os.path.dirname(file_name), name, dict_id)
+
+    # Shards, any of their hosts has it
+    if isinstance(client, list):
+        client = sshClient(client[0][0])
+
+    for name in [f"{base}{ENCRYPT_SUFFIX}", base]:
+        if client is None:
+            if not os.path.isfile(name):
+                continue
+            with open(name, "rb") as fh:
+                data = fh.read()
+        else:
+            stdin, stdout, stderr = client.exec_command(f"cat {name}")
+            data = stdout.read()
+            if stdout.channel.recv_exit_status() != 0:
+                continue
+
+        LOGGER.debug("Dictionary %d from '%s'", dict_id, name)
+        return openInput(name, io.BytesIO(data)).read()
+
+    return None
+
+
+#################################################################
+class ZstdReader:
+    """Read-only zstd stream. The dictionary is looked up in the catalog, by
+       the id in the frame header, else next to the backup file (e.g. the
+       catalog is lost with the host). A truncated stream raises EOFError."""
+
+    def __init__(self, fileobj, file_name, client=None):
+        import zstandard
+
+        self.fileobj = fileobj
+        self.pending = readExact(fileobj, ZSTD_HEADER)
+        dict_id = zstandard.get_frame_parameters(self.pending).dict_id
+
+        dictionary = None
+        if dict_id:
+            rows = catalogExecute(
+                "SELECT data FROM dictionary WHERE dict_id = ?", (dict_id,)
+            )
+            data = rows[0][0] if rows else readDictionary(file_name, dict_id, client)
+            if data is None:
+                raise ValueError(f"Dictionary {dict_id} of '{file_name}' not found")
+            dictionary = zstandard.ZstdCompressionDict(data)
+
+        self.decompress = zstandard.ZstdDecompressor(
+            dict_data=dictionary
+        ).decompressobj()
+        self.buffer = b""
+        self.offset = 0
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buffer) - self.offset < size:
+            if self.decompress.eof:
+                break
+
+            data = self.pending or self.fileobj.read(RESTORE_CHUNK)
+            self.pending = b""
+            if not data:
+                raise EOFError("Compressed file ended before the end of the frame")
+
+            self.buffer = self.buffer[self.offset :] + self.decompress.decompress(data)
+            self.offset = 0
+
+        end = len(self.buffer) if size < 0 else self.offset + size
+        data = self.buffer[self.offset : end]
+        self.offset += len(data)
+        return data
+
+
+#################################################################
+def openDecompressed(file_name, stream, client=None):
+    """The plain stream of a (decrypted) backup file, zstd or gzip."""
+
+    if file_name.removesuffix(ENCRYPT_SUFFIX).endswith(ZSTD_SUFFIX):
+        return ZstdReader(stream, file_name, client)
+
+    # All other dumps are gzip (multi-member safe)
+    return gzip.GzipFile(fileobj=stream, mode="rb")
+
+
+#################################################################
+class TarWriter:
+    """Write-only tar stream, the same output as TarFile in "w|" mode, but
+       nothing is kept per member. TarFile keeps every TarInfo (members)
+       and every inode, so its memory grows with the number of files. We
+       only keep the inodes of files with more than one link, for the
+       hardlinks, and the names of the uids/gids."""
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.offset = 0
+        self.inodes = {}
+        self.unames = {}
+        self.gnames = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def gettarinfo(self, path, arcname, statres=None):
+        """The TarInfo of the path, same as TarFile.gettarinfo(). The lstat()
+           can be done already, e.g. by the read-ahead."""
+
+        if statres is None:
+            statres = os.lstat(path)
+        mode = statres.st_mode
+        linkname = ""
+
+        if stat.S_ISREG(mode):
+            inode = (statres.st_ino, statres.st_dev)
+            if statres.st_nlink > 1 and self.inodes.get(inode, arcname) != arcname:
+                type = tarfile.LNKTYPE
+                linkname = self.inodes[inode]
+            else:
+                type = tarfile.REGTYPE
+                if statres.st_nlink > 1:
+                    self.inodes[inode] = arcname
+        elif stat.S_ISDIR(mode):
+            type = tarfile.DIRTYPE
+        elif stat.S_ISFIFO(mode):
+            type = tarfile.FIFOTYPE
+        elif stat.S_ISLNK(mode):
+            type = tarfile.SYMTYPE
+            linkname = os.readlink(path)
+        elif stat.S_ISCHR(mode):
+            type = tarfile.CHRTYPE
+        elif stat.S_ISBLK(mode):
+            type = tarfile.BLKTYPE
+        else:
+            return None
+
+        tarinfo = tarfile.TarInfo(arcname.replace(os.sep, "/").lstrip("/"))
+        tarinfo.mode = mode
+        tarinfo.uid = statres.st_uid
+        tarinfo.gid = statres.st_gid
+        tarinfo.size = statres.st_size if type == tarfile.REGTYPE else 0
+        tarinfo.mtime = statres.st_mtime
+        tarinfo.type = type
+        tarinfo.linkname = linkname
+        tarinfo.uname = self._name(self.unames, pwd.getpwuid, tarinfo.uid)
+        tarinfo.gname = self._name(self.gnames, grp.getgrgid, tarinfo.gid)
+
+        if type in (tarfile.CHRTYPE, tarfile.BLKTYPE):
+            tarinfo.devmajor = os.major(statres.st_rdev)
+            tarinfo.devminor = os.minor(statres.st_rdev)
+
+        return tarinfo
+
+    def _name(self, names, lookup, id):
+        if id not in names:
+            try:
+                names[id] = lookup(id)[0]
+            except KeyError:
+                names[id] = ""
+        return names[id]
+
+    def addfile(self, tarinfo, fileobj=None):
+        """Write the header, and the data of a regular file."""
+
+        buf = tarinfo.tobuf(tarfile.DEFAULT_FORMAT, tarfile.ENCODING, "surrogateescape")
+        self.fileobj.write(buf)
+        self.offset += len(buf)
+
+        if fileobj is None:
+            return
+
+        # Exactly the size of the header, a file can change while we read it
+        size = tarinfo.size
+        while size > 0:
+            data = fileobj.read(min(size, RESTORE_CHUNK))
+            if not data:
+                raise OSError(f"unexpected end of data, '{tarinfo.name}' shrunk")
+            self.fileobj.write(data)
+            size -= len(data)
+
+        remainder = tarinfo.size % tarfile.BLOCKSIZE
+        if remainder:
+            self.fileobj.write(tarfile.NUL * (tarfile.BLOCKSIZE - remainder))
+        self.offset += -(-tarinfo.size // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+
+    def close(self):
+        if self.fileobj is None:
+            return
+
+        # End of archive, and fill up the last record
+        self.fileobj.write(tarfile.NUL * (tarfile.BLOCKSIZE * 2))
+        self.offset += tarfile.BLOCKSIZE * 2
+        remainder = self.offset % tarfile.RECORDSIZE
+        if remainder:
+            self.fileobj.write(tarfile.NUL * (tarfile.RECORDSIZE - remainder))
+        self.fileobj = None
+
+
+#################################################################
+def incompressible(path, size):
+    """Check if a file is compressed already, by the extension or for a
+       big file by how well a sample of it compresses."""
+
+    if os.path.splitext(path)[1].lower() in STORE_EXTENSIONS:
+        return True
+
+    # Small files are not worth a switch of the compressor
+    if size < 4 * STORE_SAMPLE:
+        return False
+
+    # Sample from the middle, the start is often a (compressible) header
+    with open(path, "rb") as fh:
+        fh.seek(size // 2)
+        sample = fh.read(STORE_SAMPLE)
+
+    return len(zlib.compress(sample, 1)) > STORE_RATIO * len(sample)
+
+
+#################################################################
+def archiveTree(
+    archive, dir_input, entry, filter, output=None, pacer=None, prefetch=0
+):
+    """Add the tree to the archive (TarWriter or TarFile), the same as
+       TarFile.add(), but with absolute paths (no chdir) and every file read
+       by the InputReader.
+       With a GzipWriter as output, compressed files are stored as-is. The
+       pacer is told the progress while reading.
+       With prefetch threads, the lstat() and read of the small files ahead
+       is done in parallel. The writer still gets them in walk order, so the
+       archive is the same."""
+
+    throttle = Throttle(entry[CONF_THROTTLE][CONF_RATE])
+    fadvise = entry[CONF_THROTTLE][CONF_FADVISE]
+
+    def walk(path, arcname):
+        """The members in archive order, as (path, arcname, tarinfo). Only
+           a directory has a tarinfo, we need it to know if we go into it."""
+        for item in sorted(os.scandir(path), key=lambda x: x.name):
+            name = os.path.join(arcname, item.name) if arcname else item.name
+
+            if item.is_dir(follow_symlinks=False):
+                tarinfo = filter(archive.gettarinfo(item.path, name))
+                if tarinfo is not None:
+                    yield item.path, name, tarinfo
+                    yield from walk(item.path, name)
+            else:
+                yield item.path, name, None
+
+    def fetch(path):
+        """The lstat() and the content of a small file, in the pool."""
+        statres = os.lstat(path)
+        if not stat.S_ISREG(statres.st_mode) or statres.st_size > PREFETCH_SIZE:
+            return statres, None
+
+        with open(path, "rb") as fh:
+            data = fh.read(statres.st_size)
+            if fadvise:
+                os.posix_fadvise(fh.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+
+        return statres, data
+
+    def members():
+        """The members in archive order, with (statres, data) if fetched."""
+        if not prefetch:
+            for path, arcname, tarinfo in walk(dir_input, ""):
+                yield path, arcname, tarinfo, None, None
+            return
+
+        def oldest():
+            path, arcname, tarinfo, future = pending.popleft()
+            result = future.result() if future else (None, None)
+            return (path, arcname, tarinfo) + result
+
+        # Bounded, the oldest one goes to the writer first
+        pending = collections.deque()
+        with concurrent.futures.ThreadPoolExecutor(prefetch) as pool:
+            for path, arcname, tarinfo in walk(dir_input, ""):
+                future = pool.submit(fetch, path) if tarinfo is None else None
+                pending.append((path, arcname, tarinfo, future))
+                if len(pending) >= PREFETCH_FILES:
+                    yield oldest()
+
+            while pending:
+                yield oldest()
+
+    # Add ".", to preserve parent directory right/permissions
+    archive.addfile(archive.gettarinfo(dir_input, "."))
+
+    for path, arcname, tarinfo, statres, data in members():
+        # A directory, the walk did the filter already
+        if tarinfo is not None:
+            if output is not None:
+                output.stored(False)
+
+            archive.addfile(tarinfo)
+            continue
+
+        if statres is not None:
+            tarinfo = archive.gettarinfo(path, arcname, statres)
+        else:
+            tarinfo = archive.gettarinfo(path, arcname)
+
+        # Sockets etc. can not be archived
+        if tarinfo is None:
+            continue
+
+        tarinfo = filter(tarinfo)
+        if tarinfo is None:
+            continue
+
+        if tarinfo.isreg():
+            if output is not None:
+                output.stored(incompressible(path, tarinfo.size))
+
+            if data is not None:
+                archive.addfile(
+                    tarinfo, InputReader(io.BytesIO(data), throttle, False, pacer)
+                )
+                continue
+
+            with open(path, "rb") as fh:
+                reader = InputReader(fh, throttle, fadvise, pacer)
+                try:
+                    archive.addfile(tarinfo, reader)
+                finally:
+                    reader.close()
+        else:
+            archive.addfile(tarinfo)
+
+
+#################################################################
+def linkFile(src, dst):
+    """Publish dst as a hardlink of src, replacing an older dst."""
+
+    if os.path.exists(dst) and os.path.samefile(src, dst):
+        return
+
+    tmp = tempName(dst)
+    if os.path.exists(tmp):
+        os.remove(tmp)
+    os.link(src, tmp)
+    os.rename(tmp, dst)
+    syncDir(os.path.dirname(dst))
+
+
+#################################################################
+def linkRemote(client, src, dst, remotehost):
+    """Hardlink dst to src on the backup host. False if src is not there
+       (e.g. a new host), then it needs a normal transfer."""
+
+    cmd = f"test -f {src} && {{ [ {src} -ef {dst} ] || ln -f {src} {dst}; }} && echo linked; true"
+    rc, stdout = remoteSSH(client, cmd, remotehost=remotehost, retrylast=False)
+    return rc and any(line.strip() == "linked" for line in stdout)
+
+
+#################################################################
+def volumeName(file_name, index):
+    """Name of a volume of the artifact."""
+    return f"{file_name}.v{index:03d}"
+
+
+#################################################################
+def volumeList(typeName, entry, file_name, now):
+    """Split the artifact in volumes of the configured size, if it is
+       bigger. Returns [(index, offset, size, sha256)], which the catalog
+       keeps to put the volumes together again. Empty means no volumes.
+       The sha256 of the whole file goes to the catalog too, for scrub."""
+
+    volume_size = config[CONF_CONFIG][CONF_VOLUME][CONF_SIZE] * 1024 * 1024
+    size = os.stat(file_name).st_size
+    split = volume_size and size > volume_size
+
+    # Not split, it is read as one volume for the sha256
+    if not split:
+        volume_size = max(size, 1)
+
+    total = hashlib.sha256()
+    volumes = []
+    with open(file_name, "rb") as fh:
+        for offset in range(0, size, volume_size):
+            sha256 = hashlib.sha256()
+            left = min(volume_size, size - offset)
+            while left > 0:
+                data = fh.read(min(RESTORE_CHUNK, left))
+                if not data:
+                    raise EOFError(f"'{file_name}' is shorter than {size} bytes")
+                sha256.update(data)
+                total.update(data)
+                left -= len(data)
+
+            volume = (len(volumes), offset, min(volume_size, size - offset))
+            volumes.append(volume + (sha256.hexdigest(),))
+
+    catalogExecute(
+        "INSERT INTO checksum VALUES (?, ?, ?, ?, ?)",
+        (now.isoformat(), typeName, entry[CONF_NAME], file_name, total.hexdigest()),
+    )
+
+    if not split:
+        return []
+
+    for volume in volumes:
+        catalogExecute(
+            "INSERT INTO volume VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (now.isoformat(), typeName, entry[CONF_NAME], file_name) + volume,
+        )
+
+    LOGGER.debug(
+        "%s %s: '%s' is %d volumes of %s",
+        typeName,
+        entry[CONF_NAME],
+        file_name,
+        len(volumes),
+        sizeUnit(volume_size),
+    )
+    return volumes
+
+
+#################################################################
+class VolumeReader:
+    """Read-only view of one volume of the artifact, for scp putfo()."""
+
+    def __init__(self, fileobj, offset, size):
+        self.fileobj = fileobj
+        self.size = size
+        self.position = 0
+        self.fileobj.seek(offset)
+
+    def read(self, size=-1):
+        left = self.size - self.position
+        data = self.fileobj.read(left if size < 0 else min(size, left))
+        self.position += len(data)
+        return data
+
+    def tell(self):
+        return self.position
+
+
+#################################################################
+def missingVolumes(client, dir_remote, file_name, volumes, remotehost):
+    """The volumes not on the backup host, or with another sha256 (e.g. a
+       transfer which broke off). None if the host cannot be checked."""
+
+    names = " ".join(volumeName(file_name, index) for index, *rest in volumes)
+    cmd = f"cd {dir_remote} && {{ sha256sum {names} 2>/dev/null; true; }}"
+    rc, stdout = remoteSSH(client, cmd, remotehost=remotehost, retrylast=False)
+    if not rc:
+        return None
+
+    remote = {}
+    for line in stdout:
+        fields = line.split()
+        if len(fields) == 2:
+            remote[fields[1]] = fields[0]
+
+    return [
+        volume
+        for volume in volumes
+        if remote.get(volumeName(file_name, volume[0])) != volume[3]
+    ]
+
+
+#################################################################
+def sendVolumes(
+    typeName, entry, transfer, file_name, dir_remote, volumes, retrylast, retrycount
+):
+    """Transfer the volumes which are missing on the backup host, in
+       parallel, with a pooled SSH session per worker. Volumes which are
+       there already (e.g. of a failed run) are not sent again. Returns
+       the bytes sent, or None if volumes are still missing."""
+
+    import scp
+
+    remotehost = transfer[CONF_HOST]
+    workers = config[CONF_CONFIG][CONF_VOLUME][CONF_WORKERS]
+    name = os.path.basename(file_name)
+
+    todo = missingVolumes(sshClient(transfer), dir_remote, name, volumes, remotehost)
+    if todo is None:
+        return None
+
+    LOGGER.debug(
+        "%s %s: %d of %d volumes to '%s'",
+        typeName,
+        entry[CONF_NAME],
+        len(todo),
+        len(volumes),
+        remotehost,
+    )
+
+    # A free slot (SSH session) per worker
+    slots = collections.deque(range(1, workers + 1))
+    lock = threading.Lock()
+
+    def send(volume):
+        index, offset, size, sha256 = volume
+        with lock:
+            slot = slots.popleft()
+
+        client = None
+        try:
+            client = sshClient(transfer, slot)
+            scpclient = scp.SCPClient(client.get_transport())
+            with open(file_name, "rb") as fh:
+                scpclient.putfo(
+                    VolumeReader(fh, offset, size),
+                    remote_path=f"{dir_remote}/{volumeName(name, index)}",
+                    size=size,
+                )
+        except Exception as e:
+            LOGGER.error(
+                "%s %s: SCP of volume %d to '%s' failed, retry(%d). Exception=%s Msg=%s",
+                typeName,
+                entry[CONF_NAME],
+                index,
+                remotehost,
+                retrycount,
+                type(e).__name__,
+                e,
+            )
+            sshDrop(transfer, slot, client)
+
+        with lock:
+            slots.append(slot)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        list(pool.map(send, todo))
+
+    # Only the sent volumes need a check
+    missing = missingVolumes(sshClient(transfer), dir_remote, name, todo, remotehost)
+    if missing is None or missing:
+        errmsg = f"{typeName} {entry[CONF_NAME]}: {len(todo if missing is None else missing)} volume(s) of '{name}' failed on host '{remotehost}', retry({retrycount})"
+        LOGGER.error(errmsg)
+        if retrylast:
+            ErrorMsg(errmsg)
+        return None
+
+    return sum(volume[2] for volume in todo)
+
+
+#################################################################
+def gfTables():
+    """Exponent and logarithm tables of GF(256), polynomial 0x11d."""
+
+    exp = [0] * 512
+    log = [0] * 256
+    x = 1
+    for i in range(255):
+        exp[i] = exp[i + 255] = x
+        log[x] = i
+        x <<= 1
+        if x & 0x100:
+            x ^= 0x11D
+
+    return exp, log
+
+
+GF_EXP, GF_LOG = gfTables()
+
+
+#################################################################
+def gfMul(a, b):
+    """Multiply in GF(256)."""
+    return GF_EXP[GF_LOG[a] + GF_LOG[b]] if a and b else 0
+
+
+#################################################################
+def gfInv(a):
+    """Inverse in GF(256)."""
+    return GF_EXP[255 - GF_LOG[a]]
+
+
+#################################################################
+@functools.lru_cache(maxsize=256)
+def gfTable(c):
+    """Table for bytes.translate(), multiplies every byte with c."""
+    return bytes(gfMul(c, x) for x in range(256))
+
+
+#################################################################
+def gfCombine(row, pieces):
+    """The sum of the pieces times the coefficients of the row. A multiply
+       is a translate() of the bytes, the sum a XOR of big integers."""
+
+    result = 0
+    for c, piece in zip(row, pieces):
+        if c == 1:
+            result ^= int.from_bytes(piece, "little")
+        elif c:
+            result ^= int.from_bytes(piece.translate(gfTable(c)), "little")
+
+    return result.to_bytes(len(pieces[0]), "little")
+
+
+#################################################################
+def gfInvert(matrix):
+    """Inverse of a square matrix in GF(256), Gauss-Jordan."""
+
+    size = len(matrix)
+    rows = [list(row) + [int(i == j) for j in range(size)] for i, row in enumerate(matrix)]
+
+    for col in range(size):
+        pivot = next(row for row in range(col, size) if rows[row][col])
+        rows[col], rows[pivot] = rows[pivot], rows[col]
+
+        inv = gfInv(rows[col][col])
+        rows[col] = [gfMul(inv, x) for x in rows[col]]
+
+        for row in range(size):
+            c = rows[row][col]
+            if row != col and c:
+                rows[row] = [x ^ gfMul(c, y) for x, y in zip(rows[row], rows[col])]
+
+    return [row[size:] for row in rows]
+
+
+#################################################################
+def rsMatrix(k, m):
+    """Encoding matrix of k data and m parity shards: the identity (the data
+       shards are the data) and a Cauchy matrix, so any k rows invert."""
+
+    return [[int(i == j) for j in range(k)] for i in range(k)] + [
+        [gfInv((k + i) ^ j) for j in range(k)] for i in range(m)
+    ]
+
+
+#################################################################
+def shardName(file_name, index):
+    """Name of a shard of the artifact."""
+    return f"{file_name}.rs{index:02d}"
+
+
+#################################################################
+def shardSize(size, k):
+    """Size of a shard of an artifact of size bytes, see writeShards()."""
+
+    block = max(1, min(SHARD_BLOCK, -(-size // k)))
+    return SHARD_HEADER.size + -(-size // (k * block)) * block
+
+
+#################################################################
+def writeShards(file_name, names, k, m):
+    """Reed-Solomon encode the file into k data and m parity shards, per
+       stripe of k blocks. Every shard has a header (k, m, its index, the
+       size of the file and the block size), so a restore needs nothing
+       else. Returns the sha256 of every shard."""
+
+    size = os.stat(file_name).st_size
+    block = max(1, min(SHARD_BLOCK, -(-size // k)))
+    parity = rsMatrix(k, m)[k:]
+
+    outputs = [open(name, "wb") for name in names]
+    sha256s = [hashlib.sha256() for name in names]
+
+    def write(index, data):
+        outputs[index].write(data)
+        sha256s[index].update(data)
+
+    try:
+        for index in range(k + m):
+            write(index, SHARD_HEADER.pack(SHARD_MAGIC, k, m, index, size, block))
+
+        with open(file_name, "rb") as fh:
+            while True:
+                data = fh.read(k * block)
+                if not data:
+                    break
+
+                data = data.ljust(k * block, b"\0")
+                pieces = [data[j * block : (j + 1) * block] for j in range(k)]
+
+                for index, piece in enumerate(pieces):
+                    write(index, piece)
+                for index, row in enumerate(parity):
+                    write(k + index, gfCombine(row, pieces))
+
+    finally:
+        for output in outputs:
+            output.close()
+
+    return [sha256.hexdigest() for sha256 in sha256s]
+
+
+#################################################################
+def _doTransferShards(typeName, entry, file_name, done=(), reference=None):
+    """Erasure coding: the artifact is encoded in k data and m parity
+       shards, a shard per backup host. Any k of the hosts can restore it.
+       An unchanged artifact (reference) gets a hardlink to the shard of
+       the last one on a host. Returns False if there are not enough
+       hosts, then every host gets a full copy as usual."""
+
+    k = config[CONF_CONFIG][CONF_ERASURE][CONF_DATA]
+    m = config[CONF_CONFIG][CONF_ERASURE][CONF_PARITY]
+
+    dir_output = (
+        f"{config[CONF_CONFIG][CONF_DIR][CONF_LOCAL]}/{typeName}/{entry[CONF_NAME]}"
+    )
+    dir_output_remote = (
+        f"{config[CONF_CONFIG][CONF_DIR][CONF_REMOTE]}/{typeName}/{entry[CONF_NAME]}"
+    )
+
+    hosts = [
+        transfer
+        for transfer in config[CONF_CONFIG][CONF_TRANSFER]
+        if (not transfer[CONF_RUN_HOST] or hostname in transfer[CONF_RUN_HOST])
+        and (transfer[CONF_HOST], typeName, entry[CONF_NAME]) not in PREFLIGHT_SKIP
+    ]
+
+    if len(hosts) < k + m:
+        LOGGER.warning(
+            "%s %s: Erasure coding %d+%d needs %d backup hosts, there are %d. Full copies instead",
+            typeName,
+            entry[CONF_NAME],
+            k,
+            m,
+            k + m,
+            len(hosts),
+        )
+        return False
+
+    def record(index, remotehost, fsize, sha256, now):
+        catalogExecute(
+            "INSERT INTO shard VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                now.isoformat(),
+                typeName,
+                entry[CONF_NAME],
+                f"{dir_output}/{file_name}",
+                index,
+                remotehost,
+                fsize,
+                sha256,
+            ),
+        )
+        journal(
+            typeName,
+            entry[CONF_NAME],
+            JOURNAL_TRANSFER,
+            remotehost,
+            f"{dir_output}/{file_name}",
+        )
+
+    # The run we resume did these hosts already
+    todo = [
+        (index, transfer)
+        for index, transfer in enumerate(hosts[: k + m])
+        if transfer[CONF_HOST] not in done
+    ]
+
+    # Unchanged, the host still has the same shard of the last archive. Not
+    # for a run again the same day, the shard there may be partial
+    if reference not in [None, f"{dir_output}/{file_name}"]:
+        for index, transfer in todo[:]:
+            remotehost = transfer[CONF_HOST]
+            rows = catalogExecute(
+                "SELECT size, sha256 FROM shard WHERE file_name = ? AND shard = ?"
+                " AND host = ?",
+                (reference, index, remotehost),
+            )
+            if not rows:
+                continue
+
+            src = shardName(os.path.basename(reference), index)
+            dst = shardName(file_name, index)
+            try:
+                linked = linkRemote(
+                    sshClient(transfer),
+                    f"{dir_output_remote}/{src}",
+                    f"{dir_output_remote}/{dst}",
+                    remotehost,
+                )
+            except Exception as e:
+                LOGGER.warning(
+                    "%s %s: No hardlink on '%s'. Exception=%s Msg=%s",
+                    typeName,
+                    entry[CONF_NAME],
+                    remotehost,
+                    type(e).__name__,
+                    e,
+                )
+                linked = False
+
+            if linked:
+                ReportTime(typeName, entry[CONF_NAME], f"link {remotehost}", 0, 0)
+                now = datetime.datetime.now()
+                record(index, remotehost, rows[0][0], rows[0][1], now)
+                todo.remove((index, transfer))
+
+    if not todo:
+        return True
+
+    dir_temp = dirTemp()
+    if not os.path.exists(dir_temp):
+        os.makedirs(dir_temp)
+    scratch = tempfile.mkdtemp(prefix=f"shards-{entry[CONF_NAME]}-", dir=dir_temp)
+
+    try:
+        now = datetime.datetime.now()
+        names = [shardName(f"{scratch}/{file_name}", index) for index in range(k + m)]
+        sha256s = writeShards(f"{dir_output}/{file_name}", names, k, m)
+
+        diff = (datetime.datetime.now() - now).total_seconds()
+        fsize = sum(os.stat(name).st_size for name in names)
+        ReportTime(typeName, entry[CONF_NAME], "erasure", diff, fsize)
+        LOGGER.debug(
+            "%s %s: Encoded '%s' in %d+%d shards (%d seconds, %s)",
+            typeName,
+            entry[CONF_NAME],
+            file_name,
+            k,
+            m,
+            diff,
+            sizeUnit(fsize),
+        )
+
+        for index, transfer in todo:
+            remotehost = transfer[CONF_HOST]
+
+            now = datetime.datetime.now()
+            if not sendShard(typeName, entry, transfer, names[index], dir_output_remote, sha256s[index]):
+                continue
+
+            diff = (datetime.datetime.now() - now).total_seconds()
+            fsize = os.stat(names[index]).st_size
+            ReportTime(typeName, entry[CONF_NAME], f"scp {remotehost}", diff, fsize)
+            record(index, remotehost, fsize, sha256s[index], now)
+
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+
+    return True
+
+
+#################################################################
+def sendShard(typeName, entry, transfer, name, dir_remote, sha256):
+    """Transfer a shard to its backup host and check its sha256 there."""
+
+    remotehost = transfer[CONF_HOST]
+
+    rc = os.system("ping -w 3 -c 2 " + remotehost + " >/dev/null")
+    if rc != 0:
+        errmsg = f"{typeName} {entry[CONF_NAME]}: Cannot ping host '{remotehost}' RC={int(rc/256)}"
+        ErrorMsg(errmsg)
+        LOGGER.error(errmsg)
+        return False
+
+    for retrycount in range(transfer[CONF_RETRY] + 1):
+        client = None
+        try:
+            client = sshClient(transfer)
+
+            rc, stdout = remoteSSH(
+                client,
+                f"mkdir -p {dir_remote}",
+                remotehost=remotehost,
+                retrylast=False,
+                retrycount=retrycount,
+            )
+            if rc:
+                rc = sendDictionaries(
+                    typeName, entry, client, dir_remote, remotehost, retrycount
+                )
+            if rc:
+                rc = remoteSCP(
+                    client,
+                    name,
+                    dir_remote,
+                    remotehost=remotehost,
+                    retrylast=False,
+                    retrycount=retrycount,
+                )
+            if rc:
+                rc, stdout = remoteSSH(
+                    client,
+                    f"sha256sum {dir_remote}/{os.path.basename(name)}",
+                    remotehost=remotehost,
+                    retrylast=False,
+                    retrycount=retrycount,
+                )
+                rc = rc and stdout and stdout[0].split()[0] == sha256
+
+        # The other hosts get their shard anyway
+        except Exception as e:
+            LOGGER.error(
+                "%s %s: SSH host '%s' failed, retry(%d). Exception=%s Msg=%s",
+                typeName,
+                entry[CONF_NAME],
+                remotehost,
+                retrycount,
+                type(e).__name__,
+                e,
+            )
+            rc = False
+
+        if rc:
+            LOGGER.debug(
+                "%s %s: Shard '%s' to '%s' OK",
+                typeName,
+                entry[CONF_NAME],
+                os.path.basename(name),
+                remotehost,
+            )
+            return True
+
+        if client is not None:
+            sshDrop(transfer, client=client)
+
+    errmsg = f"{typeName} {entry[CONF_NAME]}: Shard '{os.path.basename(name)}' to host '{remotehost}' failed"
+    ErrorMsg(errmsg)
+    LOGGER.error(errmsg)
+    return False
+
+
+#################################################################
+def excluded(name, entry):
+    """Check if the (relative) name matches one of the exclude patterns."""
+
+    for pattern in entry[CONF_EXCLUDE] or []:
+        if fnmatch.fnmatch(name, pattern):
+            return True
+
+    return False
+
+
+#################################################################
+def treeSize(dir_input, entry):
+    """Fast sum of the file sizes in the tree, with the excludes applied the
+       same way as the archive does (an excluded directory is not entered)."""
+
+    total = 0
+    todo = [""]
+
+    while todo:
+        relative = todo.pop()
+        directory = f"{dir_input}/{relative}" if relative else dir_input
+        try:
+            with os.scandir(directory) as it:
+                for item in it:
+                    name = f"{relative}/{item.name}" if relative else item.name
+                    if excluded(name, entry):
+                        continue
+                    if item.is_dir(follow_symlinks=False):
+                        todo.append(name)
+                    elif item.is_file(follow_symlinks=False):
+                        total += item.stat(follow_symlinks=False).st_size
+        except OSError:
+            # Vanished or no access, the archive will report it
+            continue
+
+    return total
+
+
+#################################################################
+def treeFingerprint(dir_input, entry):
+    """Cheap fingerprint of the tree: the name, type, size, mtime and owner
+       of every member of the archive (directories without mtime, it
+       changes with every temp file). Returns the sha256 and the size."""
+
+    sha256 = hashlib.sha256()
+    total = 0
+    todo = [""]
+
+    while todo:
+        relative = todo.pop()
+        directory = f"{dir_input}/{relative}" if relative else dir_input
+        with os.scandir(directory) as it:
+            items = sorted(it, key=lambda x: x.name)
+
+        for item in items:
+            name = f"{relative}/{item.name}" if relative else item.name
+            if excluded(name, entry):
+                continue
+
+            statres = item.stat(follow_symlinks=False)
+            if item.is_dir(follow_symlinks=False):
+                todo.append(name)
+                mtime = 0
+            else:
+                mtime = statres.st_mtime_ns
+            if item.is_file(follow_symlinks=False):
+                total += statres.st_size
+
+            sha256.update(
+                f"{name}\0{statres.st_mode}\0{statres.st_uid}\0{statres.st_gid}\0"
+                f"{statres.st_size}\0{mtime}\n".encode("utf-8", "surrogateescape")
+            )
+
+    return sha256.hexdigest(), total
+
+
+#################################################################
+def unchangedArchive(typeName, entry, fingerprint, file_name):
+    """The last archive of the entry if it has the same fingerprint, and is
+       still there with the same kind of name (e.g. encrypted). None if
+       we need a new archive."""
+
+    rows = catalogExecute(
+        "SELECT fingerprint, file_name FROM fingerprint WHERE type = ? AND name = ?"
+        " ORDER BY date DESC LIMIT 1",
+        (typeName, entry[CONF_NAME]),
+    )
+    if not rows or rows[0][0] != fingerprint or not os.path.isfile(rows[0][1]):
+        return None
+
+    # The part after the date, e.g. ".tgz.enc"
+    suffix = re.sub(r"^.*\.\d{8}-\d", "", file_name)
+    if re.sub(r"^.*\.\d{8}-\d", "", os.path.basename(rows[0][1])) != suffix:
+        return None
+
+    return rows[0][1]
+
+
+#################################################################
+def estimateSize(typeName, entry):
+    """Estimate the size of the backup file. For an app/other the input size
+       with the compression ratio of the last backup, for a database the
+       last backup size with some growth. Zero if we cannot tell."""
+
+    rows = catalogExecute(
+        "SELECT size, input_size FROM artifact WHERE type = ? AND name = ?"
+        " ORDER BY date DESC LIMIT 1",
+        (typeName, entry[CONF_NAME]),
+    )
+
+    if typeName == CONF_DB:
+        return int(rows[0][0] * PREFLIGHT_GROWTH) if rows else 0
+
+    ratio = 1.0
+    if rows and rows[0][1]:
+        ratio = rows[0][0] / rows[0][1]
+
+    return int(inputSize(typeName, entry) * ratio)
+
+
+#################################################################
+def inputSize(typeName, entry):
+    """The input size of an app/other tree for the estimates before the
+       backup: the last one (catalog) with some growth, the archive walks
+       the tree anyway for its fingerprint. A tree without history is
+       walked once per run."""
+
+    rows = catalogExecute(
+        "SELECT input_size FROM artifact WHERE type = ? AND name = ?"
+        " ORDER BY date DESC LIMIT 1",
+        (typeName, entry[CONF_NAME]),
+    )
+    if rows and rows[0][0]:
+        return int(rows[0][0] * PREFLIGHT_GROWTH)
+
+    key = (typeName, entry[CONF_NAME])
+    if key not in TREE_SIZE:
+        TREE_SIZE[key] = treeSize(dirInput(entry), entry)
+
+    return TREE_SIZE[key]
+
+
+#################################################################
+def remoteFree(transfer):
+    """Free space (bytes) in the remote directory, None if unknown."""
+
+    remotedir = config[CONF_CONFIG][CONF_DIR][CONF_REMOTE]
+
+    try:
+        client = sshClient(transfer)
+        rc, stdout = remoteSSH(
+            client, f"mkdir -p {remotedir} && df -Pk {remotedir}", retrylast=False
+        )
+        if not rc:
+            return None
+        return int(stdout[-1].split()[3]) * 1024
+    except Exception as e:
+        LOGGER.debug(
+            "preflight: Free space on '%s' unknown. Exception=%s Msg=%s",
+            transfer[CONF_HOST],
+            type(e).__name__,
+            e,
+        )
+        return None
+
+
+#################################################################
+def preflight(todo):
+    """Estimate the size of every backup and check the free space on the
+       temp, local and remote directories, before any work is done. Entries
+       that do not fit are skipped with an error, so the ones after them
+       still run. A remote without space skips only the transfer."""
+
+    PREFLIGHT_SKIP.clear()
+    TREE_SIZE.clear()
+
+    if not config[CONF_CONFIG][CONF_PREFLIGHT] or not todo:
+        return todo
+
+    dir_local = config[CONF_CONFIG][CONF_DIR][CONF_LOCAL]
+    dir_temp = config[CONF_CONFIG][CONF_DIR][CONF_TEMP] or dir_local
+
+    if not os.path.exists(dir_temp):
+        os.makedirs(dir_temp)
+
+    free_local = shutil.disk_usage(dir_local).free
+    free_temp = shutil.disk_usage(dir_temp).free
+
+    # Temp on the same filesystem is already part of the local free space
+    same = os.stat(dir_temp).st_dev == os.stat(dir_local).st_dev
+
+    transfers = [
+        transfer
+        for transfer in config[CONF_CONFIG][CONF_TRANSFER]
+        if not transfer[CONF_RUN_HOST] or hostname in transfer[CONF_RUN_HOST]
+    ]
+
+    # Erasure coded, the shards are written in temp and a host gets one
+    k = config[CONF_CONFIG][CONF_ERASURE][CONF_DATA]
+    m = config[CONF_CONFIG][CONF_ERASURE][CONF_PARITY]
+    shards = config[CONF_CONFIG][CONF_ERASURE][CONF_ENABLED] and len(transfers) >= k + m
+
+    result = []
+    for typeName, entry in todo:
+        size = estimateSize(typeName, entry)
+
+        LOGGER.debug(
+            "preflight: %s %s: Estimated %s", typeName, entry[CONF_NAME], sizeUnit(size)
+        )
+
+        need_temp = size + (k + m) * shardSize(size, k) if shards else size
+        need_local = need_temp if same else size
+
+        if need_local > free_local or (not same and need_temp > free_temp):
+            directory = dir_local if need_local > free_local else dir_temp
+            free = free_local if need_local > free_local else free_temp
+            errmsg = f"{typeName} {entry[CONF_NAME]}: Skipped, estimated {sizeUnit(max(need_local, need_temp))} but only {sizeUnit(free)} free in '{directory}'"
+            ErrorMsg(errmsg)
+            LOGGER.error(errmsg)
+            continue
+
+        # Local space is used till expiry, temp only during the backup
+        free_local -= size
+        result.append((typeName, entry, size))
+
+    for transfer in transfers:
+        free = remoteFree(transfer)
+        if free is None:
+            continue
+
+        for typeName, entry, size in result:
+            if shards:
+                size = shardSize(size, k)
+
+            if size > free:
+                errmsg = f"{typeName} {entry[CONF_NAME]}: Transfer to '{transfer[CONF_HOST]}' skipped, estimated {sizeUnit(size)} but only {sizeUnit(free)} free"
+                ErrorMsg(errmsg)
+                LOGGER.error(errmsg)
+                PREFLIGHT_SKIP.add((transfer[CONF_HOST], typeName, entry[CONF_NAME]))
+                continue
+
+            free -= size
+
+    return [(typeName, entry) for typeName, entry, size in result]
+
+
+#################################################################
+def doBackupWrapper(typeName, entry):
+    """A wrapper around docker stop/start (or pause/unpause), because a
+       failure during backup should never leave the container stopped.
+       With a snapshot, the container is only paused for the copy."""
+
+    now = time.monotonic()
+    dir_snapshot = None
+
+    quiesceContainer(typeName, entry)
+    try:
+        if typeName != CONF_DB and entry[CONF_SNAPSHOT]:
+            dir_snapshot = snapshotTree(typeName, entry)
+            resumeContainer(typeName, entry)
+
+        _doAppDb(typeName, entry, dir_snapshot)
+    except Exception as e:
+        errmsg = f"Failure do{typeName} {entry[CONF_NAME]}. Exception={type(e).__name__} Msg={e}"
+        ErrorMsg(errmsg)
+        LOGGER.error(
+            errmsg, exc_info=True,
+        )
+    finally:
+        resumeContainer(typeName, entry)
+        if dir_snapshot is not None:
+            shutil.rmtree(dir_snapshot, ignore_errors=True)
+
+    # All stages, for the scheduling of the next runs
+    ReportTime(typeName, entry[CONF_NAME], "total", time.monotonic() - now)
+
+
+#################################################################
+def _doAppDb(typeName, entry, dir_snapshot=None):
+    def excludeFromTar(tarinfo):
+        """If we exclude it, we return None, otherwise tarinfo."""
+        # LOGGER.debug("x: %s", tarinfo.name)
+        if excluded(tarinfo.name, entry):
+            return None
+        # LOGGER.debug("y: %s", tarinfo.name)
+
+        # Input size, for the compression ratio in the catalog
+        if tarinfo.isfile():
+            input_size[0] += tarinfo.size
+
+        return tarinfo
+
+    input_size = [0]
+
+    # A snapshot of the tree is archived the same, as if it is the tree
+    dir_input = dir_snapshot or dirInput(entry)
+    dir_temp = dirTemp()
+
+    dir_output = (
+        f"{config[CONF_CONFIG][CONF_DIR][CONF_LOCAL]}/{typeName}/{entry[CONF_NAME]}"
+    )
+
+    # Generare output date & day-of-week
+    file_name = f"{entry[CONF_NAME]}.{datetime.datetime.today().strftime('%Y%m%d')}-{datetime.datetime.today().isoweekday()}"
+
+    # Configure name if no container is specified
+    if entry[CONF_CONTAINER] == "":
+        entry[CONF_CONTAINER] = entry[CONF_NAME]
+
+    zstd = zstdEnabled(typeName, entry)
+
+    if typeName == CONF_APP:
+        file_name = f"{file_name}.tar{ZSTD_SUFFIX}" if zstd else f"{file_name}.tgz"
+    elif zstd:
+        file_name = f"{file_name}.sql{ZSTD_SUFFIX}"
+    elif entry[CONF_TYPE] in [CONF_TYPE_MYSQL, CONF_TYPE_POSTGRESQL]:
+        # MySQL/PostgreSQL use same naming
+        file_name = f"{file_name}.sql.gz"
+    elif entry[CONF_TYPE] in [CONF_TYPE_INFLUXDB_EXPORT]:
+        # InfluxDB filename, but is the to-be-renamed filename
+        # The initial output filename is fixed in the container command
+        file_name = f"{file_name}.gz"
+    elif entry[CONF_TYPE] in [CONF_TYPE_INFLUXDB_BACKUP]:
+        # InfluxDB filename, but is the to-be-renamed filename
+        # The initial output filename is fixed in the container command
+        file_name = f"{file_name}.tgz"
+
+    # The encryption stage is visible in the name, restore needs to know it
+    if encrypting():
+        file_name = f"{file_name}{ENCRYPT_SUFFIX}"
+
+    # Check if local directory exists
+    if not os.path.exists(dir_input):
+        errmsg = (
+            f"{typeName} {entry[CONF_NAME]}: Directory '{dir_input}' does not exist"
+        )
+        ErrorMsg(errmsg)
+        LOGGER.error(errmsg)
+        return
+
+    # Create output directory structure if needed
+    if not os.path.exists(dir_output):
+        os.makedirs(dir_output)
+        LOGGER.debug(
+            "%s %s: Directory '%s' created", typeName, entry[CONF_NAME], dir_output
+        )
+
+    # We write to a temporary name in the output directory, and rename it when
+    # complete. A rename never copies. Only an explicit temp directory (e.g.
+    # the output directory is a slow NFS mount) is used as staging area
+    if config[CONF_CONFIG][CONF_DIR][CONF_TEMP]:
+        file_work = f"{dir_temp}/{file_name}"
+
+        if not os.path.exists(dir_temp):
+            os.makedirs(dir_temp)
+            LOGGER.debug(
+                "%s %s: Directory '%s' created", typeName, entry[CONF_NAME], dir_temp
+            )
+    else:
+        file_work = tempName(f"{dir_output}/{file_name}")
+
+    alreadymoved = False
+
+    # Current time
+    now = datetime.datetime.now()
+
+    # An unchanged tree gets a hardlink to the last archive, not a new one
+    fingerprint = None
+    reference = None
+
+    # The zstd dictionary of the artifact (0 is none, as in the frame header),
+    # its expiry needs to know
+    dict_id = None
+
+    if typeName == CONF_APP:
+        try:
+            fingerprint, fingerprint_size = treeFingerprint(dir_input, entry)
+            reference = unchangedArchive(
+                typeName, entry, fingerprint, f"{dir_output}/{file_name}"
+            )
+        except Exception as e:
+            LOGGER.warning(
+                "%s %s: No fingerprint. Exception=%s Msg=%s",
+                typeName,
+                entry[CONF_NAME],
+                type(e).__name__,
+                e,
+            )
+
+    # Create output file & compress file(s)
+    if reference is not None:
+        linkFile(reference, f"{dir_output}/{file_name}")
+        input_size[0] = fingerprint_size
+        rows = catalogExecute(
+            "SELECT dict_id FROM usage WHERE file_name = ?", (reference,)
+        )
+        dict_id = rows[0][0] if rows else None
+        alreadymoved = True
+
+        diff = (datetime.datetime.now() - now).total_seconds()
+        ReportTime(typeName, entry[CONF_NAME], "link", diff, 0)
+        LOGGER.info(
+            "%s %s: Unchanged, '%s' is a hardlink to '%s'",
+            typeName,
+            entry[CONF_NAME],
+            file_name,
+            reference,
+        )
+
+        resumeContainer(typeName, entry)
+
+    elif typeName == CONF_APP:
+        LOGGER.debug(
+            "%s %s: Creating '%s' from '%s'",
+            typeName,
+            entry[CONF_NAME],
+            file_name,
+            dir_input,
+        )
+        # Create out tgz file
+        try:
+            level, size, seconds = chooseLevel(typeName, entry)
+
+            with openOutput(file_work) as output:
+                # The pacer steps down gzip levels only, zstd keeps its level
+                if zstd:
+                    dictionary = zstdDictionary(typeName, entry)
+                    dict_id = dictionary.dict_id() if dictionary else 0
+                    compressed = ZstdWriter(
+                        output, dictionary, ZSTD_TREE_LEVEL[level]
+                    )
+                    pacer = None
+                else:
+                    compressed = GzipWriter(output, level)
+                    pacer = Pacer(typeName, entry, compressed, level, size, seconds)
+
+                with compressed, TarWriter(compressed) as archive:
+                    with lowPriority(typeName, entry):
+                        archiveTree(
+                            archive,
+                            dir_input,
+                            entry,
+                            excludeFromTar,
+                            None if zstd else compressed,
+                            pacer,
+                            config[CONF_CONFIG][CONF_PREFETCH],
+                        )
+
+            if zstd:
+                zstdTrain(typeName, entry, compressed.sample)
+            else:
+                pacer.finish()
+        except Exception as e:
+            errmsg = f"{typeName} {entry[CONF_NAME]}: Failure during creation '{file_work}'. Exception={type(e).__name__} Msg={e}"
+            ErrorMsg(errmsg)
+            LOGGER.error(
+                errmsg, exc_info=True,
+            )
+
+            # Do not leave a partial file behind
+            if os.path.exists(file_work):
+                os.remove(file_work)
+            return
+
+        # Calculate how many seconds it took us to SCP
+        later = datetime.datetime.now()
+        diff = (later - now).total_seconds()
+        fsize = os.stat(file_work).st_size
+        ReportTime(typeName, entry[CONF_NAME], "archive", diff, fsize)
+        fsize = round(fsize / 1024, 1)
+        unit = "kByte"
+
+        # Change to MByte if needed
+        if fsize > 1000:
+            fsize = round(fsize / 1024, 1)
+            unit = "MByte"
+
+        LOGGER.debug(
+            "%s %s: Created '%s' from '%s' (%d seconds, %d %s)",
+            typeName,
+            entry[CONF_NAME],
+            file_name,
             dir_input,
+            diff,
+            fsize,
+            unit,
+        )
+
+        # We should start the container asap
+        resumeContainer(typeName, entry)
+
+    else:
+        if entry[CONF_TYPE] == CONF_TYPE_MYSQL:
+            cmd = DB_MYSQL.format(
+                container=entry[CONF_CONTAINER],
+                database=entry[CONF_DBNAME],
+                sqluser=entry[CONF_DBUSER],
+                priority=containerPriority(entry),
+            )
+        elif entry[CONF_TYPE] == CONF_TYPE_POSTGRESQL:
+            cmd = DB_POSTGRESQL.format(
+                container=entry[CONF_CONTAINER],
+                database=entry[CONF_DBNAME],
+                sqluser=entry[CONF_DBUSER],
+                priority=containerPriority(entry),
+            )
+        elif entry[CONF_TYPE] == CONF_TYPE_INFLUXDB_BACKUP:
+            cmd = DB_INFLUXDB_BACKUP.format(
+                container=entry[CONF_CONTAINER], file_name=file_name
+            )
+        elif entry[CONF_TYPE] == CONF_TYPE_INFLUXDB_EXPORT:
+            cmd = DB_INFLUXDB_EXPORT.format(
+                container=entry[CONF_CONTAINER], database=entry[CONF_DBNAME]
+            )
+
+        # gzip in the shell, zstd here (with the dictionary of the entry)
+        if entry[CONF_TYPE] in [CONF_TYPE_MYSQL, CONF_TYPE_POSTGRESQL] and not zstd:
+            cmd = f"{cmd}{DB_GZIP}"
+
+        LOGGER.debug("%s %s: Executing '%s'", typeName, entry[CONF_NAME], cmd)
+
+        if entry[CONF_TYPE] in [CONF_TYPE_MYSQL, CONF_TYPE_POSTGRESQL]:
+            # The dump is read from stdout, so it can go through the
+            # encryption stage before it touches the disk
+            try:
+                with openOutput(file_work) as output, lowPriority(
+                    typeName, entry
+                ), subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE) as proc:
+                    try:
+                        dictionary = None
+                        if zstd:
+                            dictionary = zstdDictionary(typeName, entry)
+                            dict_id = dictionary.dict_id() if dictionary else 0
+                        compressed = (
+                            ZstdWriter(output, dictionary)
+                            if zstd
+                            else contextlib.nullcontext(output)
+                        )
+                        reader = InputReader(
+                            proc.stdout, Throttle(entry[CONF_THROTTLE][CONF_RATE])
+                        )
+                        with compressed as dump:
+                            shutil.copyfileobj(reader, dump, ENCRYPT_CHUNK)
+                    except Exception:
+                        # Nobody reads the pipe anymore, the dump would hang on it
+                        proc.kill()
+                        raise
+                    rc = proc.wait()
+
+                if zstd and rc == 0:
+                    zstdTrain(typeName, entry, compressed.sample)
+            except Exception as e:
+                LOGGER.error(
+                    "%s %s: Writing '%s' failed. Exception=%s Msg=%s",
+                    typeName,
+                    entry[CONF_NAME],
+                    file_work,
+                    type(e).__name__,
+                    e,
+                )
+                rc = -1
+        else:
+            with lowPriority(typeName, entry):
+                rc = os.waitstatus_to_exitcode(os.system(cmd))
+
+        if rc == 0:
+            # Calculate how many seconds it took us to execute the command
+            later = datetime.datetime.now()
+            diff = (later - now).total_seconds()
+
+            # Need to use the right DB stuff
+            if entry[CONF_TYPE] in [CONF_TYPE_MYSQL, CONF_TYPE_POSTGRESQL]:
+                fsize = os.stat(file_work).st_size
+            elif entry[CONF_TYPE] == CONF_TYPE_INFLUXDB_BACKUP:
+                fsize = os.stat(f"{dir_input}/backup/{file_name}").st_size
+            elif entry[CONF_TYPE] == CONF_TYPE_INFLUXDB_EXPORT:
+                fsize = os.stat(f"{dir_input}/backup/influx-export.gz").st_size
+
+            ReportTime(typeName, entry[CONF_NAME], "dump", diff, fsize)
+            fsize = round(fsize / 1024, 1)
+            unit = "kByte"
+
+            # Change to MByte if needed
+            if fsize > 1000:
+                fsize = round(fsize / 1024, 1)
+                unit = "MByte"
+
+            LOGGER.debug(
+                "%s %s: Execution is successful (%d seconds, %d %s)",
+                typeName,
+                entry[CONF_NAME],
+                diff,
+                fsize,
+                unit,
+            )
+        else:
+            errmsg = f"{typeName} {entry[CONF_NAME]}: Execution error '{entry[CONF_TYPE]}' RC={rc}, CMD={cmd}"
+            ErrorMsg(errmsg)
+            LOGGER.error(errmsg)
+
+            # Do not leave a partial file behind
+            if os.path.exists(file_work):
+                os.remove(file_work)
+            return
+
+        # Special for InfluxDB, because we need to rename in-container "/backup/influx*gz" to our output filename
+        if entry[CONF_TYPE] == CONF_TYPE_INFLUXDB_BACKUP:
+            file_input = f"{dir_input}/backup/{file_name}"
+
+            # file must exist
+            if not os.path.isfile(file_input):
+                errmsg = f"{typeName} {entry[CONF_NAME]}: Executed InfluxDB backup, but '{file_input}' does not exist?"
+                ErrorMsg(errmsg)
+                LOGGER.error(errmsg)
+                return
+
+            publishFile(file_input, f"{dir_output}/{file_name}", encrypting())
+            LOGGER.debug(
+                "%s %s: Published '%s' as '%s'",
+                typeName,
+                entry[CONF_NAME],
+                file_input,
+                f"{dir_output}/{file_name}",
+            )
+
+            # Set already moved, because it is inside the container, not in the temp directory
+            alreadymoved = True
+
+        elif entry[CONF_TYPE] == CONF_TYPE_INFLUXDB_EXPORT:
+
+            file_input = f"{dir_input}/backup/influx-export.gz"
+
+            # file must exist
+            if not os.path.isfile(file_input):
+                errmsg = f"{typeName} {entry[CONF_NAME]}: Executed InfluxDB export, but '{file_input}' does not exist?"
+                ErrorMsg(errmsg)
+                LOGGER.error(errmsg)
+                return
+
+            publishFile(file_input, f"{dir_output}/{file_name}", encrypting())
+            LOGGER.debug(
+                "%s %s: Published '%s' as '%s'",
+                typeName,
+                entry[CONF_NAME],
+                file_input,
+                f"{dir_output}/{file_name}",
+            )
+
+            # Set already moved, because it is inside the container, not in the temp directory
+            alreadymoved = True
+
+    # All good, give it the final name, for InfluxDB this isn't needed
+    if not alreadymoved:
+        publishFile(file_work, f"{dir_output}/{file_name}")
+        LOGGER.debug(
+            "%s %s: Published '%s' as '%s'",
+            typeName,
+            entry[CONF_NAME],
+            file_work,
+            f"{dir_output}/{file_name}",
+        )
+
+        # *** ONLY works on LOCAL node, not on remote ***
+
+        # Set permissions on output file
+        if config[CONF_CONFIG][CONF_CHOWN]:
+            try:
+                chown = config[CONF_CONFIG][CONF_CHOWN].split(":")
+                chown_uid = chown[0]
+                chown_gid = -1
+                if len(chown) >= 2:
+                    chown_gid = chown[1]
+
+                if chown_uid:
+                    os.chown(
+                        f"{dir_output}/{file_name}", int(chown_uid), int(chown_gid)
+                    )
+                    LOGGER.debug(
+                        "%s %s: Chown '%s' with uid=%s and gid=%s",
+                        typeName,
+                        entry[CONF_NAME],
+                        f"{dir_output}/{file_name}",
+                        chown_uid,
+                        chown_gid,
+                    )
+
+            except Exception as e:
+                errmsg = f"{typeName} {entry[CONF_NAME]}: '{file_name}' FAILED chown. Exception={type(e).__name__} Msg={e}"
+                ErrorMsg(errmsg)
+                LOGGER.error(
+                    errmsg, exc_info=True,
+                )
+
+        # *** ONLY works on LOCAL node, not on remote ***
+
+    # Keep history in the catalog, e.g. for the preflight size estimation
+    catalogExecute(
+        "INSERT INTO artifact VALUES (?, ?, ?, ?, ?, ?, ?)",
+        (
+            now.isoformat(),
+            typeName,
+            entry[CONF_NAME],
+            f"{dir_output}/{file_name}",
+            os.stat(f"{dir_output}/{file_name}").st_size,
+            input_size[0],
+            (datetime.datetime.now() - now).total_seconds(),
+        ),
+    )
+
+    if fingerprint is not None:
+        catalogExecute(
+            "INSERT INTO fingerprint VALUES (?, ?, ?, ?, ?, ?)",
+            (
+                now.isoformat(),
+                typeName,
+                entry[CONF_NAME],
+                f"{dir_output}/{file_name}",
+                fingerprint,
+                reference or "",
+            ),
+        )
+
+    # A run earlier today wrote the artifact we replaced
+    catalogExecute(
+        "DELETE FROM usage WHERE file_name = ?", (f"{dir_output}/{file_name}",)
+    )
+    if dict_id is not None:
+        catalogExecute(
+            "INSERT INTO usage VALUES (?, ?, ?, ?, ?)",
+            (
+                now.isoformat(),
+                typeName,
+                entry[CONF_NAME],
+                f"{dir_output}/{file_name}",
+                dict_id,
+            ),
+        )
+
+    # A big artifact goes to the backup hosts in volumes
+    volumes = volumeList(typeName, entry, f"{dir_output}/{file_name}", now)
+    journal(
+        typeName, entry[CONF_NAME], JOURNAL_BACKUP, file_name=f"{dir_output}/{file_name}"
+    )
+
+    _doTransfer(typeName, entry, file_name, volumes, reference)
+
+
+#################################################################
+def _doTransfer(typeName, entry, file_name, volumes, reference=None, done=()):
+    """Transfer the artifact to the backup hosts, except the hosts in done
+       (resume). Every host which has it gets its stage in the journal."""
+
+    dir_output = (
+        f"{config[CONF_CONFIG][CONF_DIR][CONF_LOCAL]}/{typeName}/{entry[CONF_NAME]}"
+    )
+    dir_output_remote = (
+        f"{config[CONF_CONFIG][CONF_DIR][CONF_REMOTE]}/{typeName}/{entry[CONF_NAME]}"
+    )
+    suffixes = [volumeName("", volume[0]) for volume in volumes] or [""]
+
+    if config[CONF_CONFIG][CONF_ERASURE][CONF_ENABLED]:
+        if _doTransferShards(typeName, entry, file_name, done, reference):
+            return
+
+    for transfer in config[CONF_CONFIG][CONF_TRANSFER]:
+
+        remotehost = transfer[CONF_HOST]
+
+        # Check if we should run it on this host or not
+        if transfer[CONF_RUN_HOST] and hostname not in transfer[CONF_RUN_HOST]:
+            LOGGER.debug(
+                "%s %s: '%s' is not enabled on this run_host '%s'='%s'",
+                typeName,
+                entry[CONF_NAME],
+                remotehost,
+                transfer[CONF_RUN_HOST],
+                hostname,
+            )
+            continue
+
+        # Preflight found not enough space on the remote host
+        if (remotehost, typeName, entry[CONF_NAME]) in PREFLIGHT_SKIP:
+            continue
+
+        # The run we resume did this host already
+        if remotehost in done:
+            continue
+
+        # ping the backup node
+        rc = os.system("ping -w 3 -c 2 " + remotehost + " >/dev/null")
+
+        if rc != 0:
+            errmsg = f"{typeName} {entry[CONF_NAME]}: Cannot ping host '{remotehost}' RC={int(rc/256)}"
+            ErrorMsg(errmsg)
+            LOGGER.error(errmsg)
+            continue
+
+        LOGGER.debug("%s %s: Ping host '%s' OK", typeName, entry[CONF_NAME], remotehost)
+
+        # make remote directory, possible it does not exist
+        if transfer[CONF_TYPE] == CONF_SCP:
+
+            retrycount = 0
+
+            while retrycount <= transfer[CONF_RETRY]:
+
+                retrylast = True if retrycount == transfer[CONF_RETRY] else False
+
+                # LOGGER.debug("%s %s: SCP to '%s:%s' with username '%s'", typeName, entry[CONF_NAME], remotehost, transfer[CONF_PORT], transfer[CONF_USER])
+                # Pooled session. After a failure it is dropped, so the retry connects again
+                client = sshClient(transfer)
+
+                LOGGER.debug(
+                    "%s %s: SSH host '%s' OK", typeName, entry[CONF_NAME], remotehost
+                )
+
+                # make remote directory, possible it does not exist
+                cmd = f"mkdir -p {dir_output_remote}"
+                rc, stdout = remoteSSH(
+                    client,
+                    cmd,
+                    remotehost=remotehost,
+                    retrylast=retrylast,
+                    retrycount=retrycount,
+                )
+
+                if not rc:
+                    sshDrop(transfer, client=client)
+                    retrycount += 1
+                    continue
+
+                LOGGER.debug(
+                    "%s %s: Remote directory '%s' OK",
+                    typeName,
+                    entry[CONF_NAME],
+                    dir_output_remote,
+                )
+
+                # The zstd dictionaries go first, a restore needs them
+                if not sendDictionaries(
+                    typeName,
+                    entry,
+                    client,
+                    dir_output_remote,
+                    remotehost,
+                    retrycount,
+                ):
+                    sshDrop(transfer, client=client)
+                    retrycount += 1
+                    continue
+
+                # Unchanged, a hardlink to the last archive on the host too. Not
+                # for a run again the same day, the file there may be partial
+                if reference not in [None, f"{dir_output}/{file_name}"] and all(
+                    linkRemote(
+                        client,
+                        f"{dir_output_remote}/{os.path.basename(reference)}{suffix}",
+                        f"{dir_output_remote}/{file_name}{suffix}",
+                        remotehost,
+                    )
+                    for suffix in suffixes
+                ):
+                    ReportTime(typeName, entry[CONF_NAME], f"link {remotehost}", 0, 0)
+                    LOGGER.debug(
+                        "%s %s: Remote hardlink '%s' OK",
+                        typeName,
+                        entry[CONF_NAME],
+                        f"{dir_output_remote}/{file_name}",
+                    )
+                    break
+
+                # Current time
+                now = datetime.datetime.now()
+
+                # Volumes in parallel, a retry only sends the missing ones
+                if volumes:
+                    fsize = sendVolumes(
+                        typeName,
+                        entry,
+                        transfer,
+                        f"{dir_output}/{file_name}",
+                        dir_output_remote,
+                        volumes,
+                        retrylast,
+                        retrycount,
+                    )
+                    if fsize is None:
+                        sshDrop(transfer, client=client)
+                        retrycount += 1
+                        continue
+
+                    diff = (datetime.datetime.now() - now).total_seconds()
+                    ReportTime(
+                        typeName, entry[CONF_NAME], f"scp {remotehost}", diff, fsize
+                    )
+                    LOGGER.debug(
+                        "%s %s: SCP '%s' OK in %d volumes (%d seconds, %s)",
+                        typeName,
+                        entry[CONF_NAME],
+                        f"{dir_output}/{file_name}",
+                        len(volumes),
+                        diff,
+                        sizeUnit(fsize),
+                    )
+                    break
+
+                # scp it to the backup node
+                rc = remoteSCP(
+                    client,
+                    f"{dir_output}/{file_name}",
+                    dir_output_remote,
+                    remotehost=remotehost,
+                    retrylast=retrylast,
+                    retrycount=retrycount,
+                )
+
+                if not rc:
+                    sshDrop(transfer, client=client)
+                    retrycount += 1
+                    continue
+
+                # Calculate how many seconds it took us to SCP
+                later = datetime.datetime.now()
+                diff = (later - now).total_seconds()
+                fsize = os.stat(f"{dir_output}/{file_name}").st_size
+                ReportTime(typeName, entry[CONF_NAME], f"scp {remotehost}", diff, fsize)
+                fsize = round(fsize / 1024, 1)
+                unit = "kByte"
+
+                # Change to MByte if needed
+                if fsize > 1000:
+                    fsize = round(fsize / 1024, 1)
+                    unit = "MByte"
+
+                LOGGER.debug(
+                    "%s %s: SCP '%s' OK (%d seconds, %d %s)",
+                    typeName,
+                    entry[CONF_NAME],
+                    f"{dir_output}/{file_name}",
+                    diff,
+                    fsize,
+                    unit,
+                )
+
+                # check the backup node, if the file is correct. For now, just a ls -l
+                cmd = f"ls -l {dir_output_remote}/{file_name}"
+                rc, stdout = remoteSSH(client, cmd, remotehost=remotehost)
+                if not rc:
+                    sshDrop(transfer, client=client)
+                    retrycount += 1
+                    continue
+
+                LOGGER.debug(
+                    "%s %s: Remote file '%s' OK",
+                    typeName,
+                    entry[CONF_NAME],
+                    f"{dir_output_remote}/{file_name}",
+                )
+
+                # All successfull
+                break
+
+            if retrycount <= transfer[CONF_RETRY]:
+                journal(
+                    typeName,
+                    entry[CONF_NAME],
+                    JOURNAL_TRANSFER,
+                    remotehost,
+                    f"{dir_output}/{file_name}",
+                )
+
+            # We get the following exception if SSH keys haven't been exchanged:
+            # paramiko.ssh_exception.SSHException
+
+    # Make it possible to restart scp/copy if it previously failed?
+
+
+#################################################################
+def entryDue(entry, when=None):
+    """Check if the entry should run. Normally (cron) this is per weekday, the
+       daemon passes the minute and uses the schedule of the entry. Without a
+       schedule the default schedule and the weekday list are used."""
+
+    if when is None:
+        return datetime.datetime.today().isoweekday() in entry[CONF_WEEKDAY]
+
+    if entry[CONF_SCHEDULE]:
+        return cronMatch(entry[CONF_SCHEDULE], when)
+
+    return (
+        cronMatch(config[CONF_CONFIG][CONF_SCHEDULE], when)
+        and when.isoweekday() in entry[CONF_WEEKDAY]
+    )
+
+
+#################################################################
+def doBackupType(typeName, when=None):
+    """We go through our entries, and return the ones to execute.
+       Config is available as read-only global var."""
+
+    todo = []
+
+    # We could be fully disabled
+    if config[CONF_CONFIG][typeName]:
+        for entry in config[typeName]:
+
+            # If we are in test mode, we need to do something else
+            if args.get("mode", "") == "backup":
+                if args[CONF_TYPE] == typeName and args[CONF_NAME] == entry[CONF_NAME]:
+                    LOGGER.debug(
+                        "Running backup test on %s '%s'", typeName, entry[CONF_NAME]
+                    )
+                    todo.append((typeName, entry))
+            else:
+
+                # If it is disabled, we skip it
+                if not entry[CONF_ENABLED]:
+                    LOGGER.debug("%s '%s' is not enabled", typeName, entry[CONF_NAME])
+                    continue
+
+                if args.get("mode", "") == "run_host":
+                    if entry[CONF_RUN_HOST] and hostname not in entry[CONF_RUN_HOST]:
+                        print(f"{typeName} {entry[CONF_NAME]} is DISABLED on this host")
+                    else:
+                        print(f"{typeName} {entry[CONF_NAME]} is enabled on this host")
+                    continue
+
+                if entry[CONF_RUN_HOST] and hostname not in entry[CONF_RUN_HOST]:
+                    LOGGER.debug(
+                        "%s '%s' is not enabled on this run_host '%s'='%s'",
+                        typeName,
+                        entry[CONF_NAME],
+                        entry[CONF_RUN_HOST],
+                        hostname,
+                    )
+                    continue
+
+                # Check if we should execute today (or now, in daemon mode) or not
+                if not entryDue(entry, when):
+                    if when is None:
+                        LOGGER.debug(
+                            "%s '%s' should not run today", typeName, entry[CONF_NAME]
+                        )
+                    continue
+
+                todo.append((typeName, entry))
+
+    else:
+        LOGGER.debug("%s backup is fully disabled", typeName)
+
+    return todo
+
+
+#################################################################
+def compressionRate(typeName, entry, level):
+    """Input bytes/s of an app archive at the level, from the catalog. A
+       level without history is derived from another level of the entry
+       (or of any entry), with the relative speed of the levels."""
+
+    for where, parameters in [
+        ("type = ? AND name = ?", (typeName, entry[CONF_NAME])),
+        ("type = ?", (typeName,)),
+    ]:
+        rows = catalogExecute(
+            "SELECT level, SUM(input_size), SUM(seconds) FROM ("
+            f" SELECT * FROM compression WHERE {where}"
+            f" ORDER BY date DESC LIMIT {LEVEL_HISTORY}) GROUP BY level",
+            parameters,
+        )
+        rates = {row[0]: row[1] / row[2] for row in rows if row[1] and row[2]}
+
+        if level in rates:
+            return rates[level]
+
+        # The nearest level we know
+        if rates:
+            known = min(rates, key=lambda x: abs(x - level))
+            return rates[known] * LEVEL_SPEED[level] / LEVEL_SPEED[known]
+
+    return LEVEL_RATE * LEVEL_SPEED[level]
+
+
+#################################################################
+def planDeadline(todo):
+    """Start the deadline of this run. Per entry we need the input size
+       (app) or the seconds of the last dump (db), to plan the levels."""
+    global DEADLINE
+
+    PLAN.clear()
+    DEADLINE = None
+
+    if not config[CONF_CONFIG][CONF_DEADLINE]:
+        return
+
+    DEADLINE = time.monotonic() + config[CONF_CONFIG][CONF_DEADLINE] * 60
+
+    for typeName, entry in todo:
+        if typeName == CONF_APP:
+            PLAN.append((typeName, entry, inputSize(typeName, entry)))
+        else:
+            rows = catalogExecute(
+                "SELECT seconds FROM artifact WHERE type = ? AND name = ?"
+                " ORDER BY date DESC LIMIT 1",
+                (typeName, entry[CONF_NAME]),
+            )
+            PLAN.append((typeName, entry, rows[0][0] if rows else 0))
+
+
+#################################################################
+def chooseLevel(typeName, entry):
+    """The strongest level with which this and the following entries still
+       fit in the deadline. Returns the level, the input size and the
+       seconds for this entry (0 and None without a deadline)."""
+
+    if DEADLINE is None:
+        return LEVEL_MAX, 0, None
+
+    left = DEADLINE - time.monotonic()
+
+    # Concurrent entries (config workers), the rest of the plan is shared by
+    # the workers: as many worker-seconds as workers
+    workers = config[CONF_CONFIG][CONF_WORKERS]
+    capacity = left * workers
+
+    # The dumps take the time they take
+    fixed = sum(size for planType, planEntry, size in PLAN if planType != CONF_APP)
+    apps = [
+        (planEntry, size) for planType, planEntry, size in PLAN if planType == CONF_APP
+    ]
+    size = next((size for planEntry, size in apps if planEntry is entry), 0)
+
+    for level in range(LEVEL_MAX, 0, -1):
+        need = [
+            planSize / compressionRate(CONF_APP, planEntry, level)
+            for planEntry, planSize in apps
+        ]
+        if fixed + sum(need) <= capacity:
+            break
+
+    # This entry gets its share of what is left, one worker does it
+    seconds = max(capacity - fixed, 0) * (
+        (size / compressionRate(typeName, entry, level)) / sum(need) if sum(need) else 1
+    )
+    seconds = min(seconds, left)
+
+    LOGGER.info(
+        "%s %s: Level %d, %s in %d seconds (%d seconds left, %d seconds needed)",
+        typeName,
+        entry[CONF_NAME],
+        level,
+        sizeUnit(size),
+        seconds,
+        left,
+        (fixed + sum(need)) / workers,
+    )
+
+    if fixed + sum(need) > capacity:
+        LOGGER.warning(
+            "%s %s: Behind the deadline, even with level %d",
+            typeName,
+            entry[CONF_NAME],
+            level,
+        )
+
+    return level, size, seconds
+
+
+#################################################################
+class Pacer:
+    """Measure the throughput per level of an archive for the catalog.
+       With a time budget, step down a level when the archive would not
+       be ready in time at the current pace."""
+
+    def __init__(self, typeName, entry, output, level, size, seconds=None):
+        self.typeName = typeName
+        self.entry = entry
+        self.output = output
+        self.level = level
+        self.size = size
+        self.start = time.monotonic()
+        self.end = self.start + seconds if seconds is not None else None
+        self.done = 0
+        self.segment = (self.start, 0)
+        self.segments = []
+        self.next = PACE_BYTES
+
+    def check(self, size):
+        self.done += size
+        if self.end is None or self.level <= 1 or self.done < self.next:
+            return
+
+        self.next = self.done + PACE_BYTES
+
+        now = time.monotonic()
+        seconds = now - self.segment[0]
+        if seconds <= 0:
+            return
+
+        rate = (self.done - self.segment[1]) / seconds
+        ready = now + max(self.size - self.done, 0) / rate
+        if ready <= self.end:
+            return
+
+        self._segment(now)
+        self.level -= 1
+        self.output.setLevel(self.level)
+
+        LOGGER.info(
+            "%s %s: Behind (ready in %d seconds, %d left), level %d after %s",
+            self.typeName,
+            self.entry[CONF_NAME],
+            ready - now,
+            self.end - now,
+            self.level,
+            sizeUnit(self.done),
+        )
+
+    def _segment(self, now):
+        self.segments.append(
+            (self.level, self.done - self.segment[1], now - self.segment[0])
+        )
+        self.segment = (now, self.done)
+
+    def finish(self):
+        """Keep the throughput per level in the catalog."""
+        self._segment(time.monotonic())
+        for level, size, seconds in self.segments:
+            if size:
+                catalogExecute(
+                    "INSERT INTO compression VALUES (?, ?, ?, ?, ?, ?)",
+                    (
+                        datetime.datetime.now().isoformat(),
+                        self.typeName,
+                        self.entry[CONF_NAME],
+                        level,
+                        size,
+                        seconds,
+                    ),
+                )
+
+
+#################################################################
+def expectedDuration(typeName, entry):
+    """Seconds the entry took, on average over its last runs. None if it
+       never ran."""
+
+    rows = catalogExecute(
+        "SELECT AVG(seconds) FROM (SELECT seconds FROM duration"
+        " WHERE type = ? AND name = ? AND stage = 'total'"
+        f" ORDER BY date DESC LIMIT {DURATION_HISTORY})",
+        (typeName, entry[CONF_NAME]),
+    )
+    return rows[0][0]
+
+
+#################################################################
+class Progress:
+    """Progress and ETA of a run, from the expected duration of its entries
+       (an entry without history counts as an average one). Shown on the
+       console and in the log after every entry."""
+
+    def __init__(self, todo, workers):
+        expected = {id(entry): expectedDuration(t, entry) for t, entry in todo}
+        known = [seconds for seconds in expected.values() if seconds is not None]
+        average = sum(known) / len(known) if known else 60
+
+        self.expected = {
+            key: average if seconds is None else seconds
+            for key, seconds in expected.items()
+        }
+        self.total = sum(self.expected.values()) or 1
+        self.workers = workers
+        self.count = len(todo)
+        self.finished = 0
+        self.work = 0
+        self.start = time.monotonic()
+        self.lock = threading.Lock()
+
+        LOGGER.info(
+            "Run of %d entries, expected %s with %d worker(s)",
+            self.count,
+            datetime.timedelta(seconds=round(self.total / workers)),
+            workers,
+        )
+
+    def done(self, typeName, entry):
+        with self.lock:
+            self.finished += 1
+            self.work += self.expected[id(entry)]
+            elapsed = time.monotonic() - self.start
+
+            # The pace so far says how long the rest takes
+            fraction = min(self.work / self.total, 1)
+            eta = elapsed / fraction - elapsed if fraction else 0
+
+            msg = "Progress %d/%d entries (%d%%), %s %s done, ETA %s (%s)" % (
+                self.finished,
+                self.count,
+                fraction * 100,
+                typeName,
+                entry[CONF_NAME],
+                datetime.timedelta(seconds=round(eta)),
+                (datetime.datetime.now() + datetime.timedelta(seconds=eta)).strftime(
+                    "%H:%M"
+                ),
+            )
+
+        LOGGER.info(msg)
+        if sys.stdout.isatty():
+            print(f"INFO: {msg}")
+
+
+#################################################################
+def doBackup(when=None):
+    """Backup our app/db/other entries, after a preflight of the disk space."""
+    global JOURNAL_RUN
+
+    todo = doBackupType(CONF_APP, when)
+    todo += doBackupType(CONF_DB, when)
+    todo += doBackupType(CONF_OTHER, when)
+
+    # Everything is open in the journal, till it is done
+    if todo:
+        JOURNAL_RUN = datetime.date.today().strftime("%Y%m%d")
+    for typeName, entry in todo:
+        journal(typeName, entry[CONF_NAME], JOURNAL_BACKUP, done=False)
+
+        # A run earlier today did the transfers of the artifact we replace
+        catalogExecute(
+            "DELETE FROM journal WHERE run = ? AND type = ? AND name = ? AND stage = ?",
+            (JOURNAL_RUN, typeName, entry[CONF_NAME], JOURNAL_TRANSFER),
+        )
+
+    todo = preflight(todo)
+    planDeadline(todo)
+
+    if not todo:
+        return
+
+    workers = config[CONF_CONFIG][CONF_WORKERS]
+    progress = Progress(todo, workers)
+
+    # Concurrent, the longest first: a short entry never keeps a worker
+    # busy at the end of the run while the long one still has to start
+    if workers > 1:
+        todo = sorted(
+            todo, key=lambda item: progress.expected[id(item[1])], reverse=True
+        )
+
+    def run(item):
+        typeName, entry = item
+        doBackupWrapper(typeName, entry)
+
+        # The deadline plans for the entries still to do
+        PLAN[:] = [plan for plan in PLAN if plan[1] is not entry]
+        progress.done(typeName, entry)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        list(pool.map(run, todo))
+
+
+#################################################################
+def doResume():
+    """Redo the stages of the last run which did not complete, e.g. after a
+       reboot halfway. An entry without an artifact is backed up again, an
+       artifact missing on a backup host is only transferred again."""
+    global JOURNAL_RUN
+
+    JOURNAL_RUN = catalogExecute("SELECT MAX(run) FROM journal")[0][0]
+    if JOURNAL_RUN is None:
+        LOGGER.info("Resume: there is no run in the journal")
+        return
+
+    stages = collections.defaultdict(dict)
+    for typeName, name, stage, host, file_name, done in catalogExecute(
+        "SELECT type, name, stage, host, file_name, done FROM journal"
+        " WHERE run = ? ORDER BY date",
+        (JOURNAL_RUN,),
+    ):
+        stages[(typeName, name)][(stage, host)] = (file_name, done)
+
+    hosts = [
+        transfer[CONF_HOST]
+        for transfer in config[CONF_CONFIG][CONF_TRANSFER]
+        if not transfer[CONF_RUN_HOST] or hostname in transfer[CONF_RUN_HOST]
+    ]
+
+    LOGGER.info("Resume run %s, %d entries", JOURNAL_RUN, len(stages))
+
+    for (typeName, name), stage in stages.items():
+        entry = next(
+            (entry for entry in config[typeName] if entry[CONF_NAME] == name), None
+        )
+        if entry is None:
+            LOGGER.warning("%s %s: Not in the config anymore, no resume", typeName, name)
+            continue
+
+        file_name, done = stage.get((JOURNAL_BACKUP, ""), ("", 0))
+        if not done:
+            LOGGER.info("%s %s: Resume, backup again", typeName, name)
+            doBackupWrapper(typeName, entry)
+            continue
+
+        pending = [
+            host for host in hosts if not stage.get((JOURNAL_TRANSFER, host), ("", 0))[1]
+        ]
+        if not pending:
+            LOGGER.debug("%s %s: Resume, nothing to do", typeName, name)
+            continue
+
+        if not os.path.isfile(file_name):
+            errmsg = f"{typeName} {name}: Resume cannot find '{file_name}'"
+            ErrorMsg(errmsg)
+            LOGGER.error(errmsg)
+            continue
+
+        LOGGER.info(
+            "%s %s: Resume, transfer '%s' to %s", typeName, name, file_name, pending
+        )
+        try:
+            _doTransfer(
+                typeName,
+                entry,
+                os.path.basename(file_name),
+                catalogVolumes(file_name),
+                done=set(hosts) - set(pending),
+            )
+        except Exception as e:
+            errmsg = f"Failure resume {typeName} {name}. Exception={type(e).__name__} Msg={e}"
+            ErrorMsg(errmsg)
+            LOGGER.error(
+                errmsg, exc_info=True,
+            )
+
+
+"""
+# Backup policy:
+# - Keep the last 7 days
+# - Keep the Sunday (7) of the last 2 months
+# - Keep the first Sunday of each month of the last 12 months
+"""
+
+#################################################################
+def findRestoreFile(typeName, entry, host=None):
+    """Find the newest backup file of an entry, locally or on a remote
+       backup host. Returns the filename and the SSH client (or None)."""
+
+    client = None
+
+    # Erasure coded, "client" are the shards on the hosts
+    if host == CONF_SHARDS:
+        return findShards(typeName, entry)
+
+    if host:
+        dir_input = f"{config[CONF_CONFIG][CONF_DIR][CONF_REMOTE]}/{typeName}/{entry[CONF_NAME]}"
+
+        client = sshClient(findTransfer(host))
+        rc, stdout = remoteSSH(
+            client, f"ls -1 {dir_input}/{entry[CONF_NAME]}.????????-?.*"
+        )
+        lof = [line.strip() for line in stdout]
+    else:
+        dir_input = f"{config[CONF_CONFIG][CONF_DIR][CONF_LOCAL]}/{typeName}/{entry[CONF_NAME]}"
+        lof = filter(
+            os.path.isfile, glob.glob(f"{dir_input}/{entry[CONF_NAME]}.????????-?.*"),
         )
-        # Create out tgz file
-        try:
-            with tarfile.open(f"{dir_temp}/{file_name}", mode="w:gz") as archive:
-                # Add ".", to preserve parent directory right/permissions
-                archive.add(".", recursive=False)
 
-                for name in os.listdir("."):
-                    archive.add(name, recursive=True, filter=excludeFromTar)
-        except Exception as e:
-            errmsg = f"{typeName} {entry[CONF_NAME]}: Failure during creation '{dir_temp}/{file_name}'. Exception={type(e).__name__} Msg={e}"
-            ErrorMsg(errmsg)
-            LOGGER.error(
-                errmsg, exc_info=True,
-            )
+    # The volumes of a file count as the file, a shard is no backup on its
+    # own (see findShards)
+    lof = sorted(
+        {
+            re.sub(VOLUME_PATTERN, "", name)
+            for name in lof
+            if not re.search(SHARD_PATTERN, name)
+        }
+    )
 
-            return
+    # We must find 1 or more filename
+    if len(lof) == 0:
+        errmsg = f"Cannot find file in directory '{dir_input}' with '{entry[CONF_NAME]}.????????-?.*'"
+        LOGGER.error(errmsg)
+        return None, client
 
-        # Calculate how many seconds it took us to SCP
-        later = datetime.datetime.now()
-        diff = (later - now).total_seconds()
-        fsize = os.stat(f"{dir_temp}/{file_name}").st_size
-        fsize = round(fsize / 1024, 1)
-        unit = "kByte"
+    return lof[-1], client
 
-        # Change to MByte if needed
-        if fsize > 1000:
-            fsize = round(fsize / 1024, 1)
-            unit = "MByte"
 
-        LOGGER.debug(
-            "%s %s: Created '%s' from '%s' (%d seconds, %d %s)",
-            typeName,
-            entry[CONF_NAME],
-            file_name,
-            dir_input,
-            diff,
-            fsize,
-            unit,
+#################################################################
+class ChainReader:
+    """Read-only file of the volumes one after the other."""
+
+    def __init__(self, names):
+        self.names = collections.deque(names)
+        self.fileobj = open(self.names.popleft(), "rb")
+
+    def read(self, size=-1):
+        while True:
+            data = self.fileobj.read(size)
+            if data or not self.names:
+                return data
+
+            self.fileobj.close()
+            self.fileobj = open(self.names.popleft(), "rb")
+
+    def close(self):
+        self.fileobj.close()
+
+
+#################################################################
+def readExact(fileobj, size):
+    """Read size bytes, less only at the end of the file."""
+
+    data = b""
+    while len(data) < size:
+        chunk = fileobj.read(size - len(data))
+        if not chunk:
+            break
+        data += chunk
+
+    return data
+
+
+#################################################################
+class ShardReader:
+    """Read-only file of the artifact, decoded from k of its shards. The
+       blocks of a stripe are read from the shards (hosts) in parallel."""
+
+    def __init__(self, streams, indices, k, m, size, block):
+        self.streams = streams
+        self.block = block
+        self.left = size
+        self.buffer = b""
+
+        # With all data shards there is nothing to decode
+        rows = rsMatrix(k, m)
+        self.decode = None
+        if indices != list(range(k)):
+            self.decode = gfInvert([rows[index] for index in indices])
+
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=k)
+
+    def stripe(self):
+        pieces = list(
+            self.pool.map(lambda stream: readExact(stream, self.block), self.streams)
         )
+        if any(len(piece) != self.block for piece in pieces):
+            raise EOFError("Shard is truncated")
 
-        # We should start the container asap
-        if entry[CONF_STOPDOCKER]:
-            startDocker(type, entry[CONF_NAME])
+        if self.decode is not None:
+            pieces = [gfCombine(row, pieces) for row in self.decode]
 
-    else:
-        if entry[CONF_TYPE] == CONF_TYPE_MYSQL:
-            cmd = DB_MYSQL.format(
-                container=entry[CONF_CONTAINER],
-                database=entry[CONF_DBNAME],
-                sqluser=entry[CONF_DBUSER],
-                dir_temp=dir_temp,
-                file_name=file_name,
+        data = b"".join(pieces)[: self.left]
+        self.left -= len(data)
+        return data
+
+    def read(self, size=-1):
+        while self.left and (size < 0 or len(self.buffer) < size):
+            self.buffer += self.stripe()
+
+        if size < 0:
+            size = len(self.buffer)
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    def close(self):
+        self.pool.shutdown()
+
+
+#################################################################
+def findShards(typeName, entry):
+    """Find the newest erasure coded backup on the backup hosts. Returns
+       the file name and its shards [(transfer, file name)]."""
+
+    dir_input = (
+        f"{config[CONF_CONFIG][CONF_DIR][CONF_REMOTE]}/{typeName}/{entry[CONF_NAME]}"
+    )
+    found = collections.defaultdict(list)
+
+    for transfer in config[CONF_CONFIG][CONF_TRANSFER]:
+        try:
+            rc, stdout = remoteSSH(
+                sshClient(transfer),
+                f"ls -1 {dir_input}/{entry[CONF_NAME]}.????????-?.*.rs?? 2>/dev/null; true",
+                remotehost=transfer[CONF_HOST],
             )
-        elif entry[CONF_TYPE] == CONF_TYPE_POSTGRESQL:
-            cmd = DB_POSTGRESQL.format(
-                container=entry[CONF_CONTAINER],
-                database=entry[CONF_DBNAME],
-                sqluser=entry[CONF_DBUSER],
-                dir_temp=dir_temp,
-                file_name=file_name,
+        except Exception as e:
+            LOGGER.warning(
+                "Cannot list the shards on '%s'. Exception=%s Msg=%s",
+                transfer[CONF_HOST],
+                type(e).__name__,
+                e,
             )
-        elif entry[CONF_TYPE] == CONF_TYPE_INFLUXDB_BACKUP:
-            cmd = DB_INFLUXDB_BACKUP.format(
-                container=entry[CONF_CONTAINER], file_name=file_name
+            continue
+
+        for line in stdout:
+            found[re.sub(SHARD_PATTERN, "", line.strip())].append(
+                (transfer, line.strip())
             )
-        elif entry[CONF_TYPE] == CONF_TYPE_INFLUXDB_EXPORT:
-            cmd = DB_INFLUXDB_EXPORT.format(
-                container=entry[CONF_CONTAINER], database=entry[CONF_DBNAME]
+
+    if not found:
+        LOGGER.error("Cannot find shards in directory '%s' on any host", dir_input)
+        return None, None
+
+    file_name = max(found)
+    return file_name, found[file_name]
+
+
+#################################################################
+def openShards(shards):
+    """Start reading the shards, concurrently. The first k (by index, so
+       data shards first) are used. Returns the reader and their stdouts."""
+
+    def start(shard):
+        transfer, name = shard
+        try:
+            client = sshClient(transfer)
+            stdin, stdout, stderr = client.exec_command(f"cat {name}")
+            header = SHARD_HEADER.unpack(readExact(stdout, SHARD_HEADER.size))
+            if header[0] != SHARD_MAGIC:
+                raise ValueError("Not a shard")
+            return header[1:], stdout
+        except Exception as e:
+            LOGGER.warning(
+                "Shard '%s' on '%s' cannot be read. Exception=%s Msg=%s",
+                name,
+                transfer[CONF_HOST],
+                type(e).__name__,
+                e,
             )
+            return None
 
-        LOGGER.debug("%s %s: Executing '%s'", typeName, entry[CONF_NAME], cmd)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(shards)) as pool:
+        started = sorted(
+            (shard for shard in pool.map(start, shards) if shard),
+            key=lambda shard: shard[0][2],
+        )
 
-        rc = os.system(cmd)
-        if rc == 0:
-            # Calculate how many seconds it took us to execute the command
-            later = datetime.datetime.now()
-            diff = (later - now).total_seconds()
+    # The same shard twice (e.g. a copy on another host) is no help
+    for position in range(len(started) - 1, 0, -1):
+        if started[position][0][2] == started[position - 1][0][2]:
+            started.pop(position)[1].channel.close()
+
+    k, m, index, size, block = started[0][0] if started else (1, 0, 0, 0, 0)
+    if len(started) < k:
+        raise EOFError(f"{len(started)} shard(s) found, {k} are needed")
+
+    # The shards we do not need
+    for header, stdout in started[k:]:
+        stdout.channel.close()
+
+    started = started[:k]
+    LOGGER.debug("Restore from shards %s of %d+%d", [header[2] for header, stdout in started], k, m)
+
+    reader = ShardReader(
+        [stdout for header, stdout in started],
+        [header[2] for header, stdout in started],
+        k,
+        m,
+        size,
+        block,
+    )
+    return ProgressReader(reader, size), [stdout for header, stdout in started]
 
-            # Need to use the right DB stuff
-            if entry[CONF_TYPE] in [CONF_TYPE_MYSQL, CONF_TYPE_POSTGRESQL]:
-                fsize = os.stat(f"{dir_temp}/{file_name}").st_size
-            elif entry[CONF_TYPE] == CONF_TYPE_INFLUXDB_BACKUP:
-                fsize = os.stat(f"{dir_input}/backup/{file_name}").st_size
-            elif entry[CONF_TYPE] == CONF_TYPE_INFLUXDB_EXPORT:
-                fsize = os.stat(f"{dir_input}/backup/influx-export.gz").st_size
 
-            fsize = round(fsize / 1024, 1)
-            unit = "kByte"
+#################################################################
+def restoreVolumes(file_name, client=None):
+    """The files to read for a backup file, in order: the file itself, or
+       its volumes. The catalog knows how many volumes there should be."""
 
-            # Change to MByte if needed
-            if fsize > 1000:
-                fsize = round(fsize / 1024, 1)
-                unit = "MByte"
+    if client is None:
+        found = [file_name] if os.path.isfile(file_name) else []
+        found += glob.glob(f"{glob.escape(file_name)}.v[0-9][0-9][0-9]")
+    else:
+        rc, stdout = remoteSSH(
+            client, f"ls -1 {file_name} {file_name}.v[0-9][0-9][0-9] 2>/dev/null; true"
+        )
+        found = [line.strip() for line in stdout]
 
-            LOGGER.debug(
-                "%s %s: Execution is successful (%d seconds, %d %s)",
-                typeName,
-                entry[CONF_NAME],
-                diff,
-                fsize,
-                unit,
-            )
+    if file_name in found:
+        return [file_name]
+
+    rows = catalogExecute(
+        "SELECT DISTINCT volume FROM volume WHERE file_name LIKE ? ORDER BY volume",
+        (f"%/{os.path.basename(file_name)}",),
+    )
+    names = [volumeName(file_name, row[0]) for row in rows] or sorted(found)
+
+    missing = sorted(set(names) - set(found))
+    if missing:
+        LOGGER.error("Volume(s) of '%s' missing: %s", file_name, missing)
+
+    return names or [file_name]
+
+
+#################################################################
+def openRestoreFile(file_name, client=None):
+    """Open the backup file for streaming, with progress. With a SSH client
+       the file is read over the SSH session, there is no local copy. A file
+       in volumes is read volume after volume.
+       Returns the reader and the remote stdout (or None)."""
+
+    if isinstance(client, list):
+        return openShards(client)
+
+    names = restoreVolumes(file_name, client)
+
+    if client is None:
+        size = sum(os.stat(name).st_size for name in names if os.path.isfile(name))
+        return ProgressReader(ChainReader(names), size), None
+
+    rc, stdout = remoteSSH(client, f"stat -c %s {' '.join(names)}")
+    size = sum(int(line) for line in stdout) if rc else 0
+
+    stdin, stdout, stderr = client.exec_command(f"cat {' '.join(names)}")
+    return ProgressReader(stdout, size), stdout
+
+
+#################################################################
+def closeRestoreFile(reader, stdout):
+    """Close the backup file, for a remote file check the RC of the read."""
+
+    if stdout is None:
+        reader.fileobj.close()
+        return True
+
+    # Shards, every read must be OK
+    if isinstance(stdout, list):
+        reader.fileobj.close()
+        return all([closeRestoreFile(reader, part) for part in stdout])
+
+    rc = stdout.channel.recv_exit_status()
+    if rc != 0:
+        errmsg = f"Reading backup file over SSH failed, RC={rc}"
+        ErrorMsg(errmsg)
+        LOGGER.error(errmsg)
+        return False
+
+    return True
+
+
+#################################################################
+def _execStream(container, cmd, reader, label):
+    """Execute the command in the container and stream the reader into its
+       stdin, in fixed size chunks so memory stays bounded. Returns the RC."""
+
+    import docker
+
+    client = docker.from_env()
+
+    execid = client.api.exec_create(
+        container, ["sh", "-c", cmd], stdin=True, stdout=True, stderr=True
+    )["Id"]
+    sock = client.api.exec_start(execid, socket=True)
+    sock = getattr(sock, "_sock", sock)
+
+    # The client output must be read while we write, otherwise a chatty
+    # client (e.g. psql) blocks. We only keep the tail of it for the log
+    output = collections.deque(maxlen=64)
+
+    def drain():
+        while True:
+            data = sock.recv(RESTORE_CHUNK)
+            if not data:
+                break
+            output.append(data)
+
+    thread = threading.Thread(target=drain, daemon=True)
+    thread.start()
+
+    now = datetime.datetime.now()
+    count = 0
+
+    try:
+        while True:
+            chunk = reader.read(RESTORE_CHUNK)
+            if not chunk:
+                break
+            sock.sendall(chunk)
+            count += len(chunk)
+    finally:
+        # Signal end-of-file to the client in the container
+        sock.shutdown(socket.SHUT_WR)
+
+    thread.join()
+    sock.close()
+
+    # The output ends before the process, till then there is no exit code
+    inspect = client.api.exec_inspect(execid)
+    while inspect["Running"]:
+        time.sleep(EXEC_POLL)
+        inspect = client.api.exec_inspect(execid)
+    rc = inspect["ExitCode"]
+    diff = (datetime.datetime.now() - now).total_seconds()
+
+    LOGGER.info(
+        "%s: Streamed %s into '%s' (%d seconds, %s/s) RC=%s",
+        label,
+        sizeUnit(count),
+        container,
+        diff,
+        sizeUnit(count / diff if diff > 0 else 0),
+        rc,
+    )
+
+    if rc != 0:
+        # Output is multiplexed with 8 byte headers, good enough for the log
+        for line in b"".join(output).decode(errors="replace").splitlines()[-10:]:
+            LOGGER.error("%s: OUTPUT: %s", label, line.rstrip())
+
+    client.close()
+    return rc
+
+
+#################################################################
+def _execCommand(container, cmd, label):
+    """Execute the command in the container, without stdin. Returns the RC."""
+
+    import docker
+
+    client = docker.from_env()
+    rc, output = client.containers.get(container).exec_run(["sh", "-c", cmd])
+    client.close()
+
+    if rc != 0:
+        for line in output.decode(errors="replace").splitlines()[-10:]:
+            LOGGER.error("%s: OUTPUT: %s", label, line.rstrip())
+
+    return rc
+
+
+#################################################################
+def _restoreDb(entry, dump, container=None):
+    """Restore the dump into the database container. The dump is streamed
+       (decompressed, see openDecompressed()) into the client in the
+       container."""
+
+    label = f"{CONF_DB} {entry[CONF_NAME]}"
+
+    # We can restore into a different container, e.g. a test one
+    container = container or entry[CONF_CONTAINER] or entry[CONF_NAME]
+
+    if entry[CONF_TYPE] == CONF_TYPE_MYSQL:
+        cmd = RESTORE_MYSQL
+    elif entry[CONF_TYPE] == CONF_TYPE_POSTGRESQL:
+        cmd = RESTORE_POSTGRESQL.format(sqluser=entry[CONF_DBUSER] or "postgres")
+    elif entry[CONF_TYPE] == CONF_TYPE_INFLUXDB_BACKUP:
+        # The backup is a tar of the portable backup, unpack it in the container first
+        cmd = RESTORE_INFLUXDB_BACKUP_UNPACK
+    elif entry[CONF_TYPE] == CONF_TYPE_INFLUXDB_EXPORT:
+        cmd = RESTORE_INFLUXDB_EXPORT
+
+    LOGGER.info("%s: Restoring into '%s' with '%s'", label, container, cmd)
+
+    rc = _execStream(container, cmd, dump, label)
+    if rc != 0:
+        errmsg = f"{label}: Restore failed, RC={rc}, CMD={cmd}"
+        ErrorMsg(errmsg)
+        LOGGER.error(errmsg)
+        return False
+
+    if entry[CONF_TYPE] == CONF_TYPE_INFLUXDB_BACKUP:
+        if entry[CONF_DBNAME]:
+            cmd = RESTORE_INFLUXDB_BACKUP_DB.format(database=entry[CONF_DBNAME])
         else:
-            errmsg = f"{typeName} {entry[CONF_NAME]}: Execution error '{entry[CONF_TYPE]}' RC={int(rc/256)}, CMD={cmd}"
+            cmd = RESTORE_INFLUXDB_BACKUP
+        LOGGER.info("%s: Executing '%s'", label, cmd)
+
+        rc = _execCommand(container, cmd, label)
+        if rc != 0:
+            errmsg = f"{label}: Restore failed, RC={rc}, CMD={cmd}"
+            if not entry[CONF_DBNAME]:
+                errmsg += " (all databases, drop the existing ones first)"
             ErrorMsg(errmsg)
             LOGGER.error(errmsg)
-            return
+            return False
 
-        # Special for InfluxDB, because we need to rename in-container "/backup/influx*gz" to our output filename
-        if entry[CONF_TYPE] == CONF_TYPE_INFLUXDB_BACKUP:
-            file_input = f"{dir_input}/backup/{file_name}"
+    return True
 
-            # file must exist
-            if not os.path.isfile(file_input):
-                errmsg = f"{typeName} {entry[CONF_NAME]}: Executed InfluxDB backup, but '{file_input}' does not exist?"
-                ErrorMsg(errmsg)
-                LOGGER.error(errmsg)
-                return
 
-            shutil.move(file_input, f"{dir_output}/{file_name}")
-            LOGGER.debug(
-                "%s %s: Moved '%s' to '%s'",
-                typeName,
-                entry[CONF_NAME],
-                file_input,
-                dir_output,
-            )
+#################################################################
+def doRestoreType():
+    """Restore a specific app/db/other to this node from the backup directory."""
 
-            # Set already moved, because it is inside the container, not in the temp directory
-            alreadymoved = True
+    found = False
+    entryFound = {}
 
-        elif entry[CONF_TYPE] == CONF_TYPE_INFLUXDB_EXPORT:
+    for entry in config[args[CONF_TYPE]]:
+        if args[CONF_NAME] == entry[CONF_NAME]:
+            entryFound = entry
+            found = True
+            break
 
-            file_input = f"{dir_input}/backup/influx-export.gz"
+    if not found:
+        print(f"ERROR: Cannot find name '{args[CONF_NAME]}' in '{args[CONF_TYPE]}'")
+        return
 
-            # file must exist
-            if not os.path.isfile(file_input):
-                errmsg = f"{typeName} {entry[CONF_NAME]}: Executed InfluxDB export, but '{file_input}' does not exist?"
-                ErrorMsg(errmsg)
-                LOGGER.error(errmsg)
-                return
+    # The output directory is the input directory of the backup
+    dir_output = dirInput(entry)
 
-            shutil.move(file_input, f"{dir_output}/{file_name}")
-            LOGGER.debug(
-                "%s %s: Moved '%s' to '%s'",
-                typeName,
-                entry[CONF_NAME],
-                file_input,
-                f"{dir_output}/{file_name}",
-            )
+    # Check if output directory exists, we should not overwrite. A database
+    # is restored into its running container instead
+    if args[CONF_TYPE] != CONF_DB and os.path.isdir(dir_output):
+        sys.exit(
+            f"ERROR: Output directory '{dir_output}' already exists, please remove it manually first"
+        )
 
-            # Set already moved, because it is inside the container, not in the temp directory
-            alreadymoved = True
+    # Find file to restore, locally or on a remote backup host
+    file_name, client = findRestoreFile(args[CONF_TYPE], entry, args.get(CONF_FROM))
+    if file_name is None:
+        sys.exit(f"ERROR: Cannot find a backup file of '{entry[CONF_NAME]}', see log")
 
-    # All good, move it to the final directory, for InfluxDB this isn't needed
-    if not alreadymoved:
-        shutil.move(f"{dir_temp}/{file_name}", f"{dir_output}/{file_name}")
-        LOGGER.debug(
-            "%s %s: Moved '%s' to '%s'",
-            typeName,
-            entry[CONF_NAME],
-            f"{dir_temp}/{file_name}",
-            dir_output,
+    if args.get(CONF_FROM):
+        print(f"INFO: Using input file '{args[CONF_FROM]}:{file_name}'")
+    else:
+        print(f"INFO: Using input file '{file_name}'")
+
+    if args[CONF_TYPE] == CONF_DB:
+        print(
+            f"INFO: Using container '{entry[CONF_CONTAINER] or entry[CONF_NAME]}' ({entry[CONF_TYPE]})"
         )
+    else:
+        print(f"INFO: Using output directory '{dir_output}'")
+
+    # Ask if we should continue or not
+    answer = input("Continue [Y/n]")
+    if answer not in ["", "Y", "y"]:
+        sys.exit("INFO: Stopped ...")
+
+    # Stream it straight into the extractor/database, for a remote file
+    # there is no local copy of the archive
+    reader, stdout = openRestoreFile(file_name, client)
+
+    # Decrypt while streaming, this also authenticates every chunk
+    stream = openDecompressed(file_name, openInput(file_name, reader), client)
+
+    # Now it depends on the type
+    if args[CONF_TYPE] in [CONF_APP, CONF_OTHER]:
+        os.mkdir(dir_output)
+        os.chdir(dir_output)
 
-        # *** ONLY works on LOCAL node, not on remote ***
+        print(f"INFO: Created output directory '{dir_output}'")
+        print(f"INFO: Starting extraction ...")
 
-        # Set permissions on output file
-        if config[CONF_CONFIG][CONF_CHOWN]:
-            try:
-                chown = config[CONF_CONFIG][CONF_CHOWN].split(":")
-                chown_uid = chown[0]
-                chown_gid = -1
-                if len(chown) >= 2:
-                    chown_gid = chown[1]
+        with tarfile.open(fileobj=stream, mode="r|") as archive:
+            archive.extractall()
+        # TarFile.extractall(path=".", members=None, *, numeric_owner=False)
 
-                if chown_uid:
-                    os.chown(
-                        f"{dir_output}/{file_name}", int(chown_uid), int(chown_gid)
-                    )
-                    LOGGER.debug(
-                        "%s %s: Chown '%s' with uid=%s and gid=%s",
-                        typeName,
-                        entry[CONF_NAME],
-                        f"{dir_output}/{file_name}",
-                        chown_uid,
-                        chown_gid,
-                    )
+        rc = True
 
-            except Exception as e:
-                errmsg = f"{typeName} {entry[CONF_NAME]}: '{file_name}' FAILED chown. Exception={type(e).__name__} Msg={e}"
-                ErrorMsg(errmsg)
-                LOGGER.error(
-                    errmsg, exc_info=True,
-                )
+    elif args[CONF_TYPE] == CONF_DB:
+        print("INFO: Starting database restore ...")
+        rc = _restoreDb(entry, stream)
+
+    if not closeRestoreFile(reader, stdout) or not rc:
+        sys.exit(f"ERROR: Restore of '{file_name}' failed, see log")
+
+    print(f"INFO: Restored {sizeUnit(reader.count)} ({sizeUnit(reader.rate())}/s)")
+    LOGGER.info(
+        "%s %s: Restored '%s' (%s, %s/s)",
+        args[CONF_TYPE],
+        entry[CONF_NAME],
+        file_name,
+        sizeUnit(reader.count),
+        sizeUnit(reader.rate()),
+    )
 
-        # *** ONLY works on LOCAL node, not on remote ***
 
-    for transfer in config[CONF_CONFIG][CONF_TRANSFER]:
+#################################################################
+def _verifyRestoreContainer(entry, reader):
+    """Load the dump into a throwaway container, started from the same image
+       as the database container. The container is always removed."""
 
-        remotehost = transfer[CONF_HOST]
-        remoteport = transfer[CONF_PORT]
-        remoteuser = transfer[CONF_USER]
+    label = f"{CONF_DB} {entry[CONF_NAME]}"
 
-        # Check if we should run it on this host or not
-        if transfer[CONF_RUN_HOST] and hostname not in transfer[CONF_RUN_HOST]:
-            LOGGER.debug(
-                "%s %s: '%s' is not enabled on this run_host '%s'='%s'",
-                typeName,
-                entry[CONF_NAME],
-                remotehost,
-                transfer[CONF_RUN_HOST],
-                hostname,
-            )
-            continue
+    import docker
 
-        # ping the backup node
-        rc = os.system("ping -w 3 -c 2 " + remotehost + " >/dev/null")
+    client = docker.from_env()
+    image = client.containers.get(entry[CONF_CONTAINER] or entry[CONF_NAME]).attrs[
+        "Config"
+    ]["Image"]
+
+    if entry[CONF_TYPE] == CONF_TYPE_MYSQL:
+        environment = {"MYSQL_ALLOW_EMPTY_PASSWORD": "yes"}
+        ready = "mysql -uroot -e 'SELECT 1'"
+        # Our restore command uses the root defaults file, as in the real container
+        setup = "printf '[client]\\nuser=root\\n' >/var/lib/mysql/.mysql-root.conf"
+    else:
+        environment = {
+            "POSTGRES_HOST_AUTH_METHOD": "trust",
+            "POSTGRES_USER": entry[CONF_DBUSER] or "postgres",
+        }
+        ready = f"pg_isready -U {entry[CONF_DBUSER] or 'postgres'}"
+        setup = "true"
+
+    LOGGER.debug("%s: Starting throwaway container from '%s'", label, image)
+    container = client.containers.run(
+        image,
+        detach=True,
+        environment=environment,
+        name=f"backup-verify-{entry[CONF_NAME]}",
+    )
 
-        if rc != 0:
-            errmsg = f"{typeName} {entry[CONF_NAME]}: Cannot ping host '{remotehost}' RC={int(rc/256)}"
+    try:
+        # Wait till the database accepts connections
+        for count in range(VERIFY_TIMEOUT // 2):
+            rc, output = container.exec_run(["sh", "-c", ready])
+            if rc == 0:
+                break
+            time.sleep(2)
+        else:
+            errmsg = f"{label}: Throwaway container not ready after {VERIFY_TIMEOUT} seconds"
             ErrorMsg(errmsg)
             LOGGER.error(errmsg)
-            continue
+            return False
 
-        LOGGER.debug("%s %s: Ping host '%s' OK", typeName, entry[CONF_NAME], remotehost)
-
-        # make remote directory, possible it does not exist
-        if transfer[CONF_TYPE] == CONF_SCP:
+        container.exec_run(["sh", "-c", setup])
 
-            retrycount = 0
+        return _restoreDb(entry, reader, container=container.name)
 
-            while retrycount <= transfer[CONF_RETRY]:
+    finally:
+        container.remove(force=True)
+        client.close()
+        LOGGER.debug("%s: Removed throwaway container", label)
 
-                retrylast = True if retrycount == transfer[CONF_RETRY] else False
 
-                # LOGGER.debug("%s %s: SCP to '%s:%s' with username '%s'", typeName, entry[CONF_NAME], remotehost, remoteport, remoteuser)
-                client = paramiko.SSHClient()
-                client.load_system_host_keys()
-                # client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+#################################################################
+def _verifyRestore(typeName, entry):
+    """Restore the newest backup into a scratch directory or throwaway
+       container. This checks the backup and measures the restore time."""
 
-                # normally connect will establish a new session. Need to redo it when a failure happens
-                client.connect(
-                    remotehost,
-                    port=remoteport,
-                    username=remoteuser,
-                    auth_timeout=5,
-                    timeout=10,
-                )
+    label = f"{typeName} {entry[CONF_NAME]}"
 
-                LOGGER.debug(
-                    "%s %s: SSH host '%s' OK", typeName, entry[CONF_NAME], remotehost
-                )
+    file_name, client = findRestoreFile(typeName, entry)
+    if file_name is None:
+        errmsg = f"{label}: Verify-restore cannot find a backup file"
+        ErrorMsg(errmsg)
+        LOGGER.error(errmsg)
+        return
 
-                # make remote directory, possible it does not exist
-                cmd = f"mkdir -p {dir_output_remote}"
-                rc, stdout = remoteSSH(
-                    client,
-                    cmd,
-                    remotehost=remotehost,
-                    retrylast=retrylast,
-                    retrycount=retrycount,
-                )
+    LOGGER.debug("%s: Verify-restore of '%s'", label, file_name)
 
-                if not rc:
-                    retrycount += 1
-                    continue
+    dir_temp = dirTemp()
+    if not os.path.exists(dir_temp):
+        os.makedirs(dir_temp)
 
-                LOGGER.debug(
-                    "%s %s: Remote directory '%s' OK",
-                    typeName,
-                    entry[CONF_NAME],
-                    dir_output_remote,
-                )
+    now = datetime.datetime.now()
+    reader, stdout = openRestoreFile(file_name)
+    ok = False
 
-                # Current time
-                now = datetime.datetime.now()
+    try:
+        # A tampered or truncated encrypted file fails here too
+        stream = openDecompressed(file_name, openInput(file_name, reader), client)
+
+        if (
+            typeName in [CONF_APP, CONF_OTHER]
+            or entry[CONF_TYPE] == CONF_TYPE_INFLUXDB_BACKUP
+        ):
+            # Extract into a scratch directory, this reads every member
+            scratch = tempfile.mkdtemp(
+                prefix=f"verify-{entry[CONF_NAME]}-", dir=dir_temp
+            )
+            try:
+                with tarfile.open(fileobj=stream, mode="r|") as archive:
+                    archive.extractall(path=scratch)
+            finally:
+                shutil.rmtree(scratch, ignore_errors=True)
+            ok = True
 
-                # scp it to the backup node
-                rc = remoteSCP(
-                    client,
-                    f"{dir_output}/{file_name}",
-                    dir_output_remote,
-                    remotehost=remotehost,
-                    retrylast=retrylast,
-                    retrycount=retrycount,
-                )
+        elif config[CONF_VERIFY][CONF_CONTAINER] and entry[CONF_TYPE] in [
+            CONF_TYPE_MYSQL,
+            CONF_TYPE_POSTGRESQL,
+        ]:
+            ok = _verifyRestoreContainer(entry, stream)
 
-                if not rc:
-                    retrycount += 1
-                    continue
+        else:
+            # Decompress the full dump, which checks the CRC and length
+            while stream.read(RESTORE_CHUNK):
+                pass
+            ok = True
 
-                # Calculate how many seconds it took us to SCP
-                later = datetime.datetime.now()
-                diff = (later - now).total_seconds()
-                fsize = os.stat(f"{dir_output}/{file_name}").st_size
-                fsize = round(fsize / 1024, 1)
-                unit = "kByte"
+    except Exception as e:
+        errmsg = f"{label}: Verify-restore of '{file_name}' failed. Exception={type(e).__name__} Msg={e}"
+        ErrorMsg(errmsg)
+        LOGGER.error(
+            errmsg, exc_info=True,
+        )
 
-                # Change to MByte if needed
-                if fsize > 1000:
-                    fsize = round(fsize / 1024, 1)
-                    unit = "MByte"
+    ok = closeRestoreFile(reader, stdout) and ok
 
-                LOGGER.debug(
-                    "%s %s: SCP '%s' OK (%d seconds, %d %s)",
-                    typeName,
-                    entry[CONF_NAME],
-                    f"{dir_output}/{file_name}",
-                    diff,
-                    fsize,
-                    unit,
-                )
+    later = datetime.datetime.now()
+    diff = (later - now).total_seconds()
 
-                # check the backup node, if the file is correct. For now, just a ls -l
-                cmd = f"ls -l {dir_output_remote}/{file_name}"
-                rc, stdout = remoteSSH(client, cmd, remotehost=remotehost)
-                if not rc:
-                    retrycount += 1
-                    continue
+    LOGGER.info(
+        "%s: Verify-restore of '%s' %s (%d seconds, %s, %s/s)",
+        label,
+        file_name,
+        "OK" if ok else "FAILED",
+        diff,
+        sizeUnit(reader.count),
+        sizeUnit(reader.count / diff if diff > 0 else 0),
+    )
 
-                LOGGER.debug(
-                    "%s %s: Remote file '%s' OK",
-                    typeName,
-                    entry[CONF_NAME],
-                    f"{dir_output_remote}/{file_name}",
-                )
+    ReportTime(typeName, entry[CONF_NAME], "verify-restore", diff, reader.count)
+    catalogExecute(
+        "INSERT INTO restore VALUES (?, ?, ?, ?, ?, ?, ?)",
+        (
+            now.isoformat(),
+            typeName,
+            entry[CONF_NAME],
+            file_name,
+            diff,
+            reader.count,
+            ok,
+        ),
+    )
+    VERIFIED.append((typeName, entry[CONF_NAME], ok))
 
-                client.close()
 
-                # All successfull
-                break
+#################################################################
+def doVerify():
+    """Verify-restore the newest backup of our entries, on the verify weekday."""
 
-            # We get the following exception if SSH keys haven't been exchanged:
-            # paramiko.ssh_exception.SSHException
+    if args.get("mode", "") == "verify-restore":
+        for entry in config[args[CONF_TYPE]]:
+            if args[CONF_NAME] == entry[CONF_NAME]:
+                _verifyRestore(args[CONF_TYPE], entry)
+                return
 
-    # Make it possible to restart scp/copy if it previously failed?
+        print(f"ERROR: Cannot find name '{args[CONF_NAME]}' in '{args[CONF_TYPE]}'")
+        return
 
+    # Check if we should execute today or not
+    today = datetime.datetime.today().isoweekday()
+    if today not in config[CONF_VERIFY][CONF_WEEKDAY]:
+        LOGGER.debug("verify: No verify-restore today")
+        return
 
-#################################################################
-def doBackupType(typeName):
-    """We go through our entries, and execute our task.
-       Config is available as read-only global var."""
+    for typeName in [CONF_APP, CONF_DB, CONF_OTHER]:
+        if not config[CONF_CONFIG][typeName]:
+            continue
 
-    # We could be fully disabled
-    if config[CONF_CONFIG][typeName]:
         for entry in config[typeName]:
+            if not entry[CONF_ENABLED]:
+                continue
 
-            # If we are in test mode, we need to do something else
-            if args.get("mode", "") == "backup":
-                if args[CONF_TYPE] == typeName and args[CONF_NAME] == entry[CONF_NAME]:
-                    LOGGER.debug(
-                        "Running backup test on %s '%s'", typeName, entry[CONF_NAME]
-                    )
-                    doBackupWrapper(typeName, entry)
-            else:
+            if entry[CONF_RUN_HOST] and hostname not in entry[CONF_RUN_HOST]:
+                continue
 
-                # If it is disabled, we skip it
-                if not entry[CONF_ENABLED]:
-                    LOGGER.debug("%s '%s' is not enabled", typeName, entry[CONF_NAME])
-                    continue
+            _verifyRestore(typeName, entry)
 
-                if args.get("mode", "") == "run_host":
-                    if entry[CONF_RUN_HOST] and hostname not in entry[CONF_RUN_HOST]:
-                        print(f"{typeName} {entry[CONF_NAME]} is DISABLED on this host")
-                    else:
-                        print(f"{typeName} {entry[CONF_NAME]} is enabled on this host")
-                    continue
 
-                if entry[CONF_RUN_HOST] and hostname not in entry[CONF_RUN_HOST]:
-                    LOGGER.debug(
-                        "%s '%s' is not enabled on this run_host '%s'='%s'",
-                        typeName,
-                        entry[CONF_NAME],
-                        entry[CONF_RUN_HOST],
-                        hostname,
-                    )
-                    continue
+#################################################################
+def sha256File(file_name, throttle=None):
+    """The sha256 of a file, read with the throttle (if any)."""
+
+    sha256 = hashlib.sha256()
+    with open(file_name, "rb") as fh:
+        while True:
+            data = fh.read(RESTORE_CHUNK)
+            if not data:
+                break
+            sha256.update(data)
+            if throttle is not None:
+                throttle.consume(len(data))
 
-                # Check if we should execute today or not
-                today = datetime.datetime.today().isoweekday()
-                if today not in entry[CONF_WEEKDAY]:
-                    LOGGER.debug(
-                        "%s '%s' should not run today", typeName, entry[CONF_NAME]
-                    )
-                    continue
+    return sha256.hexdigest()
 
-                doBackupWrapper(typeName, entry)
 
-    else:
-        LOGGER.debug("%s backup is fully disabled", typeName)
+#################################################################
+def scrubResult(typeName, name, file_name, host, ok, seconds, size, missing=False):
+    """Record a scrub check, a bad or missing copy is reported."""
+
+    where = f"host '{host}'" if host else "local"
+    ReportTime(typeName, name, f"scrub {host}".rstrip(), seconds, size)
+    catalogExecute(
+        "INSERT INTO scrub VALUES (?, ?, ?, ?, ?, ?)",
+        (datetime.datetime.now().isoformat(), typeName, name, file_name, host, ok),
+    )
 
+    if ok:
+        LOGGER.debug("%s %s: Scrub '%s' (%s) OK", typeName, name, file_name, where)
+    else:
+        damage = "is missing" if missing else "is corrupt"
+        errmsg = f"{typeName} {name}: Scrub of '{os.path.basename(file_name)}' ({where}) FAILED, the copy {damage}"
+        ErrorMsg(errmsg)
+        LOGGER.error(errmsg)
 
-"""
-# Backup policy:
-# - Keep the last 7 days
-# - Keep the Sunday (7) of the last 2 months
-# - Keep the first Sunday of each month of the last 12 months
-"""
 
 #################################################################
-def doRestoreType():
-    """Restore a specific app/db/other to this node from the backup directory."""
+def scrubLocal(artifact, rate):
+    """Check the sha256 of a local artifact. Without a sha256 in the catalog
+       (e.g. older than the catalog) the first scrub records it."""
+
+    typeName, name, file_name, sha256, date = artifact
+    now = time.monotonic()
+
+    checksum = sha256File(file_name, Throttle(rate))
+    if sha256 is None:
+        catalogExecute(
+            "INSERT INTO checksum VALUES (?, ?, ?, ?, ?)",
+            (datetime.datetime.now().isoformat(), typeName, name, file_name, checksum),
+        )
 
-    found = False
-    entryFound = {}
+    scrubResult(
+        typeName,
+        name,
+        file_name,
+        "",
+        checksum == (sha256 or checksum),
+        time.monotonic() - now,
+        os.stat(file_name).st_size,
+    )
 
-    for entry in config[args[CONF_TYPE]]:
-        if args[CONF_NAME] == entry[CONF_NAME]:
-            entryFound = entry
-            found = True
-            break
 
-    if not found:
-        print(f"ERROR: Cannot find name '{args[CONF_NAME]}' in '{args[CONF_TYPE]}'")
-        return
+#################################################################
+def scrubHost(transfer, artifacts):
+    """Check the sha256 of the copies on a backup host, one after the other
+       with a low priority there (sha256sum runs with nice, which also
+       lowers its I/O priority). Volumes and shards are checked per part.
+       A copy which is not there is missing, unless it is older than the
+       expiry (days) of the host."""
+
+    remotehost = transfer[CONF_HOST]
+    expired = ""
+    if transfer[CONF_EXPIRY]:
+        expired = (
+            datetime.datetime.now() - datetime.timedelta(days=transfer[CONF_EXPIRY])
+        ).isoformat()
+
+    for typeName, name, file_name, sha256, date in artifacts:
+        dir_remote = f"{config[CONF_CONFIG][CONF_DIR][CONF_REMOTE]}/{typeName}/{name}"
+        base = os.path.basename(file_name)
+
+        # What the host should have of this artifact (not of an older one
+        # with the same name), with the sha256 of every part
+        shards = catalogExecute(
+            "SELECT shard, sha256 FROM shard WHERE file_name = ? AND host = ?"
+            " AND date >= ? ORDER BY date DESC LIMIT 1",
+            (file_name, remotehost, date),
+        )
+        volumes = catalogExecute(
+            "SELECT volume, sha256 FROM volume WHERE file_name = ? AND date = ?",
+            (file_name, date),
+        )
+        if shards:
+            parts = {shardName(base, shards[0][0]): shards[0][1]}
+        elif catalogExecute(
+            "SELECT 1 FROM shard WHERE file_name = ? AND date >= ? LIMIT 1",
+            (file_name, date),
+        ):
+            # Erasure coded, on other hosts only
+            continue
+        elif volumes:
+            parts = {volumeName(base, index): checksum for index, checksum in volumes}
+        else:
+            parts = {base: sha256}
+
+        now = time.monotonic()
+        try:
+            rc, stdout = remoteSSH(
+                sshClient(transfer),
+                f"cd {dir_remote} && {{ nice -n 19 sha256sum {' '.join(parts)} 2>/dev/null; true; }}",
+                remotehost=remotehost,
+                retrylast=False,
+            )
+        except Exception as e:
+            LOGGER.error(
+                "Scrub of host '%s' stopped. Exception=%s Msg=%s",
+                remotehost,
+                type(e).__name__,
+                e,
+            )
+            sshDrop(transfer)
+            return
 
-    # Define the input/output directories (reverse of the backup)
-    dir_input = f"{config[CONF_CONFIG][CONF_DIR][CONF_LOCAL]}/{args[CONF_TYPE]}/{entry[CONF_NAME]}"
+        if not rc:
+            continue
 
-    # If sourcedir is used, use that one
-    if entry[CONF_SOURCEDIR]:
-        # Check if it is an absolute one or not
-        if entry[CONF_SOURCEDIR].startswith("/"):
-            dir_output = entry[CONF_SOURCEDIR]
-        else:
-            dir_output = (
-                f"{config[CONF_CONFIG][CONF_DIR][CONF_DOCKER]}/{entry[CONF_SOURCEDIR]}"
+        found = {
+            fields[1]: fields[0] for fields in map(str.split, stdout) if len(fields) == 2
+        }
+        if not found and date < expired:
+            LOGGER.debug(
+                "%s %s: Scrub '%s' is expired on host '%s'",
+                typeName,
+                name,
+                base,
+                remotehost,
             )
-    else:
-        dir_output = f"{config[CONF_CONFIG][CONF_DIR][CONF_DOCKER]}/{entry[CONF_NAME]}"
+            continue
 
-    # Check if output directory exists, we should not overwrite
-    if os.path.isdir(dir_output):
-        sys.exit(
-            f"ERROR: Output directory '{dir_output}' already exists, please remove it manually first"
+        scrubResult(
+            typeName,
+            name,
+            file_name,
+            remotehost,
+            all(found.get(part) == checksum for part, checksum in parts.items()),
+            time.monotonic() - now,
+            0,
+            missing=not found,
         )
 
-    # Find file to restore
-    lof = sorted(
-        filter(
-            os.path.isfile, glob.glob(f"{dir_input}/{entry[CONF_NAME]}.????????-?.*")
+
+#################################################################
+def doScrub():
+    """Check the stored artifacts against their sha256, locally and on the
+       backup hosts, to find bit-rot before a restore needs them. A check
+       is done again after <days> days, so a scrub which is interrupted
+       continues with what is left. Local files and every host are checked
+       in parallel."""
+
+    if args.get("mode", "") != "scrub":
+        today = datetime.datetime.today().isoweekday()
+        if today not in config[CONF_SCRUB][CONF_WEEKDAY]:
+            LOGGER.debug("scrub: No scrub today")
+            return
+
+    since = (
+        datetime.datetime.now() - datetime.timedelta(days=config[CONF_SCRUB][CONF_DAYS])
+    ).isoformat()
+
+    def due(file_name, host):
+        rows = catalogExecute(
+            "SELECT MAX(date) FROM scrub WHERE file_name = ? AND host = ?",
+            (file_name, host),
         )
-    )
+        return rows[0][0] is None or rows[0][0] < since
+
+    # The artifacts which are still here, with their newest sha256
+    artifacts = []
+    for typeName, name, file_name in catalogExecute(
+        "SELECT type, name, file_name FROM artifact GROUP BY file_name ORDER BY MIN(date)"
+    ):
+        if not os.path.isfile(file_name):
+            continue
 
-    # We must find 1 or more filename
-    if len(lof) == 0:
-        sys.exit(
-            f"ERROR: Cannot find file in directory '{dir_input}' with '{entry[CONF_NAME]}.????????-?.*'"
+        rows = catalogExecute(
+            "SELECT sha256, date FROM checksum WHERE file_name = ?"
+            " ORDER BY date DESC LIMIT 1",
+            (file_name,),
         )
+        artifacts.append((typeName, name, file_name) + (rows[0] if rows else (None, "")))
 
-    file_name = lof[-1]
+    local = [artifact for artifact in artifacts if due(artifact[2], "")]
 
-    print(f"INFO: Using input file '{file_name}'")
-    print(f"INFO: Using output directory '{dir_output}'")
+    hosts = [
+        (transfer, [a for a in artifacts if a[3] and due(a[2], transfer[CONF_HOST])])
+        for transfer in config[CONF_CONFIG][CONF_TRANSFER]
+        if not transfer[CONF_RUN_HOST] or hostname in transfer[CONF_RUN_HOST]
+    ]
 
-    # Ask if we should continue or not
-    answer = input("Continue [Y/n]")
-    if answer not in ["", "Y", "y"]:
-        sys.exit("INFO: Stopped ...")
+    LOGGER.info(
+        "Scrub %d local file(s), %s",
+        len(local),
+        ", ".join(f"{len(todo)} on '{transfer[CONF_HOST]}'" for transfer, todo in hosts)
+        or "no hosts",
+    )
 
-    os.mkdir(dir_output)
-    os.chdir(dir_output)
+    workers = config[CONF_SCRUB][CONF_WORKERS]
+    rate = config[CONF_SCRUB][CONF_RATE] / workers
 
-    print(f"INFO: Created output directory '{dir_output}'")
-    print(f"INFO: Starting extraction ...")
+    # A worker per host, the local files have their own workers
+    hostPool = concurrent.futures.ThreadPoolExecutor(max_workers=len(hosts) or 1)
+    localPool = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
 
-    # Now it depends on the type
-    if args[CONF_TYPE] in [CONF_APP, CONF_OTHER]:
-        with tarfile.open(f"{file_name}", mode="r:gz") as archive:
-            archive.extractall()
-    # TarFile.extractall(path=".", members=None, *, numeric_owner=False)
+    with hostPool, localPool:
+        futures = [hostPool.submit(scrubHost, transfer, todo) for transfer, todo in hosts]
+        futures += [localPool.submit(scrubLocal, artifact, rate) for artifact in local]
 
-    elif args[CONF_TYPE] == CONF_DB:
-        print("Do nothing YET ...")
+        for future in futures:
+            try:
+                future.result()
+            except Exception as e:
+                errmsg = f"Scrub failed. Exception={type(e).__name__} Msg={e}"
+                ErrorMsg(errmsg)
+                LOGGER.error(
+                    errmsg, exc_info=True,
+                )
 
 
 #################################################################
@@ -1050,12 +5392,14 @@ def _doCleanupAppDb(typeName, entry):
         else entry[CONF_EXPIRY][CONF_YEAR]
     )
 
-    # Get the list of files into an array
-    files = [
-        file
-        for file in os.listdir(dir_output)
-        if os.path.isfile(os.path.join(dir_output, file))
-    ]
+    # Get the list of files into an array. The volumes and shards of a file
+    # (on a backup host) expire together with the file
+    volumes = collections.defaultdict(list)
+    for file in os.listdir(dir_output):
+        if os.path.isfile(os.path.join(dir_output, file)):
+            base = re.sub(SHARD_PATTERN, "", re.sub(VOLUME_PATTERN, "", file))
+            volumes[base].append(file)
+    files = list(volumes)
 
     # Variable for files to-be-deleted
     removefiles = []
@@ -1079,6 +5423,14 @@ def _doCleanupAppDb(typeName, entry):
         # Build up full name, including path
         file_name = f"{dir_output}/{fname}"
 
+        # Temporary file of a running (or aborted) backup, see publishFile()
+        if fname.startswith("."):
+            continue
+
+        # A zstd dictionary, older backups may still need it
+        if re.search(DICT_PATTERN, fname):
+            continue
+
         # Check if name is valid
         if not fname.startswith(entry[CONF_NAME]):
             LOGGER.warning(
@@ -1159,7 +5511,8 @@ def _doCleanupAppDb(typeName, entry):
     for fname in removefiles:
         file_name = f"{dir_output}/{fname}"
         try:
-            os.remove(file_name)
+            for part in volumes[fname]:
+                os.remove(f"{dir_output}/{part}")
             LOGGER.debug("%s %s: '%s' DELETED", typeName, entry[CONF_NAME], file_name)
         except Exception as e:
             errmsg = f"{typeName} {entry[CONF_NAME]}: '{file_name}' FAILED deletion. Exception={type(e).__name__} Msg={e}"
@@ -1168,6 +5521,94 @@ def _doCleanupAppDb(typeName, entry):
                 errmsg, exc_info=True,
             )
 
+    kept = [
+        f"{dir_output}/{fname}"
+        for fname in files
+        if not fname.startswith(".")
+        and not re.search(DICT_PATTERN, fname)
+        and fname not in removefiles
+    ]
+    _doCleanupDictionaries(typeName, entry, dir_output, kept)
+
+
+#################################################################
+def _doCleanupDictionaries(typeName, entry, dir_output, kept):
+    """Expire the zstd dictionaries (file and catalog) which no kept backup
+       was written with. The newest is kept, the next run uses it."""
+
+    catalogExecute(
+        "DELETE FROM usage WHERE type = ? AND name = ? AND file_name NOT IN"
+        f" ({', '.join('?' * len(kept))})",
+        (typeName, entry[CONF_NAME], *kept),
+    )
+
+    # The samples are only needed to train the next one
+    if not zstdEnabled(typeName, entry):
+        catalogExecute(
+            "DELETE FROM sample WHERE type = ? AND name = ?",
+            (typeName, entry[CONF_NAME]),
+        )
+
+    rows = catalogExecute(
+        "SELECT version, dict_id FROM dictionary WHERE type = ? AND name = ?"
+        " ORDER BY version DESC",
+        (typeName, entry[CONF_NAME]),
+    )
+    if not rows:
+        return
+
+    # Written before the catalog had the usage, we do not know its dictionary
+    used = {
+        row[0]
+        for row in catalogExecute(
+            "SELECT dict_id FROM usage WHERE type = ? AND name = ?",
+            (typeName, entry[CONF_NAME]),
+        )
+    }
+    unknown = [
+        file_name
+        for file_name in kept
+        if file_name.removesuffix(ENCRYPT_SUFFIX).endswith(ZSTD_SUFFIX)
+        and not catalogExecute(
+            "SELECT 1 FROM usage WHERE file_name = ?", (file_name,)
+        )
+    ]
+    if unknown:
+        LOGGER.debug(
+            "%s %s: No dictionary expiry, '%s' has no dictionary in the catalog",
+            typeName,
+            entry[CONF_NAME],
+            unknown[0],
+        )
+        return
+
+    for version, dict_id in rows[1:]:
+        if dict_id in used:
+            continue
+
+        file_name = dictionaryName(dir_output, entry[CONF_NAME], dict_id)
+        try:
+            for name in [file_name, f"{file_name}{ENCRYPT_SUFFIX}"]:
+                if os.path.exists(name):
+                    os.remove(name)
+            catalogExecute(
+                "DELETE FROM dictionary WHERE type = ? AND name = ? AND version = ?",
+                (typeName, entry[CONF_NAME], version),
+            )
+            LOGGER.debug(
+                "%s %s: Dictionary version %d (id %d) DELETED",
+                typeName,
+                entry[CONF_NAME],
+                version,
+                dict_id,
+            )
+        except Exception as e:
+            errmsg = f"{typeName} {entry[CONF_NAME]}: '{file_name}' FAILED deletion. Exception={type(e).__name__} Msg={e}"
+            ErrorMsg(errmsg)
+            LOGGER.error(
+                errmsg, exc_info=True,
+            )
+
 
 #################################################################
 def _doCleanupImages():
@@ -1199,6 +5640,32 @@ def _doCleanupImages():
                 )
 
 
+#################################################################
+def doGenKey():
+    """Create the X25519 key pair of the encryption stage."""
+
+    from cryptography.hazmat.primitives.asymmetric.x25519 import X25519PrivateKey
+
+    name = config[CONF_CONFIG][CONF_ENCRYPTION][CONF_PRIVATE_KEY]
+    if not name:
+        sys.exit(f"ERROR: Please configure '{CONF_PRIVATE_KEY}' first")
+
+    # Never overwrite a key, the existing backups need it
+    if os.path.exists(name):
+        sys.exit(f"ERROR: Private key file '{name}' already exists")
+
+    private = X25519PrivateKey.generate()
+
+    fd = os.open(name, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    with os.fdopen(fd, "w") as fh:
+        fh.write(base64.b64encode(private.private_bytes_raw()).decode() + "\n")
+
+    print(f"INFO: Private key written to '{name}', keep a copy off this host")
+    print(
+        f"INFO: Configure '{CONF_PUBLIC_KEY}: {base64.b64encode(private.public_key().public_bytes_raw()).decode()}'"
+    )
+
+
 #################################################################
 def doCleanup():
     """We go through our entries, and execute our cleanup task."""
@@ -1262,21 +5729,39 @@ def displayHelp():
 
     help = """./backup.py [cmd] [arg1] [arg2] [argX]
 
-cmd = backup, restore, image, cleanup, run_host
+cmd = backup, resume, restore, verify-restore, scrub, image, cleanup, run_host, daemon, genkey
 
 backup = Backups a specific type and application
-restore = Restores a specific type and application
+resume = Redo what the last run did not complete (e.g. after a reboot), an
+         artifact which is there is only transferred to the missing host(s)
+restore = Restores a specific type and application (db into its container),
+          optional from a remote backup host with "--from <host>", or from
+          the erasure coded shards on the backup hosts with "--from shards"
+verify-restore = Restores the newest backup into a scratch directory or
+                 throwaway container, to check it and measure the restore time
+scrub = Check the sha256 of the stored backups, locally and on the backup hosts,
+        e.g. for bit-rot on a SD card. Continues where a previous scrub stopped
 image = Backups images manually
 cleanup = Run cleanup manually
 run_host = Show which backups will be done on THIS hostname
+daemon = Stay resident and run the backups on their schedule (instead of cron).
+         While it runs, other commands (e.g. backup) are queued for the daemon
+genkey = Create the key pair for the encryption, the private key is written to
+         the configured "private_key" file, keep a copy off this host
 
 Example:
 ./backup.py backup app dsmr
 ./backup.py backup db influxdb 
 ./backup.py backup other startrek
+./backup.py restore app dsmr --from 192.168.1.3
+./backup.py verify-restore db hass
 
+./backup.py resume
+./backup.py scrub
 ./backup.py image
 ./backup.py run_host
+./backup.py daemon
+./backup.py genkey
 """
 
     print(help)
@@ -1294,25 +5779,49 @@ def parseArg():
 
     # Expect: "backup <type> <containername>"
 
-    if sys.argv[1].lower() in ["backup", "restore", "image", "cleanup", "run_host"]:
+    if sys.argv[1].lower() in [
+        "backup",
+        "resume",
+        "scrub",
+        "restore",
+        "verify-restore",
+        "image",
+        "cleanup",
+        "run_host",
+        "daemon",
+        "genkey",
+    ]:
 
         args["mode"] = sys.argv[1].lower()
 
-        if args["mode"] in ["backup", "restore", "cleanup"]:
-            if len(sys.argv) != 4:
+        argv = sys.argv
+
+        # Restore can stream from a remote backup host: "--from <host>"
+        if args["mode"] == "restore" and len(argv) == 6:
+            if argv[4].lower() != f"--{CONF_FROM}":
+                displayHelp()
+                sys.exit(
+                    f"FATAL: Invalid argument '{argv[4]}', only '--{CONF_FROM}' is supported"
+                )
+
+            args[CONF_FROM] = argv[5]
+            argv = argv[:4]
+
+        if args["mode"] in ["backup", "restore", "verify-restore", "cleanup"]:
+            if len(argv) != 4:
                 displayHelp()
                 sys.exit(
                     f"FATAL: Not enough arguments specified for '{args['mode']}', e.g. '{args['mode']} app dsmr'"
                 )
 
-            args[CONF_TYPE] = sys.argv[2].lower()
+            args[CONF_TYPE] = argv[2].lower()
             if args[CONF_TYPE] not in [CONF_APP, CONF_DB, CONF_OTHER]:
                 displayHelp()
                 sys.exit(
                     f"FATAL: Invalid 'backup' argument '{args[CONF_TYPE]}', only {CONF_APP}, {CONF_DB} and {CONF_OTHER} are supported"
                 )
 
-            args[CONF_NAME] = sys.argv[3]
+            args[CONF_NAME] = argv[3]
 
         return args
 
@@ -1322,59 +5831,68 @@ def parseArg():
 
 
 #################################################################
-def _backupImage(name):
-    """Backup the image."""
+def imageFileName(name, image_id):
+    """Backup filename of an image. The short image ID is part of the name,
+       so a re-pulled tag with new content gets a new backup."""
 
     # Replace bad characters
     oname = name.replace("/", "_").replace(":", "%")
-    oname = oname + ".tar.gz"
-
-    file_name = f"{config[CONF_CONFIG][CONF_DIR][CONF_LOCAL]}/{CONF_IMAGE}/{oname}"
+    return f"{oname}@{image_id.split(':')[-1][:12]}.tar.gz"
 
-    dir_output_remote = f"{config[CONF_CONFIG][CONF_DIR][CONF_REMOTE]}/{CONF_IMAGE}"
 
-    if os.path.exists(file_name):
-        LOGGER.debug("image: '%s' already exists", file_name)
-        return
+#################################################################
+def _saveImage(name, file_name):
+    """Save and compress the image, this runs in a worker thread.
+       Returns the seconds and size, errors are raised to the caller."""
 
     # Save date/time to know how long it took
     now = datetime.datetime.now()
 
-    # We do a docker save, because the python library does not seem to support it easily
+    LOGGER.debug("image: Saving '%s' to '%s'", name, file_name)
 
-    cmd = f"docker save '{name}' | gzip -c >{file_name}"
-    LOGGER.debug("image: Executing '%s'", cmd)
+    # Stream the image tarball from the Docker API and gzip it in-process.
+    # zlib releases the GIL, so the workers compress on multiple cores
+    import docker
 
-    rc = os.system(cmd)
-    if rc == 0:
-        # Calculate how many seconds it took us to save image
-        later = datetime.datetime.now()
-        diff = (later - now).total_seconds()
-        fsize = os.stat(file_name).st_size
-        fsize = round(fsize / 1024, 1)
-        unit = "kByte"
+    client = docker.from_env()
+    file_work = tempName(file_name)
+    try:
+        with open(file_work, "wb") as fh:
+            with gzip.GzipFile(
+                filename="",
+                mode="wb",
+                fileobj=fh,
+                compresslevel=config[CONF_IMAGE][CONF_LEVEL],
+            ) as gz:
+                for chunk in client.api.get_image(name):
+                    gz.write(chunk)
+    except Exception:
+        # Do not leave a partial file, it would be skipped the next run
+        if os.path.exists(file_work):
+            os.remove(file_work)
+        raise
+    finally:
+        client.close()
+
+    # Only a complete file gets the final name
+    publishFile(file_work, file_name)
+
+    later = datetime.datetime.now()
+    return (later - now).total_seconds(), os.stat(file_name).st_size
 
-        # Change to MByte if needed
-        if fsize > 1000:
-            fsize = round(fsize / 1024, 1)
-            unit = "MByte"
 
-        LOGGER.debug(
-            "image: Created '%s' (%d seconds, %d %s)", file_name, diff, fsize, unit,
-        )
+#################################################################
+def _transferImage(name, oname):
+    """Transfer the image backup to the remote backup host(s)."""
 
-    else:
-        errmsg = f"image: Creating '{file_name}' failed with RC={int(rc/256)}"
-        ErrorMsg(errmsg)
-        LOGGER.error(errmsg)
-        return
+    file_name = f"{config[CONF_CONFIG][CONF_DIR][CONF_LOCAL]}/{CONF_IMAGE}/{oname}"
+
+    dir_output_remote = f"{config[CONF_CONFIG][CONF_DIR][CONF_REMOTE]}/{CONF_IMAGE}"
 
     # We support 1 or more remote backup hosts
     for transfer in config[CONF_CONFIG][CONF_TRANSFER]:
 
         remotehost = transfer[CONF_HOST]
-        remoteport = transfer[CONF_PORT]
-        remoteuser = transfer[CONF_USER]
 
         # Check if we should run it on this host or not
         if transfer[CONF_RUN_HOST] and hostname not in transfer[CONF_RUN_HOST]:
@@ -1399,16 +5917,7 @@ def _backupImage(name):
 
         # make remote directory, possible it does not exist
         if transfer[CONF_TYPE] == CONF_SCP:
-            client = paramiko.SSHClient()
-            client.load_system_host_keys()
-            # client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-            client.connect(
-                remotehost,
-                port=remoteport,
-                username=remoteuser,
-                auth_timeout=5,
-                timeout=10,
-            )
+            client = sshClient(transfer)
 
             LOGGER.debug("image: SSH host '%s' OK", remotehost)
 
@@ -1451,6 +5960,9 @@ def _backupImage(name):
                 fsize,
                 unit,
             )
+            ReportTime(
+                CONF_IMAGE, name, f"scp {remotehost}", diff, os.stat(file_name).st_size
+            )
 
             # check the backup node, if the file is correct. For now, just a ls -l
             cmd = f"ls -l {dir_output_remote}/{oname}"
@@ -1462,8 +5974,6 @@ def _backupImage(name):
                 "image: Remote file '%s' OK", f"{dir_output_remote}/{oname}",
             )
 
-            client.close()
-
         # We get the following exception if SSH keys haven't been exchanged:
         # paramiko.ssh_exception.SSHException
 
@@ -1485,28 +5995,95 @@ def doImages():
                 return
 
     # We only support the local Docker API
+    import docker
+
     client = docker.from_env()
 
+    dir_image = f"{config[CONF_CONFIG][CONF_DIR][CONF_LOCAL]}/{CONF_IMAGE}"
+    if not os.path.exists(dir_image):
+        os.makedirs(dir_image)
+        LOGGER.debug("image: Directory '%s' created", dir_image)
+
+    # One API call for all images, index them by image ID (digest)
+    imageIndex = {}
+    for image in client.images.list():
+        imageIndex[image.id] = image.tags
+
+    # The image ID is part of the filename, so one directory read tells
+    # us which images are already backed up with the current content
+    existing = set(os.listdir(dir_image))
+
     # List of images processeed
     processimages = []
     listimages = []
+    todo = []
 
-    # List all containers, even the stopped ones
-    for container in client.containers.list(all=True):
+    # List all containers, even the stopped ones. Sparse gives us the image ID
+    # from the list call itself, instead of an extra API call per container
+    for container in client.containers.list(all=True, sparse=True):
 
-        for image in container.image.tags:
-            if image not in processimages:
-                LOGGER.debug("image: %s (container: %s)", image, container.name)
-                _backupImage(image)
-                processimages.append(image)
+        image_id = container.attrs.get("ImageID", "")
+        container_name = container.attrs["Names"][0].lstrip("/")
 
-                # Replace bad characters
-                oname = image.replace("/", "_").replace(":", "%")
-                oname = oname + ".tar.gz"
-                listimages.append(oname)
+        if image_id in processimages:
+            continue
+        processimages.append(image_id)
 
-                # We only are interested in first image tag
-                break
+        # We only are interested in first image tag
+        tags = imageIndex.get(image_id, [])
+        if not tags:
+            LOGGER.debug(
+                "image: '%s' has no tag (container: %s)", image_id, container_name
+            )
+            continue
+
+        oname = imageFileName(tags[0], image_id)
+        listimages.append(oname)
+
+        if oname in existing:
+            LOGGER.debug(
+                "image: %s (container: %s) already exists as '%s'",
+                tags[0],
+                container_name,
+                oname,
+            )
+            continue
+
+        LOGGER.debug("image: %s (container: %s)", tags[0], container_name)
+        todo.append((tags[0], oname))
+
+    # Save & compress several images concurrently. Transfers happen in this
+    # thread as soon as an image is ready, overlapping with the other saves
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=config[CONF_IMAGE][CONF_WORKERS]
+    ) as executor:
+        futures = {
+            executor.submit(_saveImage, name, f"{dir_image}/{oname}"): (name, oname)
+            for name, oname in todo
+        }
+
+        for future in concurrent.futures.as_completed(futures):
+            name, oname = futures[future]
+
+            try:
+                diff, fsize = future.result()
+            except Exception as e:
+                errmsg = f"image: Creating '{dir_image}/{oname}' failed. Exception={type(e).__name__} Msg={e}"
+                ErrorMsg(errmsg)
+                LOGGER.error(
+                    errmsg, exc_info=True,
+                )
+                continue
+
+            ReportTime(CONF_IMAGE, name, "save", diff, fsize)
+            LOGGER.debug(
+                "image: Created '%s' (%d seconds, %s)",
+                f"{dir_image}/{oname}",
+                diff,
+                sizeUnit(fsize),
+            )
+
+            _transferImage(name, oname)
 
     listimages.sort()
     outputname = (
@@ -1523,8 +6100,6 @@ def doImages():
 
         # ping the backup node
         remotehost = transfer[CONF_HOST]
-        remoteport = transfer[CONF_PORT]
-        remoteuser = transfer[CONF_USER]
 
         # Check if we should run it on this host or not
         if transfer[CONF_RUN_HOST] and hostname not in transfer[CONF_RUN_HOST]:
@@ -1539,7 +6114,7 @@ def doImages():
         rc = os.system("ping -w 3 -c 2 " + remotehost + " >/dev/null")
 
         if rc != 0:
-            errmsg = f"{typeName} {entry[CONF_NAME]}: Cannot ping host '{remotehost}' RC={int(rc/256)}"
+            errmsg = f"image: Cannot ping host '{remotehost}' RC={int(rc/256)}"
             ErrorMsg(errmsg)
             LOGGER.error(errmsg)
             continue
@@ -1548,17 +6123,8 @@ def doImages():
 
         # make remote directory, possible it does not exist
         if transfer[CONF_TYPE] == CONF_SCP:
-            # LOGGER.debug("Image: SCP to '%s:%s' with username '%s'", remotehost, remoteport, remoteuser)
-            client = paramiko.SSHClient()
-            client.load_system_host_keys()
-            # client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-            client.connect(
-                remotehost,
-                port=remoteport,
-                username=remoteuser,
-                auth_timeout=5,
-                timeout=10,
-            )
+            # LOGGER.debug("Image: SCP to '%s:%s' with username '%s'", remotehost, transfer[CONF_PORT], transfer[CONF_USER])
+            client = sshClient(transfer)
 
             LOGGER.debug("Image: SSH host '%s' OK", remotehost)
 
@@ -1574,42 +6140,305 @@ def doImages():
                 continue
 
             LOGGER.debug("Image: transferred '%s' successfully to remote", outputname)
-            client.close()
+
+
+#################################################################
+def resetRun():
+    """Forget the error(s) and report of the previous run (daemon)."""
+    global RUN_KEY
+
+    # Every run gets its own data key
+    RUN_KEY = None
+
+    ERRORS[CONF_COUNT] = 0
+    ERRORS[CONF_MSG].clear()
+    REPORT.clear()
+    VERIFIED.clear()
+
+
+#################################################################
+def endRun(final=True):
+    """Report the run. The daemon keeps the SSH session(s) and catalog open."""
+
+    if final:
+        # Close the pooled SSH session(s)
+        sshCloseAll()
+
+    # Report timing(s) of this run
+    reportRun()
+    writeMetrics()
+
+    if final:
+        catalogClose()
+
+    # Report error(s) via Telegram
+    reportError()
+
+
+#################################################################
+def lockHolder():
+    """The pid and mode of the holder of the run lock, from the lock file."""
+
+    try:
+        with open(LOCK_FILE) as fh:
+            pid, mode = fh.read().split()
+        return int(pid), mode
+    except (OSError, ValueError):
+        return 0, ""
+
+
+#################################################################
+def tryLock(mode):
+    """Take the run lock if it is free. The kernel releases the lock of a
+       process which dies, its pid is still in the file: a stale lock."""
+    global LOCK
+
+    fh = open(LOCK_FILE, "a+")
+    try:
+        fcntl.flock(fh, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        fh.close()
+        return False
+
+    pid, holder = lockHolder()
+    if pid:
+        LOGGER.warning(
+            "Stale lock of pid %d (%s), that run ended without unlock", pid, holder
+        )
+
+    fh.seek(0)
+    fh.truncate()
+    fh.write(f"{os.getpid()} {mode}\n")
+    fh.flush()
+
+    LOCK = fh
+    return True
+
+
+#################################################################
+def lockRun():
+    """Take the run lock, runs never overlap. While the daemon has it, the
+       request of the command line is queued for the daemon (a full run is
+       left to the daemon). Other runs are waited for. Returns False if we
+       should not run."""
+
+    mode = args.get("mode", "") or "run"
+
+    if tryLock(mode):
+        return True
+
+    pid, holder = lockHolder()
+
+    if holder == "daemon":
+        if mode == "daemon":
+            sys.exit(f"FATAL: The daemon runs already, pid {pid}")
+
+        if mode == "run":
+            LOGGER.warning("The daemon (pid %d) runs the schedule, nothing to do", pid)
+            return False
+
+        os.makedirs(QUEUE_DIR, exist_ok=True)
+        name = f"{QUEUE_DIR}/{time.time_ns()}-{os.getpid()}.yaml"
+        with open(tempName(name), "w") as fh:
+            yaml.safe_dump(args, fh)
+        os.rename(tempName(name), name)
+
+        LOGGER.info("Request %s queued for the daemon (pid %d)", args, pid)
+        print(f"INFO: Queued for the daemon (pid {pid}), it starts within a minute")
+        return False
+
+    LOGGER.info("Waiting for the run of pid %d (%s)", pid, holder)
+
+    deadline = time.monotonic() + LOCK_WAIT
+    while time.monotonic() < deadline:
+        time.sleep(LOCK_POLL)
+        if tryLock(mode):
+            return True
+
+    errmsg = f"The run of pid {pid} ({holder}) is still busy after {LOCK_WAIT // 3600} hours, this run ({mode}) is skipped"
+    ErrorMsg(errmsg)
+    LOGGER.error(errmsg)
+    reportError()
+    return False
+
+
+#################################################################
+def unlockRun():
+    """Release the run lock. An empty lock file means a clean end."""
+    global LOCK
+
+    if LOCK is not None:
+        LOCK.seek(0)
+        LOCK.truncate()
+        fcntl.flock(LOCK, fcntl.LOCK_UN)
+        LOCK.close()
+        LOCK = None
+
+
+#################################################################
+def doQueue():
+    """Run the requests the command line queued for the daemon, in order."""
+    global args
+
+    daemon = args
+
+    for name in sorted(glob.glob(f"{QUEUE_DIR}/*.yaml")):
+        try:
+            with open(name) as fh:
+                request = yaml.safe_load(fh)
+            os.remove(name)
+        except Exception as e:
+            errmsg = f"Queued request '{name}' is invalid. Exception={type(e).__name__} Msg={e}"
+            ErrorMsg(errmsg)
+            LOGGER.error(errmsg)
+            continue
+
+        LOGGER.info("Queued request %s started", request)
+
+        args = request
+        try:
+            doMode()
+        except Exception as e:
+            errmsg = f"Queued request {request} failed. Exception={type(e).__name__} Msg={e}"
+            ErrorMsg(errmsg)
+            LOGGER.error(
+                errmsg, exc_info=True,
+            )
+        finally:
+            args = daemon
+
+        endRun(final=False)
+        resetRun()
+
+
+#################################################################
+def doDaemon():
+    """Stay resident and run the entries on their schedule, instead of a run
+       per day from cron. The config is read again when the file changes."""
+    global config
+
+    LOGGER.info("Daemon started on '%s', pid %d", hostname, os.getpid())
+
+    mtime = os.stat(CONFIGFILE).st_mtime
+    last = datetime.datetime.now().replace(second=0, microsecond=0)
+
+    while True:
+        # Sleep till the start of the next minute
+        now = datetime.datetime.now()
+        time.sleep(60 - now.second - now.microsecond / 1000000)
+
+        # Reload the config on change. A broken config keeps the old one
+        if os.stat(CONFIGFILE).st_mtime != mtime:
+            mtime = os.stat(CONFIGFILE).st_mtime
+            try:
+                new = loadConfig(CONFIGFILE)
+                error = checkConfig(new)
+                if error:
+                    raise ValueError(error[0])
+                config = new
+                LOGGER.info("Config file '%s' changed, reloaded", CONFIGFILE)
+            except Exception as e:
+                errmsg = f"Config file '{CONFIGFILE}' changed, but is invalid. Exception={type(e).__name__} Msg={e}"
+                ErrorMsg(errmsg)
+                LOGGER.error(errmsg)
+
+        # A long backup can take several minutes, catch up on every minute
+        # we missed, so nothing is skipped, it only starts later
+        now = datetime.datetime.now().replace(second=0, microsecond=0)
+        while last < now:
+            last += datetime.timedelta(minutes=1)
+
+            doBackup(last)
+
+            # Images, cleanup, verify-restore and scrub use the default
+            # schedule, their weekday lists still apply
+            if cronMatch(config[CONF_CONFIG][CONF_SCHEDULE], last):
+                doImages()
+                doCleanup()
+                doVerify()
+                doScrub()
+
+            if REPORT or ERRORS[CONF_COUNT]:
+                endRun(final=False)
+                resetRun()
+
+        # Requests of the command line, see lockRun()
+        doQueue()
+
+
+#################################################################
+def doMode():
+    """Run the mode of the command line, or of a request queued for the daemon."""
+
+    if args.get("mode", "") in ["backup", "run_host"]:
+        doBackup()
+    elif args.get("mode", "") == "resume":
+        doResume()
+    elif args.get("mode", "") == "restore":
+        doRestoreType()
+    elif args.get("mode", "") == "verify-restore":
+        doVerify()
+    elif args.get("mode", "") == "image":
+        doImages()
+    elif args.get("mode", "") == "cleanup":
+        doCleanup()
+    elif args.get("mode", "") == "scrub":
+        doScrub()
+    else:
+        doBackup()
+        doImages()
+        doCleanup()
+        doVerify()
+        doScrub()
+
+
+#################################################################
+def main():
+    global args, config, hostname
+
+    # Only root can access certain things, so we need this
+    if not os.geteuid() == 0:
+        sys.exit("ERROR: Only root can run this script\n")
+
+    # Get hostname of this node
+    hostname = socket.gethostname()
+
+    args = parseArg()
+
+    config = readConfig()
+
+    if args.get("mode", "") == "genkey":
+        doGenKey()
+        return
+
+    # Runs never overlap. A restore is interactive, and run_host only shows
+    if args.get("mode", "") not in ["restore", "run_host"]:
+        if not lockRun():
+            return
+
+    try:
+        if args.get("mode", "") == "daemon":
+            # systemd/docker stop with SIGTERM, stop the same way as with Ctrl-C
+            signal.signal(signal.SIGTERM, signal.default_int_handler)
+            try:
+                doDaemon()
+            except KeyboardInterrupt:
+                LOGGER.info("Daemon stopped")
+                endRun()
+            return
+
+        doMode()
+        endRun()
+
+    finally:
+        unlockRun()
 
 
 #################################################################
 # Main
 #################################################################
 
-# Only root can access certain things, so we need this
-if not os.geteuid() == 0:
-    sys.exit("ERROR: Only root can run this script\n")
-
-# Get hostname of this node
-hostname = socket.gethostname()
-
-args = parseArg()
-
-config = readConfig()
-
-if args.get("mode", "") in ["backup", "run_host"]:
-    doBackupType(CONF_APP)
-    doBackupType(CONF_DB)
-    doBackupType(CONF_OTHER)
-elif args.get("mode", "") == "restore":
-    doRestoreType()
-elif args.get("mode", "") == "image":
-    doImages()
-elif args.get("mode", "") == "cleanup":
-    doCleanup()
-else:
-    doBackupType(CONF_APP)
-    doBackupType(CONF_DB)
-    doBackupType(CONF_OTHER)
-    doImages()
-    doCleanup()
-
-# Report error(s) via Telegram
-reportError()
+if __name__ == "__main__":
+    main()
 
 # End
@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+
+"""
+Memory benchmark of the app archive, with many files.
+
+A synthetic tree of up to 1M (empty) files is made once, in directories of
+1000 files. Every size is archived by a new process, only the first
+directories are used for the smaller sizes. The peak RSS of the process is
+reported per size, for the TarWriter of backup.py and for TarFile of the
+standard library. The TarWriter should stay flat, TarFile grows with the
+number of files (it keeps a TarInfo and an inode per file). The benchmark
+fails if the TarWriter peak of the largest size is more than the tolerance
+above the one of the smallest size.
+
+./memory.py
+./memory.py --sizes 10000,100000 --dir /var/tmp --tolerance 1
+"""
+
+import argparse
+import importlib.util
+import os
+import shutil
+import sys
+import tarfile
+import tempfile
+import time
+
+#################################################################
+BACKUP = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "backup.py")
+
+PER_DIR = 1000
+
+
+#################################################################
+def makeTree(root, count):
+    """Empty files, in directories of PER_DIR files. Kept for a next run."""
+
+    for index in range(0, count, PER_DIR):
+        path = f"{root}/d{index // PER_DIR:05d}"
+        if os.path.isdir(path):
+            continue
+
+        os.makedirs(f"{path}.tmp", exist_ok=True)
+        for count in range(PER_DIR):
+            os.close(os.open(f"{path}.tmp/f{count:04d}", os.O_CREAT | os.O_WRONLY))
+        os.rename(f"{path}.tmp", path)
+
+
+#################################################################
+def child(workdir, mode, root, count):
+    """Archive the first count files to /dev/null, in this process."""
+
+    spec = importlib.util.spec_from_file_location("backup", f"{workdir}/backup.py")
+    backup = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(backup)
+
+    entry = {backup.CONF_THROTTLE: {backup.CONF_RATE: 0, backup.CONF_FADVISE: False}}
+    limit = f"d{count // PER_DIR:05d}"
+
+    def below(tarinfo):
+        return tarinfo if tarinfo.name.split("/")[0] < limit else None
+
+    with open(os.devnull, "wb") as output:
+        if mode == "tarwriter":
+            archive = backup.TarWriter(output)
+        else:
+            archive = tarfile.open(fileobj=output, mode="w")
+
+        with archive:
+            backup.archiveTree(archive, root, entry, below)
+
+
+#################################################################
+def run(workdir, mode, root, count):
+    """Run a child, returns the seconds and peak RSS (kB)."""
+
+    now = time.monotonic()
+    pid = os.fork()
+    if pid == 0:
+        try:
+            child(workdir, mode, root, count)
+        except BaseException as e:
+            print(f"ERROR: {type(e).__name__} {e}", file=sys.stderr)
+            os._exit(1)
+        os._exit(0)
+
+    pid, status, usage = os.wait4(pid, 0)
+    if os.waitstatus_to_exitcode(status) != 0:
+        sys.exit(f"ERROR: {mode} with {count} files failed")
+
+    return time.monotonic() - now, usage.ru_maxrss
+
+
+#################################################################
+def main():
+    parser = argparse.ArgumentParser(description="backup.py archive memory benchmark")
+    parser.add_argument(
+        "--sizes", default="10000,100000,1000000", help="number of files, comma separated"
+    )
+    parser.add_argument("--dir", default=None, help="directory for the tree")
+    parser.add_argument("--keep", action="store_true", help="keep the tree")
+    parser.add_argument(
+        "--tolerance", type=float, default=2, help="TarWriter growth in MB"
+    )
+    options = parser.parse_args()
+
+    sizes = sorted(int(size) for size in options.sizes.split(","))
+    peaks = {}
+
+    workdir = tempfile.mkdtemp(prefix="backup-memory-", dir=options.dir)
+    root = f"{workdir}/tree"
+
+    try:
+        # A copy, backup.py logs next to itself
+        shutil.copy(BACKUP, f"{workdir}/backup.py")
+
+        now = time.monotonic()
+        makeTree(root, sizes[-1])
+        print(f"INFO: Tree of {sizes[-1]} files in {time.monotonic() - now:.0f} seconds")
+
+        print(f"{'files':>10} {'mode':10} {'seconds':>8} {'peak RSS MB':>12}")
+        for count in sizes:
+            for mode in ["tarwriter", "tarfile"]:
+                seconds, rss = run(workdir, mode, root, count)
+                print(f"{count:10} {mode:10} {seconds:8.1f} {rss / 1024:12.1f}")
+                if mode == "tarwriter":
+                    peaks[count] = rss
+
+    finally:
+        if options.keep:
+            print(f"INFO: Kept '{workdir}'")
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    # Constant, whatever the number of files
+    growth = (peaks[sizes[-1]] - peaks[sizes[0]]) / 1024
+    print(
+        f"INFO: TarWriter grew {growth:.1f} MB from {sizes[0]} to {sizes[-1]} files (tolerance {options.tolerance} MB)"
+    )
+    if growth > options.tolerance:
+        sys.exit("ERROR: The TarWriter memory grows with the number of files")
+
+
+#################################################################
+# Main
+#################################################################
+
+if __name__ == "__main__":
+    main()
+
+# End
@@ -0,0 +1,683 @@
+#!/usr/bin/env python3
+
+"""
+End-to-end benchmark of backup.py: archive/dump, transfer and cleanup.
+
+Everything runs in a scratch directory, nothing real is touched:
+
+- A synthetic /docker/<app> tree, with many small files, a few huge files,
+  already-compressed media and deep excluded directories. The content is
+  generated from a seed, so every run archives the same bytes.
+- A database entry, with a fake "docker" command on the PATH that streams a
+  synthetic mysqldump.
+- A local paramiko SSH server (separate process) as transfer host, it
+  handles the "scp -t" sink and the shell commands backup.py sends.
+
+backup.py is imported from a copy, and _doAppDb, remoteSCP/remoteSSH and
+doCleanup are wrapped to split the time per stage. Per stage it reports the
+wall-clock time, throughput, CPU (own and of child processes, e.g. gzip)
+and the peak RSS (Linux, VmHWM is reset per stage). The result of every
+stage is checked (files in the archive, the dump, the sha256 of the copy on
+the host, what the cleanup expired), a broken stage fails the benchmark.
+
+./pipeline.py
+./pipeline.py --small 50000 --huge 4 --huge-mb 512 --encrypt
+./pipeline.py --no-transfer --keep
+"""
+
+import argparse
+import datetime
+import glob
+import hashlib
+import importlib.util
+import os
+import random
+import resource
+import shlex
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+#################################################################
+BACKUP = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "backup.py")
+
+APP = "bench"
+DB = "benchdb"
+
+# Backups the cleanup keeps per entry (day), of the history and today's
+KEEP = 7
+
+CONFIG = """config:
+  dir:
+    docker: {dir}/docker
+    local: {dir}/backup
+    remote: {dir}/remote
+  transfer: {transfer}
+  preflight: false
+  encryption:
+    enabled: {encrypt}
+    public_key: "{public_key}"
+    private_key: "{dir}/backup.key"
+  telegram:
+    enabled: false
+
+app:
+  - name: {app}
+    exclude:
+      - log
+      - "*/cache"
+
+db:
+  - name: {db}
+    type: mysql
+    dbname: {db}
+
+expiry_app:
+  day: {keep}
+  month: 0
+  year: 0
+
+expiry_db:
+  day: {keep}
+  month: 0
+  year: 0
+"""
+
+# Fake docker, only "docker exec ... mysqldump ..." does something
+FAKE_DOCKER = """#!{python}
+import os, random, sys
+
+if "mysqldump" not in " ".join(sys.argv):
+    sys.exit(0)
+
+rnd = random.Random({seed})
+size = {size}
+out = sys.stdout.buffer
+out.write(b"CREATE DATABASE IF NOT EXISTS bench;\\nUSE bench;\\n")
+while size > 0:
+    rows = ",".join(
+        "(%d,'%s',%f)" % (rnd.randrange(10**9), rnd.choice(["on", "off", "idle", "home", "away"]), rnd.random() * 100)
+        for count in range(200)
+    )
+    line = ("INSERT INTO states VALUES " + rows + ";\\n").encode()
+    out.write(line)
+    size -= len(line)
+"""
+
+WORDS = b"backup docker volume sensor state home light switch temperature humidity power energy value".split()
+
+
+#################################################################
+# Local SSH server (transfer host)
+#################################################################
+
+
+#################################################################
+def scpSink(channel, target):
+    """Receive files with the scp protocol ("scp -t <target>")."""
+
+    def readline():
+        line = b""
+        while not line.endswith(b"\n"):
+            data = channel.recv(1)
+            if not data:
+                return None
+            line += data
+        return line
+
+    dirs = [target]
+    channel.sendall(b"\0")
+
+    while True:
+        line = readline()
+        if line is None:
+            return 0
+
+        if line[:1] == b"C":
+            mode, size, name = line[1:-1].decode().split(" ", 2)
+            size = int(size)
+            path = (
+                os.path.join(dirs[-1], name) if os.path.isdir(dirs[-1]) else dirs[-1]
+            )
+            channel.sendall(b"\0")
+
+            with open(path, "wb") as fh:
+                while size > 0:
+                    data = channel.recv(min(size, 1024 * 1024))
+                    if not data:
+                        return 1
+                    fh.write(data)
+                    size -= len(data)
+
+            # Trailing confirm of the sender
+            channel.recv(1)
+            channel.sendall(b"\0")
+
+        elif line[:1] == b"D":
+            mode, size, name = line[1:-1].decode().split(" ", 2)
+            dirs.append(os.path.join(dirs[-1], name))
+            os.makedirs(dirs[-1], exist_ok=True)
+            channel.sendall(b"\0")
+
+        elif line[:1] == b"E":
+            dirs.pop()
+            channel.sendall(b"\0")
+
+        else:
+            # "T" (times) and anything else is just confirmed
+            channel.sendall(b"\0")
+
+
+#################################################################
+def execCommand(channel, command):
+    """Run one exec request of a client."""
+
+    rc = 1
+    try:
+        argv = shlex.split(command)
+        if argv and argv[0] == "scp" and "-t" in argv:
+            rc = scpSink(channel, argv[-1])
+        else:
+            result = subprocess.run(
+                command, shell=True, stdin=subprocess.DEVNULL, capture_output=True
+            )
+            channel.sendall(result.stdout)
+            channel.sendall_stderr(result.stderr)
+            rc = result.returncode
+    finally:
+        channel.send_exit_status(rc)
+        channel.close()
+
+
+#################################################################
+def serve(workdir):
+    """SSH server process, any key of any user is accepted."""
+
+    import paramiko
+
+    class Server(paramiko.ServerInterface):
+        def check_channel_request(self, kind, chanid):
+            if kind == "session":
+                return paramiko.OPEN_SUCCEEDED
+            return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+        def get_allowed_auths(self, username):
+            return "publickey"
+
+        def check_auth_publickey(self, username, key):
+            return paramiko.AUTH_SUCCESSFUL
+
+        def check_channel_exec_request(self, channel, command):
+            threading.Thread(
+                target=execCommand, args=(channel, command.decode()), daemon=True
+            ).start()
+            return True
+
+    host_key = paramiko.RSAKey(filename=f"{workdir}/host_key")
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(("127.0.0.1", 0))
+    sock.listen(10)
+
+    print(sock.getsockname()[1], flush=True)
+
+    while True:
+        conn, addr = sock.accept()
+        transport = paramiko.Transport(conn)
+        transport.add_server_key(host_key)
+        transport.start_server(server=Server())
+
+
+#################################################################
+def startServer(workdir):
+    """Start the SSH server, and make the keys the client will use."""
+
+    import paramiko
+
+    host_key = paramiko.RSAKey.generate(2048)
+    host_key.write_private_key_file(f"{workdir}/host_key")
+
+    # backup.py uses the default keys and known_hosts of the user
+    os.makedirs(f"{workdir}/home/.ssh")
+    paramiko.RSAKey.generate(2048).write_private_key_file(
+        f"{workdir}/home/.ssh/id_rsa"
+    )
+    os.environ["HOME"] = f"{workdir}/home"
+    os.environ.pop("SSH_AUTH_SOCK", None)
+
+    proc = subprocess.Popen(
+        [sys.executable, os.path.abspath(__file__), "--serve", workdir],
+        stdout=subprocess.PIPE,
+        universal_newlines=True,
+    )
+    port = int(proc.stdout.readline())
+
+    with open(f"{workdir}/home/.ssh/known_hosts", "w") as fh:
+        fh.write(
+            f"[127.0.0.1]:{port} {host_key.get_name()} {host_key.get_base64()}\n"
+        )
+
+    return proc, port
+
+
+#################################################################
+def stopServer(proc):
+    """Stop the SSH server, returns its CPU seconds and peak RSS (kB)."""
+
+    proc.terminate()
+    pid, status, usage = os.wait4(proc.pid, 0)
+    proc.returncode = status
+    return usage.ru_utime + usage.ru_stime, usage.ru_maxrss
+
+
+#################################################################
+# Synthetic data
+#################################################################
+
+
+#################################################################
+def textBlock(rnd, size):
+    """Compressible text, like config files and logs."""
+
+    data = bytearray()
+    while len(data) < size:
+        data += b" ".join(rnd.choice(WORDS) for count in range(12)) + b"\n"
+    return bytes(data[:size])
+
+
+#################################################################
+def makeTree(root, options):
+    """Generate the app tree, returns the bytes that will be archived."""
+
+    rnd = random.Random(options.seed)
+    block = textBlock(rnd, 1024 * 1024)
+    total = 0
+
+    def write(name, data, repeat=1):
+        os.makedirs(os.path.dirname(name), exist_ok=True)
+        with open(name, "wb") as fh:
+            for count in range(repeat):
+                fh.write(data)
+        return len(data) * repeat
+
+    # Many small files, in directories of 500
+    for count in range(options.small):
+        size = rnd.randrange(options.small_kb * 512, options.small_kb * 1536)
+        offset = rnd.randrange(0, len(block) - size)
+        total += write(
+            f"{root}/config/d{count // 500:04d}/f{count:06d}.yaml",
+            block[offset : offset + size],
+        )
+
+    # A few huge files, compressible but not too much (text with random runs)
+    chunk = bytearray(block)
+    for pos in range(0, len(chunk), 4096):
+        chunk[pos : pos + 512] = rnd.randbytes(512)
+    for count in range(options.huge):
+        total += write(
+            f"{root}/data/huge{count}.db", bytes(chunk), repeat=options.huge_mb
+        )
+
+    # Already-compressed media, random bytes do not compress
+    for count in range(options.media):
+        ext = ["jpg", "mp4", "png", "gz"][count % 4]
+        total += write(
+            f"{root}/media/m{count:03d}.{ext}",
+            rnd.randbytes(1024 * 1024),
+            repeat=options.media_mb,
+        )
+
+    # Deep directories, the cache at the bottom is excluded
+    path = f"{root}/data/deep"
+    for level in range(options.depth):
+        path = f"{path}/l{level}"
+        total += write(f"{path}/keep.txt", block[:1024])
+        write(f"{path}/cache/tmp.bin", block[: 64 * 1024])
+
+    # Excluded log directory
+    write(f"{root}/log/app.log", block, repeat=8)
+
+    return total
+
+
+#################################################################
+def makeHistory(local, name, extension, days=30):
+    """Older backup files, so the cleanup has something to expire."""
+
+    os.makedirs(local, exist_ok=True)
+    today = datetime.date.today()
+    for day in range(1, days + 1):
+        date = today - datetime.timedelta(days=day)
+        with open(
+            f"{local}/{name}.{date.strftime('%Y%m%d')}-{date.isoweekday()}.{extension}",
+            "wb",
+        ) as fh:
+            fh.write(b"\0" * 4096)
+
+
+#################################################################
+# Measurement
+#################################################################
+
+
+#################################################################
+class Meter:
+    """Time, CPU and peak RSS per stage. Stages nest (the transfer runs
+       inside _doAppDb), the time is given to the innermost stage."""
+
+    def __init__(self):
+        self.stack = []
+        self.stages = {}
+        self.mark = None
+        self.hwm = os.path.exists("/proc/self/clear_refs")
+
+    def _now(self):
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        return (
+            time.monotonic(),
+            time.process_time(),
+            children.ru_utime + children.ru_stime,
+        )
+
+    def _peak(self):
+        """Peak RSS (kB) since the last reset, and reset it."""
+        if not self.hwm:
+            return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+        try:
+            with open("/proc/self/status") as fh:
+                for line in fh:
+                    if line.startswith("VmHWM:"):
+                        peak = int(line.split()[1])
+            with open("/proc/self/clear_refs", "w") as fh:
+                fh.write("5")
+        except OSError:
+            self.hwm = False
+            return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+        return peak
+
+    def _switch(self):
+        now = self._now()
+        peak = self._peak()
+
+        if self.stack and self.mark:
+            stage = self.stages.setdefault(
+                self.stack[-1], {"wall": 0, "cpu": 0, "child": 0, "rss": 0}
+            )
+            stage["wall"] += now[0] - self.mark[0]
+            stage["cpu"] += now[1] - self.mark[1]
+            stage["child"] += now[2] - self.mark[2]
+            stage["rss"] = max(stage["rss"], peak)
+
+        self.mark = now
+
+    def wrap(self, name, func):
+        """Wrap func, name can be a function of the arguments."""
+
+        def wrapper(*args, **kwargs):
+            self._switch()
+            self.stack.append(name(*args) if callable(name) else name)
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self._switch()
+                self.stack.pop()
+
+        return wrapper
+
+
+#################################################################
+# Checks
+#################################################################
+
+
+#################################################################
+def sha256File(name):
+    """The sha256 of a file."""
+
+    sha256 = hashlib.sha256()
+    with open(name, "rb") as fh:
+        for chunk in iter(lambda: fh.read(1024 * 1024), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+#################################################################
+def checkBackup(backup, workdir, options):
+    """Check the archive (every file), the dump (complete) and the copies
+       on the transfer host (same sha256). Returns today's artifacts."""
+
+    import tarfile
+
+    if backup.ERRORS[backup.CONF_COUNT]:
+        sys.exit(f"ERROR: backup.py reported errors: {backup.ERRORS[backup.CONF_MSG]}")
+
+    today = datetime.date.today()
+    artifacts = {}
+    for typeName, name in [("app", APP), ("db", DB)]:
+        names = glob.glob(
+            f"{workdir}/backup/{typeName}/{name}/{name}.{today.strftime('%Y%m%d')}-*"
+        )
+        if len(names) != 1:
+            sys.exit(f"ERROR: {typeName} {name}: {len(names)} backup(s) of today")
+        artifacts[typeName] = names[0]
+
+    # The files makeTree writes outside the excludes
+    expected = options.small + options.huge + options.media + options.depth
+    name = artifacts["app"]
+    with open(name, "rb") as fh:
+        stream = backup.openDecompressed(name, backup.openInput(name, fh))
+        with tarfile.open(fileobj=stream, mode="r|") as archive:
+            files = sum(1 for member in archive if member.isfile())
+    if files != expected:
+        sys.exit(f"ERROR: The archive has {files} files, expected {expected}")
+
+    name = artifacts["db"]
+    with open(name, "rb") as fh:
+        stream = backup.openDecompressed(name, backup.openInput(name, fh))
+        head = stream.read(64)
+        size = len(head) + sum(
+            len(chunk) for chunk in iter(lambda: stream.read(1024 * 1024), b"")
+        )
+    if not head.startswith(b"CREATE DATABASE") or size < options.dump_mb * 1024 ** 2:
+        sys.exit(f"ERROR: The dump is incomplete, {size} bytes")
+
+    if not options.no_transfer:
+        for name in artifacts.values():
+            remote = name.replace(f"{workdir}/backup/", f"{workdir}/remote/")
+            if not os.path.isfile(remote) or sha256File(remote) != sha256File(name):
+                sys.exit(f"ERROR: The copy '{remote}' is not the same")
+
+    return artifacts
+
+
+#################################################################
+def checkCleanup(workdir, artifacts):
+    """Check the cleanup expired the history, and kept today's backups."""
+
+    for typeName, name in [("app", APP), ("db", DB)]:
+        left = [
+            fname
+            for fname in os.listdir(f"{workdir}/backup/{typeName}/{name}")
+            if not fname.startswith(".")
+        ]
+        if len(left) != KEEP or os.path.basename(artifacts[typeName]) not in left:
+            sys.exit(
+                f"ERROR: {typeName} {name}: The cleanup left {len(left)} backups, expected {KEEP} with today's"
+            )
+
+
+#################################################################
+def loadBackup(workdir):
+    """Import the copy of backup.py in the scratch directory."""
+
+    spec = importlib.util.spec_from_file_location("backup", f"{workdir}/backup.py")
+    backup = importlib.util.module_from_spec(spec)
+    sys.modules["backup"] = backup
+    spec.loader.exec_module(backup)
+    return backup
+
+
+#################################################################
+def main():
+    parser = argparse.ArgumentParser(description="backup.py pipeline benchmark")
+    parser.add_argument("--small", type=int, default=20000, help="small files")
+    parser.add_argument("--small-kb", type=int, default=4, help="avg small kB")
+    parser.add_argument("--huge", type=int, default=2, help="huge files")
+    parser.add_argument("--huge-mb", type=int, default=128, help="huge file MB")
+    parser.add_argument("--media", type=int, default=20, help="media files")
+    parser.add_argument("--media-mb", type=int, default=4, help="media file MB")
+    parser.add_argument("--depth", type=int, default=40, help="deep directories")
+    parser.add_argument("--dump-mb", type=int, default=128, help="database dump MB")
+    parser.add_argument("--seed", type=int, default=42, help="random seed")
+    parser.add_argument("--encrypt", action="store_true", help="encryption stage")
+    parser.add_argument("--no-transfer", action="store_true", help="no SSH host")
+    parser.add_argument("--keep", action="store_true", help="keep scratch dir")
+    parser.add_argument("--serve", help=argparse.SUPPRESS)
+    options = parser.parse_args()
+
+    if options.serve:
+        serve(options.serve)
+        return
+
+    workdir = tempfile.mkdtemp(prefix="backup-pipeline-")
+    server = None
+
+    try:
+        print(f"INFO: Scratch directory '{workdir}'")
+        shutil.copy(BACKUP, f"{workdir}/backup.py")
+
+        now = time.monotonic()
+        size = makeTree(f"{workdir}/docker/{APP}", options)
+        os.makedirs(f"{workdir}/docker/{DB}")
+        makeHistory(f"{workdir}/backup/app/{APP}", APP, "tgz")
+        makeHistory(f"{workdir}/backup/db/{DB}", DB, "sql.gz")
+        print(
+            f"INFO: Generated {size / 1024 ** 2:.0f} MB to archive in {time.monotonic() - now:.1f} seconds"
+        )
+
+        # Fake docker (and ping, if there is none) in front of the PATH
+        os.makedirs(f"{workdir}/bin")
+        with open(f"{workdir}/bin/docker", "w") as fh:
+            fh.write(
+                FAKE_DOCKER.format(
+                    python=sys.executable,
+                    seed=options.seed,
+                    size=options.dump_mb * 1024 * 1024,
+                )
+            )
+        os.chmod(f"{workdir}/bin/docker", 0o755)
+        if not shutil.which("ping"):
+            os.symlink(shutil.which("true"), f"{workdir}/bin/ping")
+        os.environ["PATH"] = f"{workdir}/bin:{os.environ['PATH']}"
+
+        public_key = ""
+        if options.encrypt:
+            import base64
+
+            from cryptography.hazmat.primitives.asymmetric.x25519 import (
+                X25519PrivateKey,
+            )
+
+            private = X25519PrivateKey.generate()
+            with open(f"{workdir}/backup.key", "w") as fh:
+                fh.write(base64.b64encode(private.private_bytes_raw()).decode())
+            public_key = base64.b64encode(
+                private.public_key().public_bytes_raw()
+            ).decode()
+
+        transfer = "[]"
+        if not options.no_transfer:
+            server, port = startServer(workdir)
+            transfer = f"[{{host: 127.0.0.1, port: {port}, user: bench}}]"
+
+        with open(f"{workdir}/backup.yaml", "w") as fh:
+            fh.write(
+                CONFIG.format(
+                    dir=workdir,
+                    transfer=transfer,
+                    encrypt="true" if options.encrypt else "false",
+                    public_key=public_key,
+                    app=APP,
+                    db=DB,
+                    keep=KEEP,
+                )
+            )
+
+        backup = loadBackup(workdir)
+        backup.args = {}
+        backup.hostname = socket.gethostname()
+        backup.config = backup.readConfig()
+
+        meter = Meter()
+        backup._doAppDb = meter.wrap(
+            lambda typeName, entry, *rest: "archive" if typeName == "app" else "dump",
+            backup._doAppDb,
+        )
+        backup.remoteSCP = meter.wrap("transfer", backup.remoteSCP)
+        backup.remoteSSH = meter.wrap("transfer", backup.remoteSSH)
+        backup.doCleanup = meter.wrap("cleanup", backup.doCleanup)
+
+        for typeName in ["app", "db"]:
+            for entry in backup.config[typeName]:
+                backup.doBackupWrapper(typeName, entry)
+        artifacts = checkBackup(backup, workdir, options)
+        backup.doCleanup()
+        checkCleanup(workdir, artifacts)
+        backup.sshCloseAll()
+        backup.catalogClose()
+
+        if backup.ERRORS[backup.CONF_COUNT]:
+            sys.exit(
+                f"ERROR: backup.py reported errors: {backup.ERRORS[backup.CONF_MSG]}"
+            )
+
+        # The bytes per stage: input tree for the archive, the rest from the report
+        sizes = {"archive": size}
+        for typeName, name, stage, seconds, fsize in backup.REPORT:
+            if stage == "dump":
+                sizes["dump"] = sizes.get("dump", 0) + fsize
+            elif stage.startswith("scp "):
+                sizes["transfer"] = sizes.get("transfer", 0) + fsize
+
+        print()
+        print(
+            f"{'stage':10} {'wall s':>8} {'MB':>8} {'MB/s':>8} {'CPU s':>8} {'CPU %':>6} {'child s':>8} {'peak RSS MB':>12}"
+        )
+        for name, stage in meter.stages.items():
+            mbyte = sizes.get(name, 0) / 1024 ** 2
+            rate = f"{mbyte / stage['wall']:8.1f}" if mbyte and stage["wall"] else f"{'-':>8}"
+            print(
+                f"{name:10} {stage['wall']:8.2f} {mbyte:8.0f} {rate} {stage['cpu']:8.2f} "
+                f"{100 * stage['cpu'] / stage['wall'] if stage['wall'] else 0:6.0f} "
+                f"{stage['child']:8.2f} {stage['rss'] / 1024:12.1f}"
+            )
+
+        if server:
+            cpu, rss = stopServer(server)
+            server = None
+            print(f"{'ssh server':10} {'':8} {'':8} {'':8} {cpu:8.2f} {'':6} {'':8} {rss / 1024:12.1f}")
+
+    finally:
+        if server:
+            stopServer(server)
+        if options.keep:
+            print(f"INFO: Kept '{workdir}'")
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+#################################################################
+# Main
+#################################################################
+
+if __name__ == "__main__":
+    main()
+
+# End
@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+
+"""
+Read-ahead benchmark of the app archive, for trees of small files on
+storage with latency (NFS, SD card).
+
+A synthetic tree of small files is archived with 0 (no read-ahead) and more
+prefetch threads. A latency is added to every lstat(), open() and scandir()
+in this process, like a round-trip to a NFS server. Per number of threads
+it reports the seconds and the sha256 of the archive: the archive must be
+the same for every number of threads.
+
+./prefetch.py
+./prefetch.py --files 50000 --latency-ms 2 --threads 0,4,16
+"""
+
+import argparse
+import hashlib
+import importlib.util
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+#################################################################
+BACKUP = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "backup.py")
+
+PER_DIR = 200
+
+
+#################################################################
+class HashWriter:
+    """Write-only sink, only the sha256 and size of what is written."""
+
+    def __init__(self):
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+
+    def write(self, data):
+        self.sha256.update(data)
+        self.size += len(data)
+        return len(data)
+
+
+#################################################################
+def makeTree(root, count, seed):
+    """Small files of 0.5-16 kB, a few hardlinks and symlinks."""
+
+    rnd = random.Random(seed)
+    words = b"backup docker volume sensor state home light switch".split()
+
+    for index in range(count):
+        path = f"{root}/d{index // PER_DIR:04d}"
+        os.makedirs(path, exist_ok=True)
+
+        size = rnd.randrange(512, 16 * 1024)
+        data = b" ".join(rnd.choice(words) for count in range(size // 6))
+        with open(f"{path}/f{index:06d}.txt", "wb") as fh:
+            fh.write(data[:size])
+
+        if index % 1000 == 1:
+            os.link(f"{path}/f{index:06d}.txt", f"{path}/hardlink{index:06d}")
+            os.symlink(f"f{index:06d}.txt", f"{path}/symlink{index:06d}")
+
+
+#################################################################
+def addLatency(seconds):
+    """Every lstat(), open() and scandir() of backup.py waits first."""
+
+    def slow(func):
+        def wrapper(*args, **kwargs):
+            time.sleep(seconds)
+            return func(*args, **kwargs)
+
+        return wrapper
+
+    os.lstat = slow(os.lstat)
+    os.scandir = slow(os.scandir)
+    return slow(open)
+
+
+#################################################################
+def main():
+    parser = argparse.ArgumentParser(description="backup.py read-ahead benchmark")
+    parser.add_argument("--files", type=int, default=20000, help="small files")
+    parser.add_argument("--latency-ms", type=float, default=1.0, help="per call")
+    parser.add_argument(
+        "--threads", default="0,2,4,8,16", help="prefetch threads, comma separated"
+    )
+    parser.add_argument("--level", type=int, default=6, help="compression level")
+    parser.add_argument("--seed", type=int, default=42, help="random seed")
+    parser.add_argument("--dir", default=None, help="directory for the tree")
+    options = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="backup-prefetch-", dir=options.dir)
+    root = f"{workdir}/tree"
+
+    try:
+        # A copy, backup.py logs next to itself
+        shutil.copy(BACKUP, f"{workdir}/backup.py")
+        spec = importlib.util.spec_from_file_location("backup", f"{workdir}/backup.py")
+        backup = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(backup)
+
+        makeTree(root, options.files, options.seed)
+        backup.open = addLatency(options.latency_ms / 1000)
+
+        entry = {
+            backup.CONF_THROTTLE: {backup.CONF_RATE: 0, backup.CONF_FADVISE: False}
+        }
+
+        print(
+            f"INFO: {options.files} files, {options.latency_ms} ms per lstat/open/scandir"
+        )
+        print(f"{'threads':>8} {'seconds':>8} {'speedup':>8} {'MB':>6}  sha256")
+
+        first = None
+        for threads in [int(x) for x in options.threads.split(",")]:
+            sink = HashWriter()
+            now = time.monotonic()
+
+            with backup.GzipWriter(sink, options.level) as compressed:
+                with backup.TarWriter(compressed) as archive:
+                    backup.archiveTree(
+                        archive,
+                        root,
+                        entry,
+                        lambda tarinfo: tarinfo,
+                        compressed,
+                        prefetch=threads,
+                    )
+
+            seconds = time.monotonic() - now
+            digest = sink.sha256.hexdigest()
+            first = first or (seconds, digest)
+
+            print(
+                f"{threads:8} {seconds:8.2f} {first[0] / seconds:7.1f}x "
+                f"{sink.size / 1024 ** 2:6.1f}  {digest[:16]}"
+            )
+
+            if digest != first[1]:
+                sys.exit("ERROR: The archive depends on the number of threads")
+
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+#################################################################
+# Main
+#################################################################
+
+if __name__ == "__main__":
+    main()
+
+# End
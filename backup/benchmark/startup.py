@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+
+"""
+Startup benchmark of backup.py, per subcommand.
+
+Every subcommand is started a few times with "python -X importtime" from a
+scratch directory, with its own backup.yaml and an empty app, so nothing real
+is touched. The wall-clock time is checked against a budget, and the import
+time is split per top-level module. The subcommands that do not talk to
+Docker, SSH or Telegram should not import docker, paramiko, scp or telegram.
+
+Must run as root, same as backup.py:
+
+./startup.py
+./startup.py --budget 300 --repeat 10
+"""
+
+import argparse
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+#################################################################
+BACKUP = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "backup.py")
+
+HEAVY = ["docker", "paramiko", "scp", "telegram"]
+
+# Subcommand, and if it may import the heavy modules
+SUBCOMMANDS = [
+    (["run_host"], False),
+    (["cleanup", "app", "bench"], False),
+    (["backup", "app", "bench"], False),
+    (["verify-restore", "app", "bench"], False),
+]
+
+CONFIG = """config:
+  dir:
+    docker: {dir}/docker
+    local: {dir}/backup
+    remote: {dir}/remote
+  telegram:
+    enabled: false
+
+app:
+  - name: bench
+"""
+
+
+#################################################################
+def importTimes(stderr):
+    """Cumulative import time (us) per top-level module, from -X importtime."""
+
+    times = {}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+
+        fields = line.split("|")
+        # Top-level modules have a single space before the name
+        if len(fields) != 3 or not fields[2].startswith(" ") or fields[2][1] == " ":
+            continue
+
+        try:
+            times[fields[2].strip()] = int(fields[1])
+        except ValueError:
+            continue
+
+    return times
+
+
+#################################################################
+def runOnce(workdir, subcommand):
+    """Start backup.py once, returns the wall-clock seconds and import times."""
+
+    now = time.monotonic()
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", f"{workdir}/backup.py"] + subcommand,
+        cwd=workdir,
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+    )
+    diff = time.monotonic() - now
+
+    if result.returncode != 0:
+        sys.exit(
+            f"ERROR: '{' '.join(subcommand)}' failed, RC={result.returncode}\n{result.stderr[-2000:]}"
+        )
+
+    return diff, importTimes(result.stderr)
+
+
+#################################################################
+def main():
+    parser = argparse.ArgumentParser(description="backup.py startup benchmark")
+    parser.add_argument(
+        "--budget", type=int, default=500, help="budget per subcommand in ms"
+    )
+    parser.add_argument("--repeat", type=int, default=5, help="runs per subcommand")
+    parser.add_argument("--top", type=int, default=5, help="slowest imports shown")
+    options = parser.parse_args()
+
+    if not os.geteuid() == 0:
+        sys.exit("ERROR: Only root can run backup.py, so this benchmark too\n")
+
+    workdir = tempfile.mkdtemp(prefix="backup-startup-")
+    failed = 0
+
+    try:
+        shutil.copy(BACKUP, f"{workdir}/backup.py")
+        with open(f"{workdir}/backup.yaml", "w") as fh:
+            fh.write(CONFIG.format(dir=workdir))
+        os.makedirs(f"{workdir}/docker/bench")
+        os.makedirs(f"{workdir}/backup")
+        with open(f"{workdir}/docker/bench/file.txt", "w") as fh:
+            fh.write("bench\n")
+
+        for subcommand, heavy in SUBCOMMANDS:
+            walltimes = []
+            for count in range(options.repeat):
+                diff, times = runOnce(workdir, subcommand)
+                walltimes.append(diff)
+
+            median = statistics.median(walltimes) * 1000
+            ok = median <= options.budget
+
+            imported = [name for name in HEAVY if name in times]
+            if imported and not heavy:
+                ok = False
+
+            print(
+                f"{'OK  ' if ok else 'FAIL'} {' '.join(subcommand):28} "
+                f"median {median:6.0f} ms, min {min(walltimes) * 1000:6.0f} ms "
+                f"(budget {options.budget} ms), imports {sum(times.values()) / 1000:6.0f} ms"
+            )
+            if imported and not heavy:
+                print(f"     should not import: {', '.join(imported)}")
+
+            for name, value in sorted(times.items(), key=lambda x: -x[1])[
+                : options.top
+            ]:
+                print(f"     {value / 1000:8.1f} ms {name}")
+
+            if not ok:
+                failed += 1
+
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    if failed:
+        sys.exit(f"ERROR: {failed} subcommand(s) over budget")
+
+
+#################################################################
+# Main
+#################################################################
+
+if __name__ == "__main__":
+    main()
+
+# End